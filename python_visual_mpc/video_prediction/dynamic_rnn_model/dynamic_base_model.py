@@ -32,8 +32,23 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
                  vgf_dim,
                  reuse=None,
                  dependent_mask = True,
+                 context_images=None,
+                 context_state=None,
+                 context_pix_distrib=None,
+                 context_encoding=None,
+                 emit_context_encoding=False,
                  ):
-
+        """
+        :param context_images: optional, shape [context_frames, 1, h, w, 3], when given the context is shared by all
+        samples in the batch: the cell then only takes the actions as inputs and the action-independent encoder layers
+        are evaluated once for the whole batch during the context steps
+        :param context_state: shape [1, sdim], first state of the shared context
+        :param context_pix_distrib: shape [context_frames, 1, ndesig, h, w, 1], designated pixel distributions of the shared context
+        :param context_encoding: optional, encoder outputs of the shared context as emitted with emit_context_encoding,
+        each of shape [context_frames, 1, ...], read during the context steps instead of running the encoder
+        :param emit_context_encoding: if True the encoder outputs h0, h1, h2 and the cell and hidden states of the
+        first two lstms are appended to the outputs
+        """
         super(DNACell, self).__init__(_reuse=reuse)
 
         if 'float16' in conf:
@@ -45,6 +60,14 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
         self.state_dim = state_dim
         self.first_image = first_image
         self.first_pix_distrib = first_pix_distrib
+        self.context_images = context_images
+        self.context_state = context_state
+        self.context_pix_distrib = context_pix_distrib
+        self.share_context = context_images is not None
+        self.context_encoding = context_encoding
+        self.emit_context_encoding = emit_context_encoding
+        assert self.share_context or (context_encoding is None and not emit_context_encoding), \
+            'caching the context encoding requires a shared context'
 
         self.num_ground_truth = num_ground_truth
         if conf['model'] != 'appflow' and conf['model'] != 'appflow_chained':
@@ -108,7 +131,6 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
         if self.first_pix_distrib is not None:
             output_size.append(tf.TensorShape([ndesig, height, width, 1]))  # pix_distrib
             output_size.append([tf.TensorShape([ndesig, height, width, 1])] * num_masks)  # transformed_pix_distribs
-        self._output_size = tuple(output_size)
 
         # state_size
         if self.lstm_skip_connection:
@@ -129,6 +151,12 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
             tf.TensorShape([height // 4, width // 4, lstm_filters_multiplier * self.vgf_dim * 2]),
             tf.TensorShape([height // 2, width // 2, lstm_filters_multiplier * self.vgf_dim]),
         ]
+        if self.emit_context_encoding:
+            # h0, h1, h2 have the shapes of the cells of the lstms they feed
+            output_size.append(lstm_cell_sizes[:3] + [lstm_cell_sizes[0], lstm_state_sizes[0],
+                                                      lstm_cell_sizes[1], lstm_state_sizes[1]])  # context encoding
+        self._output_size = tuple(output_size)
+
         state_size = [
             tuple([tf.nn.rnn_cell.LSTMStateTuple(lstm_cell_size, lstm_state_size)
                    for lstm_cell_size, lstm_state_size in zip(lstm_cell_sizes, lstm_state_sizes)]),  # lstm_states
@@ -164,12 +192,98 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
         #     state = lstm_cell.zero_state(batch_size, tf.float32)
         return lstm_cell(inputs, state)
 
-    def call(self, inputs, states):
+    def _encode(self, image, lstm_state0, lstm_state1):
+        """
+        action-independent part of the encoder
+        """
+        vgf_dim = self.vgf_dim
+        with tf.variable_scope('h0'):
+            h0 = conv_pool2d(image, vgf_dim, kernel_size=(5, 5), strides=(2, 2))
+            h0 = self.normalizer_fn(h0)
+            h0 = tf.nn.relu(h0)
+
+        with tf.variable_scope('lstm_h0'):
+            lstm_h0, lstm_state0 = self._lstm_func(h0, lstm_state0, vgf_dim)
+
+        with tf.variable_scope('h1'):
+            h1 = conv_pool2d(lstm_h0, vgf_dim * 2, kernel_size=(3, 3), strides=(2, 2))
+            h1 = self.normalizer_fn(h1)
+            h1 = tf.nn.relu(h1)
+
+        with tf.variable_scope('lstm_h1'):
+            lstm_h1, lstm_state1 = self._lstm_func(h1, lstm_state1, vgf_dim * 2)
+
+        with tf.variable_scope('h2'):
+            h2 = conv_pool2d(lstm_h1, vgf_dim * 4, kernel_size=(3, 3), strides=(2, 2))
+            h2 = self.normalizer_fn(h2)
+            h2 = tf.nn.relu(h2)
+        return h0, h1, h2, lstm_state0, lstm_state1
+
+    def _encode_shared_context(self, time, gen_image, lstm_state0, lstm_state1, batch_size):
+        """
+        During the context steps image and lstm states are identical for all samples, so the encoder is run on a
+        single sample and the result is tiled to the batch. Exact since all normalizations are per sample.
+        """
+        context_step = tf.logical_not(tf.reduce_all(time > self.context_frames - 1))
+        t_context = tf.minimum(tf.to_int32(time[0]), self.context_frames - 1)
+
+        def first_sample(x):
+            return tf.cond(context_step, lambda: x[:1], lambda: x)
+
+        def tile_to_batch(x, static_shape):
+            x = tf.cond(context_step, lambda: tf.tile(x, [batch_size] + [1] * (len(static_shape) - 1)), lambda: x)
+            x.set_shape(static_shape)
+            return x
+
+        image = tf.cond(context_step, lambda: self.context_images[t_context], lambda: gen_image)
+        lstm_states = [tf.nn.rnn_cell.LSTMStateTuple(first_sample(s.c), first_sample(s.h))
+                       for s in [lstm_state0, lstm_state1]]
+        static_shapes = [s.get_shape().as_list() for s in [lstm_state0.c, lstm_state0.h, lstm_state1.c, lstm_state1.h]]
+
+        h0, h1, h2, lstm_state0, lstm_state1 = self._encode(image, *lstm_states)
+
+        h0 = tile_to_batch(h0, [batch_size] + h0.get_shape().as_list()[1:])
+        h1 = tile_to_batch(h1, [batch_size] + h1.get_shape().as_list()[1:])
+        h2 = tile_to_batch(h2, [batch_size] + h2.get_shape().as_list()[1:])
+        lstm_state0 = tf.nn.rnn_cell.LSTMStateTuple(tile_to_batch(lstm_state0.c, static_shapes[0]),
+                                                    tile_to_batch(lstm_state0.h, static_shapes[1]))
+        lstm_state1 = tf.nn.rnn_cell.LSTMStateTuple(tile_to_batch(lstm_state1.c, static_shapes[2]),
+                                                    tile_to_batch(lstm_state1.h, static_shapes[3]))
+        image = tile_to_batch(image, [batch_size] + self.image_shape)
+        return image, h0, h1, h2, lstm_state0, lstm_state1
+
+    def _read_context_encoding(self, time, gen_image, lstm_state0, lstm_state1, batch_size):
+        """
+        During the context steps the encoder outputs are read from self.context_encoding and tiled to the batch, the
+        encoder then runs on an empty batch. Afterwards the generated images are encoded as usual.
+        """
+        context_step = tf.logical_not(tf.reduce_all(time > self.context_frames - 1))
+        t_context = tf.minimum(tf.to_int32(time[0]), self.context_frames - 1)
+
+        def no_sample(x):
+            return tf.cond(context_step, lambda: x[:0], lambda: x)
+
+        lstm_states = [tf.nn.rnn_cell.LSTMStateTuple(no_sample(s.c), no_sample(s.h)) for s in [lstm_state0, lstm_state1]]
+        h0, h1, h2, lstm_state0, lstm_state1 = self._encode(no_sample(gen_image), *lstm_states)
+
+        encoded = []
+        for x, cached in zip([h0, h1, h2, lstm_state0.c, lstm_state0.h, lstm_state1.c, lstm_state1.h],
+                             self.context_encoding):
+            static_shape = [batch_size] + cached.get_shape().as_list()[2:]
+            x = tf.cond(context_step, lambda cached=cached: tf.tile(cached[t_context], [batch_size, 1, 1, 1]),
+                        lambda x=x: x)
+            x.set_shape(static_shape)
+            encoded.append(x)
+        h0, h1, h2 = encoded[:3]
+        lstm_state0 = tf.nn.rnn_cell.LSTMStateTuple(encoded[3], encoded[4])
+        lstm_state1 = tf.nn.rnn_cell.LSTMStateTuple(encoded[5], encoded[6])
+
+        image = tf.cond(context_step, lambda: tf.tile(self.context_images[t_context], [batch_size, 1, 1, 1]),
+                        lambda: gen_image)
+        image.set_shape([batch_size] + self.image_shape)
+        return image, h0, h1, h2, lstm_state0, lstm_state1
 
-        # inputs
-        (image, action, state), other_inputs = inputs[:3], inputs[3:]
-        if other_inputs:
-            pix_distrib = other_inputs.pop(0)
+    def call(self, inputs, states):
 
         # states
         (lstm_states, time, gen_image, gen_state), other_states = states[:4], states[4:]
@@ -182,8 +296,59 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
             if 'appflow_chained' == self.conf['model']:
                 prev_flow_t_0 = other_states.pop(0)
 
-        image_shape = image.get_shape().as_list()
-        batch_size, height, width, color_channels = image_shape
+        done_warm_start = time > self.context_frames - 1
+
+        if self.share_context:
+            # inputs
+            action = inputs[0]
+            batch_size = action.get_shape().as_list()[0]
+            height, width, color_channels = self.image_shape
+            image_shape = [batch_size, height, width, color_channels]
+
+            if self.context_encoding is not None:
+                image, h0, h1, h2, lstm_state0, lstm_state1 = self._read_context_encoding(time, gen_image, lstm_state0,
+                                                                                          lstm_state1, batch_size)
+            else:
+                image, h0, h1, h2, lstm_state0, lstm_state1 = self._encode_shared_context(time, gen_image, lstm_state0,
+                                                                                          lstm_state1, batch_size)
+            context_encoding = [h0, h1, h2, lstm_state0.c, lstm_state0.h, lstm_state1.c, lstm_state1.h]
+            if self.first_pix_distrib is not None:
+                t_context = tf.minimum(tf.to_int32(time[0]), self.context_frames - 1)
+                pix_distrib = tf.cond(tf.reduce_all(done_warm_start),
+                                      lambda: gen_pix_distrib,
+                                      lambda: tf.tile(self.context_pix_distrib[t_context], [batch_size, 1, 1, 1, 1]))
+            state = tf.cond(tf.reduce_all(tf.equal(time, 0)),
+                            lambda: tf.tile(self.context_state, [batch_size, 1]),
+                            lambda: gen_state)
+        else:
+            # inputs
+            (image, action, state), other_inputs = inputs[:3], inputs[3:]
+            if other_inputs:
+                pix_distrib = other_inputs.pop(0)
+
+            image_shape = image.get_shape().as_list()
+            batch_size, height, width, color_channels = image_shape
+
+            if self.feedself:
+                image = tf.cond(tf.reduce_all(done_warm_start),
+                                lambda: gen_image,  # feed in generated image
+                                lambda: image)  # feed in ground_truth
+                if self.first_pix_distrib is not None:
+                    pix_distrib = tf.cond(tf.reduce_all(done_warm_start),
+                                          lambda: gen_pix_distrib,  # feed in generated pixel distribution
+                                          lambda: pix_distrib)  # feed in ground_truth
+            else:
+                image = tf.cond(tf.reduce_all(done_warm_start),
+                                lambda: scheduled_sample(image, gen_image, batch_size, self.num_ground_truth),
+                                # schedule sampling
+                                lambda: image)  # feed in ground_truth
+                if self.first_pix_distrib is not None:
+                    raise NotImplementedError
+            state = tf.cond(tf.reduce_all(tf.equal(time, 0)),
+                            lambda: state,  # feed in ground_truth state only for first time step
+                            lambda: gen_state)  # feed in predicted state
+
+            h0, h1, h2, lstm_state0, lstm_state1 = self._encode(image, lstm_state0, lstm_state1)
 
         _, state_dim = state.get_shape().as_list()
         kernel_size = self.kernel_size
@@ -191,52 +356,11 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
         num_transformed_images = self.num_transformed_images
         vgf_dim = self.vgf_dim
 
-        done_warm_start = time > self.context_frames - 1
-        if self.feedself:
-            image = tf.cond(tf.reduce_all(done_warm_start),
-                            lambda: gen_image,  # feed in generated image
-                            lambda: image)  # feed in ground_truth
-            if self.first_pix_distrib is not None:
-                pix_distrib = tf.cond(tf.reduce_all(done_warm_start),
-                                      lambda: gen_pix_distrib,  # feed in generated pixel distribution
-                                      lambda: pix_distrib)  # feed in ground_truth
-        else:
-            image = tf.cond(tf.reduce_all(done_warm_start),
-                            lambda: scheduled_sample(image, gen_image, batch_size, self.num_ground_truth),
-                            # schedule sampling
-                            lambda: image)  # feed in ground_truth
-            if self.first_pix_distrib is not None:
-                raise NotImplementedError
-        state = tf.cond(tf.reduce_all(tf.equal(time, 0)),
-                        lambda: state,  # feed in ground_truth state only for first time step
-                        lambda: gen_state)  # feed in predicted state
-
         if 'ignore_state' in self.conf:
             state_action = tf.concat([action], axis=-1)
         else:
             state_action = tf.concat([action, state], axis=-1)
 
-        with tf.variable_scope('h0'):
-            h0 = conv_pool2d(image, vgf_dim, kernel_size=(5, 5), strides=(2, 2))
-            h0 = self.normalizer_fn(h0)
-            h0 = tf.nn.relu(h0)
-
-        with tf.variable_scope('lstm_h0'):
-            lstm_h0, lstm_state0 = self._lstm_func(h0, lstm_state0, vgf_dim)
-
-        with tf.variable_scope('h1'):
-            h1 = conv_pool2d(lstm_h0, vgf_dim * 2, kernel_size=(3, 3), strides=(2, 2))
-            h1 = self.normalizer_fn(h1)
-            h1 = tf.nn.relu(h1)
-
-        with tf.variable_scope('lstm_h1'):
-            lstm_h1, lstm_state1 = self._lstm_func(h1, lstm_state1, vgf_dim * 2)
-
-        with tf.variable_scope('h2'):
-            h2 = conv_pool2d(lstm_h1, vgf_dim * 4, kernel_size=(3, 3), strides=(2, 2))
-            h2 = self.normalizer_fn(h2)
-            h2 = tf.nn.relu(h2)
-
         # Pass in state and action.
         if self.use_state:
             with tf.variable_scope('state_action_h2'):
@@ -345,20 +469,17 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
             transformed_pix_distribs = []
             with tf.name_scope('transformed_pix_distrib'):
 
+                # the designated pixels are transformed together as the channels of one image
+                desig_channels = fold_desig(pix_distrib)
                 if self.model == 'appflow' or self.model == 'appflow_chained':
                     if self.model == 'appflow_chained':
                         trafoflow = flow_tp1_0
                     else:
                         trafoflow = flowvecs_tp1_t
-                    transf_pix = [[apply_warp(pix_distrib[:, p], trafoflow)] for p in range(self.ndesig)]
+                    transf_pix = [apply_warp(desig_channels, trafoflow)]
                 else:
-                    transf_pix = [apply_kernels(pix_distrib[:, p], kernels, dilation_rate=dilation_rate) for p in
-                                  range(self.ndesig)]
-                transf_pix_l = []
-                for n in range(self.num_transformed_images):
-                    transf_pix_n = tf.stack([transf_pix[p][n] for p in range(self.ndesig)], axis=1)
-                    transf_pix_l.append(transf_pix_n)
-                transformed_pix_distribs += transf_pix_l
+                    transf_pix = apply_kernels(desig_channels, kernels, dilation_rate=dilation_rate)
+                transformed_pix_distribs += [unfold_desig(transf_pix_n) for transf_pix_n in transf_pix]
             if self.first_image_background:
                 transformed_pix_distribs.append(self.first_pix_distrib)
             if self.prev_image_background:
@@ -388,14 +509,9 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
             with tf.name_scope('gen_pix_distrib'):
                 assert len(transformed_pix_distribs) <= len(masks) <= len(
                     transformed_pix_distribs) + 1  # there might be an extra mask because of the scratch image
-                gen_pix_distrib = []
-                for p in range(self.ndesig):
-                    transformed_pix_distribs_p = [transformed_pix_distribs[n][:, p] for n in
-                                                  range(len(transformed_pix_distribs))]
-                    gen_pix_distrib.append(tf.add_n([transformed_pix_distrib * mask
-                                                     for transformed_pix_distrib, mask in
-                                                     zip(transformed_pix_distribs_p, masks)]))
-                gen_pix_distrib = tf.stack(gen_pix_distrib, axis=1)
+                gen_pix_distrib = tf.add_n([transformed_pix_distrib * mask[:, None]
+                                            for transformed_pix_distrib, mask in
+                                            zip(transformed_pix_distribs, masks)])
 
         with tf.variable_scope('state_pred'):
             gen_state = dense(state_action, state_dim)
@@ -409,6 +525,9 @@ class DNACell(tf.nn.rnn_cell.RNNCell):
             outputs.append(gen_pix_distrib)
             outputs.append(transformed_pix_distribs)
 
+        if self.emit_context_encoding:
+            outputs.append(context_encoding)
+
         outputs = tuple(outputs)
         # states
         new_lstm_states = lstm_state0, lstm_state1, lstm_state2, lstm_state3, lstm_state4
@@ -431,8 +550,19 @@ class Dynamic_Base_Model(object):
                  pix_distrib=None,
                  load_data = True,
                  build_loss = True,
-                 iternum=None
+                 iternum=None,
+                 resume_state=None,
+                 context_encoding=None,
+                 emit_context_encoding=False
                  ):
+        """
+        :param resume_state: optional, recurrent state of DNACell (e.g. final_state of another model) to continue the
+        prediction from, only supported with a shared context. All given actions are then consumed and all generated
+        frames are returned.
+        :param context_encoding: optional, cached encoder outputs of the shared context, see DNACell
+        :param emit_context_encoding: if True the encoder outputs of every step are returned in self.context_encoding,
+        a list of tensors of shape [t, batch_size, ...] in the order DNACell reads them
+        """
 
         if iternum == None:
             self.iter_num = tf.placeholder(tf.float32, [])
@@ -464,15 +594,27 @@ class Dynamic_Base_Model(object):
         if pix_distrib is not None:
             pix_distrib = tf.transpose(pix_distrib, [0,1,4,2,3])[...,None]  #putting ndesig at the third position
 
-        if states is not None and states.get_shape().as_list()[1] != seq_len:  # append zeros if states is shorter than sequence length
+        # context shared by all samples: images, states and pix_distrib are given with batch size 1 and are neither
+        # tiled nor zero-padded to the sequence length
+        self.share_context = 'share_context' in conf and images is not None
+        if self.share_context:
+            assert images.get_shape().as_list()[0] == 1, 'shared context requires context tensors with batch size 1'
+            assert conf['schedsamp_k'] == -1, 'shared context requires feeding back generated images'
+            assert not build_loss, 'shared context is only supported for inference'
+        if resume_state is not None:
+            assert self.share_context, 'resuming from a saved state requires a shared context'
+        if context_encoding is not None or emit_context_encoding:
+            assert self.share_context, 'caching the context encoding requires a shared context'
+
+        if states is not None and states.get_shape().as_list()[1] != seq_len and not self.share_context:  # append zeros if states is shorter than sequence length
             states = tf.concat([states, tf.zeros([conf['batch_size'], seq_len - conf['context_frames'], conf['sdim']])],
                 axis=1)
 
-        if images is not None and images.get_shape().as_list()[1] != seq_len:  # append zeros if states is shorter than sequence length
+        if images is not None and images.get_shape().as_list()[1] != seq_len and not self.share_context:  # append zeros if states is shorter than sequence length
             images = tf.concat([images, tf.zeros([conf['batch_size'], seq_len - conf['context_frames'], self.img_height, self.img_width, 3])],
                 axis=1)
 
-        if pix_distrib is not None:
+        if pix_distrib is not None and not self.share_context:
             pix_distrib = tf.concat([pix_distrib, tf.zeros([conf['batch_size'], seq_len - conf['context_frames'],ndesig, self.img_height, self.img_width, 1])], axis=1)
             pix_distrib = pix_distrib
 
@@ -561,12 +703,19 @@ class Dynamic_Base_Model(object):
 
         if pix_distrib is not None:
             pix_distrib = tf.split(axis=1, num_or_size_splits=pix_distrib.get_shape()[1], value=pix_distrib)
-            pix_distrib = [tf.reshape(pix, [self.batch_size, ndesig, self.img_height, self.img_width, 1]) for pix in pix_distrib]
+            pix_distrib = [tf.reshape(pix, [pix.get_shape().as_list()[0], ndesig, self.img_height, self.img_width, 1]) for pix in pix_distrib]
 
         image_shape = images[0].get_shape().as_list()
         batch_size, height, width, color_channels = image_shape
-        images_length = len(images)
-        sequence_length = images_length - 1
+        if self.share_context:
+            batch_size = actions[0].get_shape().as_list()[0]
+            if resume_state is not None:
+                sequence_length = len(actions)
+            else:
+                sequence_length = len(actions) - 1
+        else:
+            images_length = len(images)
+            sequence_length = images_length - 1
         _, action_dim = actions[0].get_shape().as_list()
         _, state_dim = states[0].get_shape().as_list()
 
@@ -594,28 +743,53 @@ class Dynamic_Base_Model(object):
 
         first_pix_distrib = None if pix_distrib is None else pix_distrib[0]
 
-        cell = DNACell(conf,
-                       [height, width, color_channels],
-                       state_dim,
-                       first_image=images[0],
-                       first_pix_distrib=first_pix_distrib,
-                       num_ground_truth=num_ground_truth,
-                       lstm_skip_connection=False,
-                       feedself=feedself,
-                       use_state=use_state,
-                       vgf_dim=vgf_dim)
-
-        inputs = [tf.stack(images[:sequence_length]), tf.stack(actions[:sequence_length]), tf.stack(states[:sequence_length])]
-        if pix_distrib is not None:
-            inputs.append(tf.stack(pix_distrib[:sequence_length]))
+        if self.share_context:
+            first_image = tf.tile(images[0], [batch_size, 1, 1, 1])
+            if first_pix_distrib is not None:
+                first_pix_distrib = tf.tile(first_pix_distrib, [batch_size, 1, 1, 1, 1])
+            cell = DNACell(conf,
+                           [height, width, color_channels],
+                           state_dim,
+                           first_image=first_image,
+                           first_pix_distrib=first_pix_distrib,
+                           num_ground_truth=num_ground_truth,
+                           lstm_skip_connection=False,
+                           feedself=feedself,
+                           use_state=use_state,
+                           vgf_dim=vgf_dim,
+                           context_images=tf.stack(images),
+                           context_state=states[0],
+                           context_pix_distrib=None if pix_distrib is None else tf.stack(pix_distrib),
+                           context_encoding=context_encoding,
+                           emit_context_encoding=emit_context_encoding)
+            inputs = [tf.stack(actions[:sequence_length])]
+        else:
+            cell = DNACell(conf,
+                           [height, width, color_channels],
+                           state_dim,
+                           first_image=images[0],
+                           first_pix_distrib=first_pix_distrib,
+                           num_ground_truth=num_ground_truth,
+                           lstm_skip_connection=False,
+                           feedself=feedself,
+                           use_state=use_state,
+                           vgf_dim=vgf_dim)
+
+            inputs = [tf.stack(images[:sequence_length]), tf.stack(actions[:sequence_length]), tf.stack(states[:sequence_length])]
+            if pix_distrib is not None:
+                inputs.append(tf.stack(pix_distrib[:sequence_length]))
 
         if 'float16' in conf:
             use_dtype = tf.float16
         else: use_dtype = tf.float32
-        outputs, _ = tf.nn.dynamic_rnn(cell, inputs, sequence_length=[sequence_length] * batch_size, dtype=use_dtype,
-                                       swap_memory=True, time_major=True)
+        outputs, self.final_state = tf.nn.dynamic_rnn(cell, inputs, sequence_length=[sequence_length] * batch_size,
+                                                      initial_state=resume_state, dtype=use_dtype,
+                                                      swap_memory=True, time_major=True)
 
-        n_cutoff = self.context_frames - 1 # only return images predicting future timesteps, omit images predicting steps during context
+        if resume_state is not None:
+            n_cutoff = 0   # a resumed prediction starts after the context
+        else:
+            n_cutoff = self.context_frames - 1 # only return images predicting future timesteps, omit images predicting steps during context
         (gen_images, gen_states, gen_masks, gen_transformed_images), other_outputs = outputs[:4], outputs[4:]
         self.gen_images = tf.transpose(gen_images[n_cutoff:], [1,0,2,3,4])[:,:,None]   # newshape: b,t,n,r,c,3
         self.gen_states = tf.transpose(gen_states[n_cutoff:], [1,0,2])
@@ -624,9 +798,10 @@ class Dynamic_Base_Model(object):
         other_outputs = list(other_outputs)
 
 
-        # making video summaries
-        self.train_video_summaries = make_video_summaries(conf['context_frames'], [self.images, self.gen_images[:,:,0]], 'train_images')
-        self.val_video_summaries = make_video_summaries(conf['context_frames'], [self.images, self.gen_images[:,:,0]], 'val_images')
+        # making video summaries, with a shared context only the context frames are available
+        if not self.share_context:
+            self.train_video_summaries = make_video_summaries(conf['context_frames'], [self.images, self.gen_images[:,:,0]], 'train_images')
+            self.val_video_summaries = make_video_summaries(conf['context_frames'], [self.images, self.gen_images[:,:,0]], 'val_images')
 
         if 'compute_flow_map' in self.conf:
             gen_flow_map = other_outputs.pop(0)
@@ -640,6 +815,9 @@ class Dynamic_Base_Model(object):
                 *[tf.unstack(gen_transformed_pixdistrib, axis=0) for gen_transformed_pixdistrib in
                   self.gen_transformed_pixdistribs]))[n_cutoff:]
 
+        if emit_context_encoding:
+            self.context_encoding = other_outputs.pop(0)
+
         assert not other_outputs
 
         if build_loss:
@@ -827,6 +1005,21 @@ def apply_cdna_kernels(image, kernels, dilation_rate=(1, 1)):
     return outputs
 
 
+def fold_desig(pix_distrib):
+    """
+    :param pix_distrib: shape [batch, ndesig, h, w, 1]
+    :return: shape [batch, h, w, ndesig], the distributions as channels of one image
+    """
+    return tf.transpose(pix_distrib[..., 0], [0, 2, 3, 1])
+
+
+def unfold_desig(desig_channels):
+    """
+    inverse of fold_desig
+    """
+    return tf.transpose(desig_channels, [0, 3, 1, 2])[..., None]
+
+
 def scheduled_sample(ground_truth_x, generated_x, batch_size, num_ground_truth):
     """Sample batch with specified mix of ground truth and generated data points.
 
@@ -1,3 +1,5 @@
+import copy
+import re
 import tensorflow as tf
 from python_visual_mpc.video_prediction.read_tf_records2 import build_tfrecord_input as build_tfrecord_fn
 from python_visual_mpc.video_prediction.utils_vpred.video_summary import make_video_summaries
@@ -39,8 +41,11 @@ class Multi_View_Model(object):
             self.actions = actions
             self.states = states
 
+        self.fold_views = 'fold_views' in conf
         self.models = []
-        for icam in range(conf['ncam']):
+        if self.fold_views:
+            self.models.append(self.buildnet_folded(conf, self.images, pix_distrib, self.states, self.actions))
+        for icam in range(0 if self.fold_views else conf['ncam']):
             if 'multi_gpu' in conf:
                 with tf.device('/gpu:%d' % icam):
                     with tf.variable_scope('icam{}'.format(icam)):
@@ -51,16 +56,24 @@ class Multi_View_Model(object):
 
         if build_loss:
             self.loss = 0.
-            for icam in range(conf['ncam']):
-                self.loss += self.models[icam].loss
+            for model in self.models:
+                self.loss += model.loss
             self.train_op = tf.group([m.train_op for m in self.models])
             self.train_summ_op = tf.summary.merge([m.train_summ_op for m in self.models])
             self.val_summ_op = tf.summary.merge([m.val_summ_op for m in self.models])
 
-        self.gen_images = tf.concat([m.gen_images for m in self.models], axis=2)
-        self.gen_states = tf.concat([m.gen_states for m in self.models], axis=2)
-        if pix_distrib is not None:
-            self.gen_distrib = tf.concat([m.gen_distrib for m in self.models], axis=2)
+        if self.fold_views:
+            ncam, model = conf['ncam'], self.models[0]
+            self.gen_images = unfold_views(model.gen_images[:, :, 0], ncam)
+            gen_states = unfold_views(model.gen_states, ncam)
+            self.gen_states = tf.reshape(gen_states, gen_states.get_shape().as_list()[:2] + [-1])
+            if pix_distrib is not None:
+                self.gen_distrib = unfold_views(model.gen_distrib[:, :, 0], ncam)
+        else:
+            self.gen_images = tf.concat([m.gen_images for m in self.models], axis=2)
+            self.gen_states = tf.concat([m.gen_states for m in self.models], axis=2)
+            if pix_distrib is not None:
+                self.gen_distrib = tf.concat([m.gen_distrib for m in self.models], axis=2)
 
         if build_loss:
             self.train_video_summaries = make_video_summaries(conf['context_frames'], [self.images[:,:,0], self.gen_images[:,:,0],
@@ -77,6 +90,23 @@ class Multi_View_Model(object):
                                    build_loss=self.build_loss, load_data=False, iternum=self.iter_num)
         return model
 
+    def buildnet_folded(self, conf, images, pix_distrib, states, actions):
+        """
+        one network with weights shared by all cameras, the cameras are folded into the batch dimension. The variables
+        are named like those of a single-view model.
+        """
+        assert 'share_context' not in conf, 'fold_views does not support a shared context'
+        ncam = conf['ncam']
+        print('building one network for {} cameras'.format(ncam))
+        model_conf = copy.deepcopy(conf)
+        model_conf['batch_size'] = conf['batch_size'] * ncam
+        if pix_distrib is not None:
+            pix_distrib = fold_views(pix_distrib)
+        model = Dynamic_Base_Model(model_conf, fold_views(images), tile_views(actions, ncam), tile_views(states, ncam),
+                                   pix_distrib=pix_distrib, build_loss=self.build_loss, load_data=False,
+                                   iternum=self.iter_num)
+        return model
+
     def random_shift(self, images, states, actions):
         print('shifting the video sequence randomly in time')
         tshift = 3
@@ -95,3 +125,46 @@ class Multi_View_Model(object):
 
     def visualize(self, sess):
         visualize(sess, self.conf, self)
+
+
+def check_folded_checkpoint(model_file):
+    """
+    fold_views shares one network between the cameras and names its variables like a single-view model, a checkpoint
+    with one network per camera would be matched to the weights of one of its cameras for all cameras
+    :raises ValueError: if model_file holds the per-camera icam{i} networks
+    """
+    per_camera = [name for name, _ in tf.train.list_variables(model_file) if re.search(r'(^|/)icam\d+/', name)]
+    if per_camera:
+        raise ValueError('fold_views needs a single-view checkpoint or one trained with fold_views, {} holds '
+                         'per-camera networks, e.g. {}'.format(model_file, per_camera[0]))
+
+
+def fold_views(x):
+    """
+    :param x: shape [batch, t, ncam, ...]
+    :return: shape [batch * ncam, t, ...], the cameras of a sample are consecutive rows
+    """
+    shape = x.get_shape().as_list()
+    x = tf.transpose(x, [0, 2, 1] + list(range(3, len(shape))))
+    return tf.reshape(x, [shape[0] * shape[2], shape[1]] + shape[3:])
+
+
+def tile_views(x, ncam):
+    """
+    :param x: shape [batch, ...]
+    :return: shape [batch * ncam, ...], every sample repeated for all cameras like in fold_views
+    """
+    shape = x.get_shape().as_list()
+    x = tf.tile(x[:, None], [1, ncam] + [1] * (len(shape) - 1))
+    return tf.reshape(x, [shape[0] * ncam] + shape[1:])
+
+
+def unfold_views(x, ncam):
+    """
+    inverse of fold_views
+    :param x: shape [batch * ncam, t, ...]
+    :return: shape [batch, t, ncam, ...]
+    """
+    shape = x.get_shape().as_list()
+    x = tf.reshape(x, [shape[0] // ncam, ncam] + shape[1:])
+    return tf.transpose(x, [0, 2, 1] + list(range(3, len(shape) + 1)))
@@ -0,0 +1,151 @@
+"""
+Freezes a trained video-prediction model into a constant graph that only contains the ops planning fetches.
+
+    python frozen_predictor.py <netconf.py> <output prefix> [--fetches gen_distrib gen_images gen_states]
+
+writes <prefix>.pb and <prefix>.json with the input and output names, the batch size and the measured startup times.
+Setting conf['frozen_graph'] = <prefix> makes setup_predictor load the frozen graph instead of building the model.
+"""
+import os
+import copy
+import imp
+import json
+import time
+import argparse
+import tensorflow as tf
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.logger import Logger
+from python_visual_mpc.video_prediction.utils_vpred.output_fetches import OUTPUT_KEYS, FetchCache, unpack_outputs
+
+
+def _node_name(tensor):
+    return tensor.name.split(':')[0]
+
+
+def export_frozen_graph(conf, prefix, fetches=('gen_distrib',), gpu_id=0, logger=None):
+    """
+    builds the model with setup_predictor, folds the variables into constants and keeps only the ops needed for fetches
+    :return: seconds setup_predictor took to build and restore the model
+    """
+    from python_visual_mpc.video_prediction.setup_predictor_towers import setup_predictor
+    if logger is None:
+        logger = Logger(printout=True)
+    conf = copy.deepcopy(conf)
+    for key in ('frozen_graph', 'prefix_depth', 'cache_context'):
+        conf.pop(key, None)
+
+    t_start = time.time()
+    graph_io = setup_predictor({}, conf, gpu_id, 1, logger).graph_io
+    t_build = time.time() - t_start
+
+    outputs = dict((k, graph_io['outputs'][k]) for k in fetches if graph_io['outputs'][k] is not None)
+    assert outputs, 'none of {} exists in this model'.format(fetches)
+    inputs = dict((k, v) for k, v in graph_io['inputs'].items() if v is not None)
+    if 'gen_distrib' not in outputs:
+        inputs.pop('input_one_hot_images', None)
+    output_nodes = [_node_name(t) for t in outputs.values()]
+
+    sess = graph_io['session']
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_nodes)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_nodes)
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, [_node_name(t) for t in inputs.values()], output_nodes,
+                                   ['strip_unused_nodes', 'fold_constants(ignore_errors=true)'])
+    except ImportError:
+        logger.log('graph_transforms not available, exporting without constant folding')
+
+    # placeholders the remaining graph still depends on besides the inputs, e.g. the iteration number of scheduled
+    # sampling, are fed with zeros like setup_predictor does
+    input_nodes = set(_node_name(t) for t in inputs.values())
+    zero_inputs = [n.name + ':0' for n in graph_def.node if n.op == 'Placeholder' and n.name not in input_nodes]
+
+    with open(prefix + '.pb', 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta = {'inputs': dict((k, t.name) for k, t in inputs.items()),
+            'input_shapes': dict((k, t.get_shape().as_list()) for k, t in inputs.items()),
+            'outputs': dict((k, t.name) for k, t in outputs.items()),
+            'zero_inputs': zero_inputs,
+            'batch_size': conf['batch_size'],
+            'nodes': len(graph_def.node),
+            'nodes_full': len(sess.graph.as_graph_def().node),
+            'startup_seconds': {'full': t_build}}
+    with open(prefix + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    logger.log('exported {} of {} nodes to {}.pb'.format(meta['nodes'], meta['nodes_full'], prefix))
+    return t_build
+
+
+def setup_frozen_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
+    """
+    same signature and predictor_func as setup_predictor, loads the frozen graph at conf['frozen_graph'], outputs that
+    were not exported are returned as None
+    """
+    if logger is None:
+        logger = Logger(printout=True)
+    prefix = conf['frozen_graph']
+    with open(prefix + '.json', 'r') as f:
+        meta = json.load(f)
+    assert meta['batch_size'] == conf['batch_size'], 'graph was exported for batch size {}'.format(meta['batch_size'])
+    os.environ["CUDA_VISIBLE_DEVICES"] = ','.join(str(i) for i in range(gpu_id, gpu_id + ngpu))
+
+    graph_def = tf.GraphDef()
+    with open(prefix + '.pb', 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    session_config = tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=0.7),
+                                    allow_soft_placement=True)
+    if 'num_threads' in conf:
+        session_config.intra_op_parallelism_threads = conf['num_threads']
+        session_config.inter_op_parallelism_threads = conf['num_threads']
+    sess = tf.Session(config=session_config, graph=graph)
+    logger.log('loaded frozen predictor {} with {} nodes'.format(prefix, meta['nodes']))
+
+    inputs = dict((k, graph.get_tensor_by_name(name)) for k, name in meta['inputs'].items())
+    fetch_cache = FetchCache(dict((k, graph.get_tensor_by_name(name)) for k, name in meta['outputs'].items()))
+    zero_feeds = dict((graph.get_tensor_by_name(name), 0) for name in meta['zero_inputs'])
+
+    def predictor_func(input_images=None, input_one_hot_images=None, input_state=None, input_actions=None,
+                       fetches=None):
+        feed_dict = dict(zero_feeds)
+        for key, value in (('input_images', input_images), ('input_one_hot_images', input_one_hot_images),
+                           ('input_state', input_state), ('input_actions', input_actions)):
+            if key in inputs:
+                feed_dict[inputs[key]] = value
+        names, tensors = fetch_cache.get(fetches, input_one_hot_images is not None)
+        return unpack_outputs(names, sess.run(tensors, feed_dict))
+
+    predictor_func.accepts_fetches = True
+    return predictor_func
+
+
+def main():
+    parser = argparse.ArgumentParser(description='freeze a video prediction model for planning')
+    parser.add_argument('netconf', type=str, help='video prediction configuration file')
+    parser.add_argument('prefix', type=str, help='output path without extension')
+    parser.add_argument('--fetches', type=str, nargs='+', default=['gen_distrib'], choices=OUTPUT_KEYS)
+    parser.add_argument('--batch_size', type=int, default=-1, help='batch size of the frozen graph, default from netconf')
+    parser.add_argument('--gpu_id', type=int, default=0)
+    args = parser.parse_args()
+
+    conf = imp.load_source('params', args.netconf).configuration
+    if args.batch_size != -1:
+        conf['batch_size'] = args.batch_size
+    t_build = export_frozen_graph(conf, args.prefix, args.fetches, args.gpu_id)
+
+    t_start = time.time()
+    setup_frozen_predictor({}, dict(conf, frozen_graph=args.prefix), args.gpu_id)
+    t_frozen = time.time() - t_start
+
+    with open(args.prefix + '.json', 'r') as f:
+        meta = json.load(f)
+    meta['startup_seconds']['frozen'] = t_frozen
+    with open(args.prefix + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    print('startup: {:.1f} s building and restoring, {:.1f} s loading the frozen graph ({:.1f}x)'.format(
+        t_build, t_frozen, t_build / max(t_frozen, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
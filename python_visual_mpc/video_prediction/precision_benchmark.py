@@ -0,0 +1,133 @@
+""" accuracy against float32 and CPU latency of the video predictor in float16 and with int8 weights on stored trajectories """
+import os
+import glob
+import copy
+import imp
+import time
+import argparse
+import pickle as pkl
+import numpy as np
+import cv2
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.logger import Logger
+from python_visual_mpc.video_prediction.utils_vpred.quantization import distrib_divergence
+
+
+MODES = {'fp32': {}, 'fp16': {'float16': ''}}
+
+
+def load_trajectory(folder, conf):
+    """
+    reads a trajectory saved by Sim._save_raw_data
+    :return: images of shape [T, ncam, r, c, 3] in [0, 1] resized to conf['orig_size'], states, actions and the
+    designated pixel of every camera at the first step
+    """
+    with open(os.path.join(folder, 'obs_dict.pkl'), 'rb') as f:
+        obs_dict = pkl.load(f)
+    with open(os.path.join(folder, 'policy_out.pkl'), 'rb') as f:
+        policy_out = pkl.load(f)
+    height, width = conf['orig_size']
+    ncam = conf.get('ncam', 1)
+    T = obs_dict['state'].shape[0]
+
+    images = np.zeros((T, ncam, height, width, 3), dtype=np.float32)
+    for t in range(T):
+        for icam in range(ncam):
+            files = glob.glob('{}/images{}/im_{}.*'.format(folder, icam, t))
+            img = cv2.imread(files[0])[:, :, ::-1]
+            images[t, icam] = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA) / 255.
+
+    actions = np.stack([p['actions'] for p in policy_out])[:, :conf['adim']]
+    if 'obj_image_locations' in obs_dict:
+        desig = obs_dict['obj_image_locations'][0, :, :conf['ndesig']].reshape(ncam, conf['ndesig'], 2)
+    else:
+        desig = np.tile(np.array([height // 2, width // 2]), [ncam, conf['ndesig'], 1])
+    return images, obs_dict['state'][:, :conf['sdim']], actions, desig
+
+
+def make_inputs(trajectory, conf, action_noise, rng):
+    """
+    context of the trajectory's first steps and a batch of its actions perturbed like CEM samples
+    """
+    images, states, actions, desig = trajectory
+    ctxt, seqlen, height, width = conf['context_frames'], conf['sequence_length'], conf['orig_size'][0], \
+                                  conf['orig_size'][1]
+    seq_actions = np.zeros((seqlen, conf['adim']))
+    n = min(seqlen, actions.shape[0])
+    seq_actions[:n] = actions[:n]
+    batch_actions = seq_actions[None] + action_noise * rng.standard_normal((conf['batch_size'], seqlen, conf['adim']))
+    batch_actions[0] = seq_actions
+
+    one_hot = np.zeros((1, ctxt, images.shape[1], height, width, conf['ndesig']), dtype=np.float32)
+    desig = np.clip(desig, 0, np.array([height - 1, width - 1])).astype(np.int64)
+    for icam in range(images.shape[1]):
+        for p in range(conf['ndesig']):
+            one_hot[:, :, icam, desig[icam, p, 0], desig[icam, p, 1], p] = 1.
+    return {'input_images': images[None, :ctxt], 'input_state': states[None, :ctxt],
+            'input_actions': batch_actions.astype(np.float32), 'input_one_hot_images': one_hot}
+
+
+def run_mode(conf, mode_keys, inputs, gpu_id, niter):
+    """
+    :return: predicted distributions for every input and the seconds per predictor call after one warm-up call
+    """
+    mode_conf = copy.deepcopy(conf)
+    mode_conf.update(mode_keys)
+    predictor = mode_conf['setup_predictor']({}, mode_conf, gpu_id, 1, Logger(printout=True))
+    distribs = [predictor(**inp)[1] for inp in inputs]
+
+    times = []
+    for i in range(niter):
+        t_start = time.time()
+        predictor(**inputs[i % len(inputs)])
+        times.append(time.time() - t_start)
+    return distribs, np.array(times)
+
+
+def mean_divergence(ref, distribs):
+    tv, kl = zip(*[distrib_divergence(r, d) for r, d in zip(ref, distribs)])
+    return np.mean(tv, axis=0), np.mean(kl, axis=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='reduced precision video prediction benchmark')
+    parser.add_argument('netconf', type=str, help='video prediction configuration file with the float32 checkpoint')
+    parser.add_argument('trajectories', type=str, nargs='+', help='trajectory folders written by Sim')
+    parser.add_argument('--modes', type=str, nargs='+', default=['fp32', 'fp16', 'int8'])
+    parser.add_argument('--ncalib', type=int, default=4, help='trajectories used to calibrate the int8 clipping')
+    parser.add_argument('--clip_percentiles', type=float, nargs='+', default=[100., 99.99, 99.9, 99.])
+    parser.add_argument('--action_noise', type=float, default=0.05, help='std of the perturbation of stored actions')
+    parser.add_argument('--niter', type=int, default=20, help='timed predictor calls per mode')
+    parser.add_argument('--gpu_id', type=int, default=-1, help='-1 hides all gpus and runs on the CPU')
+    args = parser.parse_args()
+
+    conf = imp.load_source('params', args.netconf).configuration
+    for key in ('float16', 'int8_weights', 'prefix_depth', 'batched_context'):
+        conf.pop(key, None)
+    rng = np.random.RandomState(0)
+    inputs = [make_inputs(load_trajectory(folder, conf), conf, args.action_noise, rng) for folder in args.trajectories]
+    calib, evaluation = inputs[:args.ncalib], inputs[args.ncalib:]
+    assert evaluation, 'need more than --ncalib trajectories'
+
+    ref_calib, _ = run_mode(conf, MODES['fp32'], calib, args.gpu_id, 0)
+    results = {}
+    for mode in args.modes:
+        keys = MODES.get(mode)
+        if mode == 'int8':
+            calibration = []
+            for percentile in args.clip_percentiles:
+                distribs, _ = run_mode(conf, {'int8_weights': percentile}, calib, args.gpu_id, 0)
+                calibration.append((np.mean(mean_divergence(ref_calib, distribs)[0]), percentile))
+                print('int8 calibration: clip percentile {}, mean total variation {:.5f}'.format(percentile,
+                                                                                              calibration[-1][0]))
+            keys = {'int8_weights': min(calibration)[1]}
+        results[mode] = (keys,) + run_mode(conf, keys, evaluation, args.gpu_id, args.niter)
+
+    ref = results['fp32'][1] if 'fp32' in results else run_mode(conf, {}, evaluation, args.gpu_id, 0)[0]
+    print('{} evaluation trajectories, batch size {}'.format(len(evaluation), conf['batch_size']))
+    for mode in args.modes:
+        keys, distribs, times = results[mode]
+        tv, kl = mean_divergence(ref, distribs)
+        print('{} {}: {:.1f} ms per call, {:.0f} samples/s'.format(mode, keys, 1e3 * np.mean(times),
+                                                                   conf['batch_size'] / np.mean(times)))
+        print('  total variation per step ' + ' '.join('{:.4f}'.format(v) for v in tv))
+        print('  KL per step              ' + ' '.join('{:.4f}'.format(v) for v in kl))
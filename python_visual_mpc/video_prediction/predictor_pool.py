@@ -0,0 +1,166 @@
+"""
+Spreads the samples of a CEM iteration over several predictor processes.
+
+Every replica builds its own model with conf['setup_predictor'] in a persistent worker process. The action samples are
+written to a shared array that the replicas slice, each replica scores its predictions with the expected pixel
+distance and writes the per-step costs to a second shared array, so only the small context inputs and the timings go
+through the queues. With one configuration per replica and ensemble set, every replica scores all samples, e.g. with
+independently trained checkpoints.
+
+The pool forks its workers, create it before a TensorFlow session is opened in the planning process.
+"""
+import copy
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+from python_visual_mpc.visual_mpc_core.algorithm.utils.pixel_cost import expected_distance_costs
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.logger import Logger
+from python_visual_mpc.video_prediction.utils_vpred.output_fetches import call_predictor
+
+
+def _predict_rows(predictor, batch_size, inputs, actions):
+    """
+    runs the predictor in chunks of batch_size, the last chunk is padded by repeating its last row
+    :return: gen_distrib of all rows
+    """
+    nrows = actions.shape[0]
+    gen_distrib = None
+    for start in range(0, nrows, batch_size):
+        stop = min(start + batch_size, nrows)
+        chunk = actions[start:stop]
+        if stop - start < batch_size:
+            chunk = np.concatenate([chunk, np.repeat(chunk[-1:], batch_size - chunk.shape[0], axis=0)])
+        _, gen_distrib_, _, _ = call_predictor(predictor, ['gen_distrib'], input_actions=chunk, **inputs)
+        if gen_distrib is None:
+            gen_distrib = np.empty((nrows,) + gen_distrib_.shape[1:], dtype=gen_distrib_.dtype)
+        gen_distrib[start:stop] = gen_distrib_[:stop - start]
+    return gen_distrib
+
+
+def _replica_worker(replica_id, conf, hyperparams, gpu_id, task_queue, done_queue, actions_buf, action_shape,
+                    costs_buf, cost_shape):
+    actions = np.frombuffer(actions_buf, dtype=np.float32).reshape(action_shape)
+    costs = np.frombuffer(costs_buf, dtype=np.float64).reshape(cost_shape)
+    try:
+        logger = Logger(printout=True)
+        predictor = conf['setup_predictor'](hyperparams, conf, gpu_id, 1, logger)
+        done_queue.put((replica_id, None, None))
+    except Exception:
+        done_queue.put((replica_id, traceback.format_exc(), None))
+        return
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        try:
+            inputs, distance_grids, normalize, start, stop = task
+            t_start = time.time()
+            gen_distrib = _predict_rows(predictor, conf['batch_size'], inputs, actions[start:stop])
+            costs[replica_id, start:stop] = expected_distance_costs(gen_distrib, distance_grids, normalize)
+            done_queue.put((replica_id, None, time.time() - t_start))
+        except Exception:
+            done_queue.put((replica_id, traceback.format_exc(), None))
+
+
+class PredictorPool(object):
+    """
+    Persistent predictor replicas sharing the action samples and per-step costs through shared memory
+    """
+    def __init__(self, confs, hyperparams, max_samples, ensemble=False, gpu_id=0, logger=None):
+        """
+        :param confs: one netconf per replica, e.g. copies of the same conf with different 'pretrained_model'
+        :param max_samples: largest number of samples per call
+        :param ensemble: if True every replica scores all samples, otherwise the samples are split between replicas
+        """
+        self.nreplicas = len(confs)
+        self.ensemble = ensemble
+        if logger is None:
+            logger = Logger(printout=True)
+        self.logger = logger
+
+        conf = confs[0]
+        ncam = conf.get('ncam', 1)
+        self._action_shape = (max_samples, conf['sequence_length'], conf['adim'])
+        self._cost_shape = (self.nreplicas, max_samples, conf['sequence_length'] - conf['context_frames'], ncam,
+                            conf['ndesig'])
+        actions_buf = RawArray('f', int(np.prod(self._action_shape)))
+        costs_buf = RawArray('d', int(np.prod(self._cost_shape)))
+        self._actions = np.frombuffer(actions_buf, dtype=np.float32).reshape(self._action_shape)
+        self._costs = np.frombuffer(costs_buf, dtype=np.float64).reshape(self._cost_shape)
+
+        self._task_queues = [mp.Queue() for _ in range(self.nreplicas)]
+        self._done_queue = mp.Queue()
+        self._procs = []
+        for i, replica_conf in enumerate(confs):
+            p = mp.Process(target=_replica_worker, args=(i, copy.deepcopy(replica_conf), hyperparams, gpu_id,
+                                                         self._task_queues[i], self._done_queue, actions_buf,
+                                                         self._action_shape, costs_buf, self._cost_shape))
+            p.daemon = True
+            p.start()
+            self._procs.append(p)
+        self._gather(self.nreplicas)
+        self.logger.log('started {} predictor replicas'.format(self.nreplicas))
+
+    def _gather(self, nresults):
+        latencies = {}
+        for _ in range(nresults):
+            replica_id, error, latency = self._done_queue.get()
+            if error is not None:
+                raise RuntimeError('predictor replica {} failed:\n{}'.format(replica_id, error))
+            latencies[replica_id] = latency
+        return latencies
+
+    def predict_costs(self, actions, distance_grids, normalize=True, input_images=None, input_state=None,
+                      input_one_hot_images=None):
+        """
+        :param actions: shape [M, sequence_length, adim]
+        :param distance_grids: shape [ncam, ndesig, r, c]
+        :return: expected distance per step of shape [nreplicas, M, t, ncam, ndesig] when ensembling, otherwise
+        [1, M, t, ncam, ndesig], and a dict with the seconds every active replica took
+        """
+        M = actions.shape[0]
+        assert M <= self._action_shape[0], 'pool was created for at most {} samples'.format(self._action_shape[0])
+        self._actions[:M] = actions
+        inputs = {'input_images': input_images, 'input_state': input_state,
+                  'input_one_hot_images': input_one_hot_images}
+
+        if self.ensemble:
+            bounds = [(0, M)] * self.nreplicas
+        else:
+            splits = np.linspace(0, M, self.nreplicas + 1).astype(np.int64)
+            bounds = list(zip(splits[:-1], splits[1:]))
+        active = [i for i in range(self.nreplicas) if bounds[i][1] > bounds[i][0]]
+        for i in active:
+            self._task_queues[i].put((inputs, distance_grids, normalize, bounds[i][0], bounds[i][1]))
+        latencies = self._gather(len(active))
+
+        if self.ensemble:
+            return self._costs[:, :M].copy(), latencies
+        costs = np.empty((1,) + (M,) + self._cost_shape[2:])
+        for i in active:
+            costs[0, bounds[i][0]:bounds[i][1]] = self._costs[i, bounds[i][0]:bounds[i][1]]
+        return costs, latencies
+
+    def close(self):
+        for q in self._task_queues:
+            q.put(None)
+        for p in self._procs:
+            p.join()
+
+
+def replica_confs(conf, nreplicas, checkpoints=None):
+    """
+    :param checkpoints: list of 'pretrained_model' paths, one replica per checkpoint; if empty nreplicas copies of conf
+    """
+    if checkpoints:
+        confs = []
+        for path in checkpoints:
+            replica_conf = copy.deepcopy(conf)
+            replica_conf['pretrained_model'] = path
+            confs.append(replica_conf)
+        return confs
+    return [copy.deepcopy(conf) for _ in range(nreplicas)]
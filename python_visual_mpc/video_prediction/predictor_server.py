@@ -0,0 +1,281 @@
+"""
+Serves one video-prediction model to many CEM controllers over a local unix socket.
+
+Requests of all connected clients are coalesced into full batches of the server's batch_size, every sample carries the
+context of the request it belongs to. Start the server with
+
+    python predictor_server.py <netconf.py> --address /tmp/vmpc_predictor
+
+and set the policy hparam 'predictor_server' to the same address to make the controllers use it.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import imp
+import copy
+import traceback
+import collections
+from threading import Thread, Event
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+if sys.version_info[0] == 2:
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.logger import Logger
+from python_visual_mpc.video_prediction.utils_vpred.output_fetches import call_predictor
+
+ACTION_KEY = 'input_actions'   # all other inputs have batch size 1 and are shared by all rows of a request
+
+
+class _Request(object):
+    def __init__(self, inputs, fetches=None):
+        self.inputs = dict([(k, v) for k, v in inputs.items() if v is not None])
+        self.fetches = fetches
+        self.nrows = self.inputs[ACTION_KEY].shape[0]
+        # only requests with the same inputs, shapes and fetched outputs can share a batch
+        self.signature = tuple(sorted((k, v.shape[1:]) for k, v in self.inputs.items())) + \
+                         (None if fetches is None else tuple(sorted(fetches)),)
+        self.next_row = 0
+        self.rows_done = 0
+        self.outputs = None
+        self.error = None
+        self.done = Event()
+
+    def store(self, outputs, offset, start, stop):
+        if self.outputs is None:
+            self.outputs = [None if o is None else np.empty((self.nrows,) + o.shape[1:], dtype=o.dtype)
+                            for o in outputs]
+        for out, o in zip(self.outputs, outputs):
+            if out is not None:
+                out[start:stop] = o[offset:offset + stop - start]
+        self.rows_done += stop - start
+        if self.rows_done == self.nrows:
+            self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+
+class PredictorServer(object):
+    def __init__(self, predictor, batch_size, address, max_wait=0.01, authkey=None, logger=None):
+        """
+        :param predictor: predictor_func that takes one context per sample, e.g. from setup_predictor with
+        conf['batched_context'] set
+        :param batch_size: number of rows the predictor processes per call
+        :param address: path of the unix socket
+        :param max_wait: seconds to wait for more requests once a batch has been started
+        """
+        self._predictor = predictor
+        self.batch_size = batch_size
+        self.address = address
+        self.max_wait = max_wait
+        self._authkey = authkey
+        if logger is None:
+            logger = Logger(printout=True)
+        self.logger = logger
+
+        self._queue = Queue()
+        self._pending = collections.deque()   # requests that did not fit into the previous batch
+        self._stop = Event()
+        self._listener = None
+        self.n_batches, self.n_rows = 0, 0
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self._listener = Listener(self.address, family='AF_UNIX', authkey=self._authkey)
+        self.logger.log('predictor server listening on', self.address)
+
+        batch_thread = Thread(target=self._batch_loop)
+        batch_thread.daemon = True
+        batch_thread.start()
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn = self._listener.accept()
+                except (OSError, IOError, EOFError):
+                    if self._stop.is_set():
+                        break
+                    raise
+                if self._stop.is_set():   # the connection of shutdown
+                    conn.close()
+                    break
+                client_thread = Thread(target=self._serve_client, args=(conn,))
+                client_thread.daemon = True
+                client_thread.start()
+        finally:
+            self._stop.set()
+            batch_thread.join()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._listener is not None:
+            try:   # closing the listener does not wake up accept in serve_forever, connecting does
+                wakeup = socket.socket(socket.AF_UNIX)
+                wakeup.connect(self.address)
+                wakeup.close()
+            except (OSError, IOError):
+                pass
+            self._listener.close()
+
+    def _serve_client(self, conn):
+        try:
+            while True:
+                inputs, fetches = conn.recv()
+                request = _Request(inputs, fetches)
+                self._queue.put(request)
+                request.done.wait()
+                if request.error is not None:
+                    conn.send(('error', request.error))
+                else:
+                    conn.send(('ok', tuple(request.outputs)))
+        except (EOFError, IOError, OSError):
+            pass   # client disconnected
+        finally:
+            conn.close()
+
+    def _next_request(self, deadline):
+        if self._pending:
+            return self._pending.popleft()
+        if deadline is None:
+            timeout = 0.1
+        else:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return None
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def _collect_batch(self):
+        """
+        :return: list of (request, first row, last row) filling at most one batch
+        """
+        chunks, nrows, deferred = [], 0, []
+        deadline = None
+        while nrows < self.batch_size:
+            request = self._next_request(deadline)
+            if request is None:
+                break
+            if request.error is not None:   # remaining rows of a request whose earlier rows failed
+                continue
+            if chunks and request.signature != chunks[0][0].signature:
+                deferred.append(request)
+                continue
+            if deadline is None:
+                deadline = time.time() + self.max_wait
+
+            n = min(request.nrows - request.next_row, self.batch_size - nrows)
+            chunks.append((request, request.next_row, request.next_row + n))
+            request.next_row += n
+            nrows += n
+            if request.next_row < request.nrows:
+                deferred.insert(0, request)   # the remaining rows go first into the next batch
+        self._pending.extendleft(reversed(deferred))
+        return chunks
+
+    def _run_batch(self, chunks):
+        first = chunks[0][0]
+        inputs = dict([(k, np.zeros((self.batch_size,) + v.shape[1:], dtype=v.dtype)) for k, v in first.inputs.items()])
+        offset = 0
+        for request, start, stop in chunks:
+            n = stop - start
+            for k, v in request.inputs.items():
+                if k == ACTION_KEY:
+                    inputs[k][offset:offset + n] = v[start:stop]
+                else:
+                    inputs[k][offset:offset + n] = v
+            offset += n
+
+        try:
+            outputs = call_predictor(self._predictor, first.fetches, **inputs)
+        except Exception:
+            error = traceback.format_exc()
+            self.logger.log('predictor failed', error)
+            for request, _, _ in chunks:
+                request.fail(error)
+            return
+
+        offset = 0
+        for request, start, stop in chunks:
+            request.store(outputs, offset, start, stop)
+            offset += stop - start
+        self.n_batches += 1
+        self.n_rows += offset
+
+    def _batch_loop(self):
+        while not self._stop.is_set():
+            chunks = self._collect_batch()
+            if chunks:
+                self._run_batch(chunks)
+
+
+class PredictorClient(object):
+    """
+    drop-in replacement for the predictor_func returned by setup_predictor
+    """
+    def __init__(self, address, authkey=None):
+        self._conn = Client(address, family='AF_UNIX', authkey=authkey)
+
+    accepts_fetches = True
+
+    def __call__(self, input_images=None, input_one_hot_images=None, input_state=None, input_actions=None,
+                 fetches=None):
+        self._conn.send(({'input_images': input_images,
+                          'input_one_hot_images': input_one_hot_images,
+                          'input_state': input_state,
+                          'input_actions': input_actions}, fetches))
+        status, result = self._conn.recv()
+        if status == 'error':
+            raise RuntimeError('predictor server failed:\n' + result)
+        return result
+
+    def close(self):
+        self._conn.close()
+
+
+def setup_predictor_client(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
+    """
+    same signature as setup_predictor, connects to the server at conf['predictor_server'] instead of building the model
+    """
+    if logger is not None:
+        logger.log('connecting to predictor server at', conf['predictor_server'])
+    return PredictorClient(conf['predictor_server'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve a video prediction model to several CEM controllers')
+    parser.add_argument('netconf', type=str, help='video prediction configuration file')
+    parser.add_argument('--address', type=str, default='/tmp/vmpc_predictor', help='path of the unix socket')
+    parser.add_argument('--batch_size', type=int, default=-1, help='server batch size, default from netconf')
+    parser.add_argument('--max_wait', type=float, default=0.01, help='seconds to wait for filling a batch')
+    parser.add_argument('--gpu_id', type=int, default=0)
+    parser.add_argument('--ngpu', type=int, default=1)
+    args = parser.parse_args()
+
+    conf = copy.deepcopy(imp.load_source('params', args.netconf).configuration)
+    if args.batch_size != -1:
+        conf['batch_size'] = args.batch_size
+    conf['batched_context'] = ''
+    conf.pop('share_context', None)
+    conf.pop('cache_context', None)
+    conf.pop('prefix_depth', None)
+
+    logger = Logger(printout=True)
+    predictor = conf['setup_predictor']({}, conf, args.gpu_id, args.ngpu, logger)
+    server = PredictorServer(predictor, conf['batch_size'], args.address, args.max_wait, logger=logger)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
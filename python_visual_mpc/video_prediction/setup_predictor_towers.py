@@ -12,6 +12,10 @@ from python_visual_mpc.video_prediction.dynamic_rnn_model.dynamic_base_model imp
 from python_visual_mpc.video_prediction.dynamic_rnn_model.alex_model_interface import Alex_Interface_Model
 from python_visual_mpc.visual_mpc_core.infrastructure.utility.logger import Logger
 from python_visual_mpc.video_prediction.utils_vpred.variable_checkpoint_matcher import variable_checkpoint_matcher
+from python_visual_mpc.video_prediction.utils_vpred.rollout_tree import PrefixTree
+from python_visual_mpc.video_prediction.utils_vpred.quantization import quantizable, fake_quantize
+from python_visual_mpc.video_prediction.utils_vpred.output_fetches import FetchCache, unpack_outputs
+from tensorflow.python.util import nest
 import re
 from tensorflow.python.framework.errors_impl import NotFoundError
 
@@ -36,7 +40,7 @@ def get_maxiter_weights(dir):
 
 
 class Tower(object):
-    def __init__(self, conf, gpu_id, start_images, actions, start_states, pix_distrib):
+    def __init__(self, conf, gpu_id, start_images, actions, start_states, pix_distrib, context_encoding=None):
 
         nsmp_per_gpu = conf['batch_size']// conf['ngpu']
         # setting the per gpu batch_size
@@ -44,11 +48,19 @@ class Tower(object):
         # picking different subset of the actions for each gpu
         startidx = gpu_id * nsmp_per_gpu
         actions = tf.slice(actions, [startidx, 0, 0], [nsmp_per_gpu, -1, -1])
-        start_images = tf.tile(start_images, [nsmp_per_gpu, 1, 1, 1, 1, 1])
-        start_states = tf.tile(start_states, [nsmp_per_gpu, 1, 1])
 
-        if pix_distrib is not None:
-            pix_distrib = tf.tile(pix_distrib, [nsmp_per_gpu, 1, 1, 1, 1, 1])
+        if 'batched_context' in conf:   # every sample comes with its own context
+            start_images = tf.slice(start_images, [startidx, 0, 0, 0, 0, 0], [nsmp_per_gpu, -1, -1, -1, -1, -1])
+            start_states = tf.slice(start_states, [startidx, 0, 0], [nsmp_per_gpu, -1, -1])
+
+            if pix_distrib is not None:
+                pix_distrib = tf.slice(pix_distrib, [startidx, 0, 0, 0, 0, 0], [nsmp_per_gpu, -1, -1, -1, -1, -1])
+        elif 'share_context' not in conf:   # with a shared context the model broadcasts the context itself
+            start_images = tf.tile(start_images, [nsmp_per_gpu, 1, 1, 1, 1, 1])
+            start_states = tf.tile(start_states, [nsmp_per_gpu, 1, 1])
+
+            if pix_distrib is not None:
+                pix_distrib = tf.tile(pix_distrib, [nsmp_per_gpu, 1, 1, 1, 1, 1])
 
         print('startindex for gpu {0}: {1}'.format(gpu_id, startidx))
 
@@ -62,7 +74,82 @@ class Tower(object):
 
         modconf = copy.deepcopy(conf)
         modconf['batch_size'] = nsmp_per_gpu
-        self.model = Model(modconf, start_images, actions, start_states, pix_distrib=pix_distrib, build_loss=False)
+        kwargs = {} if context_encoding is None else {'context_encoding': context_encoding}
+        self.model = Model(modconf, start_images, actions, start_states, pix_distrib=pix_distrib, build_loss=False,
+                           **kwargs)
+
+
+class ContextCache(object):
+    def __init__(self, conf, start_images, start_states, pix_distrib, use_dtype):
+        """
+        Runs the action-independent encoder over the shared context once per control step and keeps its outputs in
+        local variables, the towers read them during the context steps instead of encoding the context in every call.
+        Has to be built before the towers, which then reuse its variables.
+        """
+        assert 'share_context' in conf, 'caching the context encoding requires share_context'
+        assert issubclass(conf['pred_model'], Dynamic_Base_Model), 'caching the context requires a Dynamic_Base_Model'
+        encoder_conf = copy.deepcopy(conf)
+        encoder_conf['batch_size'] = 1
+        # the model takes one action more than it predicts steps, the encoder does not depend on the actions
+        actions = tf.zeros([1, conf['context_frames'] + 1, conf['adim']], dtype=use_dtype)
+        with tf.name_scope('context_encoder'):
+            encoder = conf['pred_model'](encoder_conf, start_images, actions, start_states, pix_distrib=pix_distrib,
+                                         build_loss=False, emit_context_encoding=True)
+        self.encoding = [tf.Variable(tf.zeros(e.get_shape(), dtype=e.dtype), trainable=False, name='context_encoding',
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES]) for e in encoder.context_encoding]
+        self.encode_op = tf.group(*[tf.assign(v, e) for v, e in zip(self.encoding, encoder.context_encoding)])
+
+class PrefixTreeGraph(object):
+    def __init__(self, conf, start_images, start_states, pix_distrib, use_dtype, context_encoding=None):
+        """
+        Predicts up to conf['prefix_batch'] distinct action prefixes of conf['prefix_depth'] steps, gathers the
+        recurrent state at the branch point for every sample and predicts the suffixes from there, all in one session
+        run. Requires the shared context and a single gpu.
+        :param context_encoding: optional, the encoding of a ContextCache, only the prefixes run the context steps
+        """
+        assert 'share_context' in conf, 'prefix sharing requires share_context'
+        assert conf['ngpu'] == 1, 'prefix sharing supports a single gpu'
+        assert issubclass(conf['pred_model'], Dynamic_Base_Model), 'prefix sharing requires a Dynamic_Base_Model'
+        self.depth = conf['prefix_depth']
+        self.prefix_batch = conf.get('prefix_batch', conf['batch_size'] // 2)
+        self.nsteps = nsteps = conf['sequence_length'] - 1
+        assert conf['context_frames'] - 1 <= self.depth < nsteps, 'prefix has to end between context and last step'
+        assert self.prefix_batch < conf['batch_size'], 'prefix sharing only pays off with prefix_batch < batch_size'
+
+        # the model drops the last action of a sequence, the extra action of the prefix is never used
+        self.prefix_actions = tf.placeholder(use_dtype, name='prefix_actions',
+                                             shape=(self.prefix_batch, self.depth + 1, conf['adim']))
+        self.suffix_actions = tf.placeholder(use_dtype, name='suffix_actions',
+                                             shape=(conf['batch_size'], nsteps - self.depth, conf['adim']))
+        self.prefix_index = tf.placeholder(tf.int32, name='prefix_index', shape=(conf['batch_size'],))
+
+        prefix_conf = copy.deepcopy(conf)
+        prefix_conf['batch_size'] = self.prefix_batch
+        kwargs = {} if context_encoding is None else {'context_encoding': context_encoding}
+        with tf.name_scope('prefix'):
+            prefix = conf['pred_model'](prefix_conf, start_images, self.prefix_actions, start_states,
+                                        pix_distrib=pix_distrib, build_loss=False, **kwargs)
+        resume_state = nest.map_structure(lambda s: tf.gather(s, self.prefix_index), prefix.final_state)
+        with tf.name_scope('suffix'):
+            suffix = conf['pred_model'](copy.deepcopy(conf), start_images, self.suffix_actions, start_states,
+                                        pix_distrib=pix_distrib, build_loss=False, resume_state=resume_state)
+
+        def join(prefix_out, suffix_out):
+            return to_float32(tf.concat([tf.gather(prefix_out, self.prefix_index), suffix_out], axis=1))
+        self.gen_images = join(prefix.gen_images, suffix.gen_images)
+        self.gen_states = join(prefix.gen_states, suffix.gen_states)
+        self.gen_distrib = None
+        if pix_distrib is not None:
+            self.gen_distrib = join(prefix.gen_distrib, suffix.gen_distrib)
+
+    def feed(self, feed_dict, tree, input_actions):
+        prefixes = np.zeros(self.prefix_actions.get_shape().as_list(), dtype=input_actions.dtype)
+        prefixes[:tree.nprefixes, :self.depth] = tree.prefixes
+        feed_dict[self.prefix_actions] = prefixes
+        feed_dict[self.suffix_actions] = input_actions[:, self.depth:self.nsteps]
+        feed_dict[self.prefix_index] = tree.index
+        return feed_dict
+
 
 def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
     """
@@ -73,6 +160,10 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
     :return: function which predicts a batch of whole trajectories
     conditioned on the actions
     """
+    if 'frozen_graph' in conf:
+        from python_visual_mpc.video_prediction.frozen_predictor import setup_frozen_predictor
+        return setup_frozen_predictor(hyperparams, conf, gpu_id, ngpu, logger)
+
     assert conf['batch_size'] % ngpu == 0, "ngpu should perfectly divide batch_size"
     
     conf['ngpu'] = ngpu
@@ -95,7 +186,11 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.7)
     g_predictor = tf.Graph()
     logger.log('making session')
-    sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True), graph=g_predictor)
+    session_config = tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True)
+    if 'num_threads' in conf:   # e.g. to share the cores of one machine between several predictor replicas
+        session_config.intra_op_parallelism_threads = conf['num_threads']
+        session_config.inter_op_parallelism_threads = conf['num_threads']
+    sess = tf.Session(config=session_config, graph=g_predictor)
     logger.log('done making session.')
     with sess.as_default():
         with g_predictor.as_default():
@@ -106,9 +201,15 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
             else:
                 use_dtype = tf.float32
 
+            if 'batched_context' in conf:
+                assert 'share_context' not in conf, "batched_context and share_context are exclusive"
+                ncontext = conf['batch_size']
+            else:
+                ncontext = 1
+
             orig_size = conf['orig_size']
             images_pl = tf.placeholder(use_dtype, name='images',
-                                       shape=(1, conf['context_frames'], ncam, orig_size[0], orig_size[1], 3))
+                                       shape=(ncontext, conf['context_frames'], ncam, orig_size[0], orig_size[1], 3))
             sdim = conf['sdim']
             adim = conf['adim']
             logger.log('adim', adim)
@@ -117,12 +218,19 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
             actions_pl = tf.placeholder(use_dtype, name='actions',
                                         shape=(conf['batch_size'], conf['sequence_length'], adim))
             states_pl = tf.placeholder(use_dtype, name='states',
-                                       shape=(1, conf['context_frames'], sdim))
+                                       shape=(ncontext, conf['context_frames'], sdim))
 
             if 'use_goal_image' in conf:
                 pix_distrib = None
             else:
-                pix_distrib = tf.placeholder(use_dtype, shape=(1, conf['context_frames'], ncam, orig_size[0], orig_size[1], conf['ndesig']))
+                pix_distrib = tf.placeholder(use_dtype, name='pix_distrib', shape=(ncontext, conf['context_frames'], ncam, orig_size[0], orig_size[1], conf['ndesig']))
+
+            context_cache = None
+            if 'cache_context' in conf:
+                logger.log('building the context encoder')
+                with tf.device('/gpu:0'):
+                    context_cache = ContextCache(conf, images_pl, states_pl, pix_distrib, use_dtype)
+                tf.get_variable_scope().reuse_variables()
 
             # making the towers
             towers = []
@@ -130,10 +238,18 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
                 with tf.device('/gpu:%d' % i_gpu):
                     with tf.name_scope('tower_%d' % (i_gpu)):
                         logger.log(('creating tower %d: in scope %s' % (i_gpu, tf.get_variable_scope())))
-                        towers.append(Tower(conf, i_gpu, images_pl, actions_pl, states_pl, pix_distrib))
+                        towers.append(Tower(conf, i_gpu, images_pl, actions_pl, states_pl, pix_distrib,
+                                            None if context_cache is None else context_cache.encoding))
                         tf.get_variable_scope().reuse_variables()
 
+            tree_graph = None
+            if 'prefix_depth' in conf:
+                logger.log('building prefix tree graph with depth', conf['prefix_depth'])
+                tree_graph = PrefixTreeGraph(conf, images_pl, states_pl, pix_distrib, use_dtype,
+                                             None if context_cache is None else context_cache.encoding)
+
             sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
 
             vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
             vars = filter_vars(vars)
@@ -141,17 +257,17 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
             if 'load_latest' in hyperparams:
                 conf['pretrained_model'] = get_maxiter_weights('/result/modeldata')
                 logger.log('loading {}'.format(conf['pretrained_model']))
-                if conf['pred_model'] == Alex_Interface_Model:
-                    towers[0].model.m.restore(sess, conf['pretrained_model'])
-                else:
-                    vars = variable_checkpoint_matcher(conf, vars, conf['pretrained_model'])
-                    saver = tf.train.Saver(vars, max_to_keep=0)
-                    saver.restore(sess, conf['pretrained_model'])
+            if conf['pred_model'] == Alex_Interface_Model:
+                towers[0].model.m.restore(sess, conf['pretrained_model'])
             else:
-                if conf['pred_model'] == Alex_Interface_Model:
-                    towers[0].model.m.restore(sess, conf['pretrained_model'])
+                if 'fold_views' in conf:
+                    from python_visual_mpc.video_prediction.dynamic_rnn_model.multi_view_model import \
+                        check_folded_checkpoint
+                    check_folded_checkpoint(conf['pretrained_model'])
+                vars = variable_checkpoint_matcher(conf, vars, conf['pretrained_model'])
+                if 'float16' in conf or 'int8_weights' in conf:
+                    restore_cast(sess, vars, conf['pretrained_model'], conf.get('int8_weights'), logger)
                 else:
-                    vars = variable_checkpoint_matcher(conf, vars, conf['pretrained_model'])
                     saver = tf.train.Saver(vars, max_to_keep=0)
                     saver.restore(sess, conf['pretrained_model'])
 
@@ -163,20 +279,43 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
                 logger.log(key, ': ', conf[key])
             logger.log('-------------------------------------------------------------------')
 
-            comb_gen_img = tf.concat([to.model.gen_images for to in towers], axis=0)
+            # reduced-precision graphs still return float32 so that the costs are computed in full precision
+            comb_gen_img = tf.identity(to_float32(tf.concat([to.model.gen_images for to in towers], axis=0)),
+                                       name='gen_images_out')
             if towers[0].model.gen_states is not None:
-                comb_gen_states = tf.concat([to.model.gen_states for to in towers], axis=0)
+                comb_gen_states = tf.identity(to_float32(tf.concat([to.model.gen_states for to in towers], axis=0)),
+                                              name='gen_states_out')
             else: comb_gen_states = None
 
+            comb_pix_distrib = None
             if not 'no_pix_distrib' in conf:
-                comb_pix_distrib = tf.concat([to.model.gen_distrib for to in towers], axis=0)
+                comb_pix_distrib = tf.identity(to_float32(tf.concat([to.model.gen_distrib for to in towers], axis=0)),
+                                               name='gen_distrib_out')
+
+            fetch_cache = FetchCache({'gen_images': comb_gen_img, 'gen_distrib': comb_pix_distrib,
+                                      'gen_states': comb_gen_states})
 
-            def predictor_func(input_images=None, input_one_hot_images=None, input_state=None, input_actions=None):
+            def encode_context(input_images=None, input_one_hot_images=None, input_state=None):
+                """
+                encodes the context and keeps the encoding on the device, calls with reuse_context predict from it
+                """
+                feed_dict = {images_pl: input_images, states_pl: input_state}
+                if input_one_hot_images is not None:
+                    feed_dict[pix_distrib] = input_one_hot_images
+                sess.run(context_cache.encode_op, feed_dict)
+
+            def predictor_func(input_images=None, input_one_hot_images=None, input_state=None, input_actions=None,
+                               fetches=None, reuse_context=False):
                 """
                 :param one_hot_images: the first two frames
                 :param pixcoord: the coords of the disgnated pixel in images coord system
-                :return: the predicted pixcoord at the end of sequence
+                :param fetches: names of the outputs to compute, e.g. ['gen_distrib'], None computes all outputs
+                :param reuse_context: with conf['cache_context'], True skips encoding the context, the last call of
+                predictor_func.encode_context has to have been made with the same context inputs
+                :return: the predicted pixcoord at the end of sequence, None for outputs that are not fetched
                 """
+                if context_cache is not None and not reuse_context:
+                    encode_context(input_images, input_one_hot_images, input_state)
 
                 feed_dict = {}
                 for t in towers:
@@ -186,26 +325,78 @@ def setup_predictor(hyperparams, conf, gpu_id=0, ngpu=1, logger=None):
                 feed_dict[images_pl] = input_images
                 feed_dict[states_pl] = input_state
                 feed_dict[actions_pl] = input_actions
-
-                if input_one_hot_images is None:
-                    gen_images, gen_states = sess.run([comb_gen_img,
-                                                      comb_gen_states],
-                                                      feed_dict)
-                    gen_distrib = None
-                elif comb_gen_states is None:
+                if input_one_hot_images is not None:
                     feed_dict[pix_distrib] = input_one_hot_images
-                    gen_images, gen_distrib = sess.run([comb_gen_img, comb_pix_distrib], feed_dict)
-                    gen_states = None
-                else:
+
+                names, tensors = fetch_cache.get(fetches, input_one_hot_images is not None)
+                return unpack_outputs(names, sess.run(tensors, feed_dict))
+
+            predictor_func.accepts_fetches = True
+            if context_cache is not None:
+                predictor_func.encode_context = encode_context
+            # used by frozen_predictor to export the inference graph
+            predictor_func.graph_io = {'session': sess,
+                                       'inputs': {'input_images': images_pl, 'input_actions': actions_pl,
+                                                  'input_state': states_pl, 'input_one_hot_images': pix_distrib},
+                                       'outputs': {'gen_images': comb_gen_img, 'gen_distrib': comb_pix_distrib,
+                                                   'gen_states': comb_gen_states}}
+            if tree_graph is None:
+                return predictor_func
+
+            tree_fetch_cache = FetchCache({'gen_images': tree_graph.gen_images, 'gen_distrib': tree_graph.gen_distrib,
+                                           'gen_states': tree_graph.gen_states})
+
+            def tree_predictor_func(input_images=None, input_one_hot_images=None, input_state=None, input_actions=None,
+                                    fetches=None, reuse_context=False):
+                """
+                same interface as predictor_func, samples with identical first prefix_depth actions share the
+                prediction of that prefix. Falls back to predictor_func if there are more distinct prefixes than
+                prefix_batch.
+                """
+                tree = PrefixTree(input_actions, tree_graph.depth)
+                logger.log('prefix tree: {} distinct prefixes for {} samples'.format(tree.nprefixes, tree.nsamples))
+                if tree.nprefixes > tree_graph.prefix_batch:
+                    return predictor_func(input_images, input_one_hot_images, input_state, input_actions, fetches,
+                                          reuse_context)
+                if context_cache is not None and not reuse_context:
+                    encode_context(input_images, input_one_hot_images, input_state)
+
+                feed_dict = {images_pl: input_images, states_pl: input_state}
+                tree_graph.feed(feed_dict, tree, input_actions)
+                if input_one_hot_images is not None:
                     feed_dict[pix_distrib] = input_one_hot_images
-                    gen_images, gen_distrib, gen_states = sess.run([comb_gen_img,
-                                                                    comb_pix_distrib,
-                                                                    comb_gen_states],
-                                                                   feed_dict)
+                names, tensors = tree_fetch_cache.get(fetches, input_one_hot_images is not None)
+                return unpack_outputs(names, sess.run(tensors, feed_dict))
+
+            tree_predictor_func.accepts_fetches = True
+            if context_cache is not None:
+                tree_predictor_func.encode_context = encode_context
+            return tree_predictor_func
+
 
-                return gen_images, gen_distrib, gen_states, None
+def to_float32(tensor):
+    if tensor.dtype == tf.float32:
+        return tensor
+    return tf.cast(tensor, tf.float32)
 
-            return predictor_func
+
+def restore_cast(sess, ckpt_vars, model_file, int8_weights=None, logger=None):
+    """
+    restores variables whose dtype differs from the checkpoint, e.g. a float16 graph from a float32 checkpoint
+    :param ckpt_vars: dict from checkpoint names to variables as returned by variable_checkpoint_matcher
+    :param int8_weights: if not None the kernels are rounded to per-channel int8 with this clipping percentile, see
+    quantization.quantize_int8
+    """
+    reader = tf.train.NewCheckpointReader(model_file)
+    nquantized = 0
+    for ck_name, var in ckpt_vars.items():
+        value = reader.get_tensor(ck_name)
+        if int8_weights is not None and quantizable(value):
+            value = fake_quantize(value, int8_weights)
+            nquantized += 1
+        var.load(value.astype(var.dtype.base_dtype.as_numpy_dtype), sess)
+    if logger is not None:
+        logger.log('restored {} variables with casting, {} quantized to int8'.format(len(ckpt_vars), nquantized))
 
 def filter_vars(vars):
     newlist = []
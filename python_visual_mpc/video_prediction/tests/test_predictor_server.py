@@ -0,0 +1,117 @@
+""" PredictorServer with a numpy stand-in predictor: batches are coalesced across clients and rows go back to their sender """
+import os
+import time
+from threading import Thread, Barrier
+import numpy as np
+
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.logger import Logger
+from python_visual_mpc.video_prediction.predictor_server import PredictorServer, PredictorClient
+
+BATCH_SIZE, CONTEXT, T, ADIM, HEIGHT, WIDTH = 200, 2, 13, 4, 8, 8
+
+
+def make_predictor(batch_sizes):
+    """
+    every output row depends on the context and the actions of that row only
+    :param batch_sizes: receives the number of rows of every call
+    """
+    def predictor(input_images=None, input_one_hot_images=None, input_state=None, input_actions=None, fetches=None):
+        batch_sizes.append(input_actions.shape[0])
+        fetches = ('gen_images', 'gen_distrib', 'gen_states') if fetches is None else fetches
+        motion = np.cumsum(input_actions, axis=1)[:, :, 0, None, None, None, None]
+        gen_images = input_images[:, -1:] + motion if 'gen_images' in fetches else None
+        gen_distrib = input_one_hot_images[:, -1:] * np.exp(-motion ** 2) if 'gen_distrib' in fetches else None
+        gen_states = input_state[:, -1:] + np.cumsum(input_actions, axis=1) if 'gen_states' in fetches else None
+        return gen_images, gen_distrib, gen_states, None
+    predictor.accepts_fetches = True
+    return predictor
+
+
+def make_request(seed, nrows):
+    rng = np.random.RandomState(seed)
+    return {'input_images': rng.uniform(size=(1, CONTEXT, 1, HEIGHT, WIDTH, 3)).astype(np.float32),
+            'input_one_hot_images': rng.uniform(size=(1, CONTEXT, 1, HEIGHT, WIDTH, 1)).astype(np.float32),
+            'input_state': rng.normal(size=(1, CONTEXT, ADIM)).astype(np.float32),
+            'input_actions': rng.normal(size=(nrows, T, ADIM)).astype(np.float32)}
+
+
+def run_clients(address, requests):
+    """
+    sends every request from its own client, all clients start at the same time
+    :param requests: list of (inputs, fetches)
+    :return: outputs of every request
+    """
+    results = [None] * len(requests)
+    barrier = Barrier(len(requests))
+
+    def client(i):
+        predictor = PredictorClient(address)
+        barrier.wait()
+        inputs, fetches = requests[i]
+        results[i] = predictor(fetches=fetches, **inputs)
+        predictor.close()
+
+    threads = [Thread(target=client, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def start_server(address, batch_sizes):
+    server = PredictorServer(make_predictor(batch_sizes), BATCH_SIZE, address, max_wait=0.5,
+                             logger=Logger(mute=True))
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    while not os.path.exists(address):
+        time.sleep(0.01)
+    return server, thread
+
+
+def check_outputs(requests, results):
+    reference = make_predictor([])
+    for (inputs, fetches), outputs in zip(requests, results):
+        expected = reference(fetches=fetches, **inputs)
+        for out, exp in zip(outputs, expected):
+            assert (out is None) == (exp is None)
+            if exp is not None:
+                np.testing.assert_allclose(out, exp, rtol=1e-6)
+
+
+def test_coalesced_batches(tmpdir):
+    """ 6 clients with 280 rows each fill 9 batches of 200 instead of 12 """
+    address = str(tmpdir.join('predictor'))
+    batch_sizes = []
+    server, thread = start_server(address, batch_sizes)
+    requests = [(make_request(i, 280), ['gen_distrib']) for i in range(6)]
+    try:
+        results = run_clients(address, requests)
+    finally:
+        server.shutdown()
+        thread.join()
+
+    check_outputs(requests, results)
+    assert server.n_rows == 1680
+    assert server.n_batches == 9
+    assert set(batch_sizes) == {BATCH_SIZE}
+
+
+def test_routing_with_different_fetches(tmpdir):
+    """ requests of different sizes and fetched outputs, only requests with the same fetches share a batch """
+    address = str(tmpdir.join('predictor'))
+    server, thread = start_server(address, [])
+    nrows = [100, 150, 250, 330, 400, 450]
+    fetches = [['gen_distrib'], None, ['gen_distrib'], ['gen_images', 'gen_states'], None, ['gen_distrib']]
+    requests = [(make_request(i, n), f) for i, (n, f) in enumerate(zip(nrows, fetches))]
+    try:
+        results = run_clients(address, requests)
+    finally:
+        server.shutdown()
+        thread.join()
+
+    check_outputs(requests, results)
+    assert server.n_rows == 1680
+    for (inputs, _), outputs in zip(requests, results):
+        assert all(o is None or o.shape[0] == inputs['input_actions'].shape[0] for o in outputs)
@@ -0,0 +1,90 @@
+"""
+times one forward pass of Multi_View_Model with one network per camera against one network over the folded cameras
+
+The timings do not depend on the weights, both graphs run with their initial variables and no checkpoint:
+
+    python fold_views_timings.py --hyper <multi-view netconf.py> --batch_sizes 200,400 --output fold_views_timings.json
+"""
+import sys
+import imp
+import os
+import copy
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import flags
+
+from python_visual_mpc.video_prediction.dynamic_rnn_model.multi_view_model import Multi_View_Model
+
+
+MODES = [('per_camera', False), ('folded', True)]
+
+
+def time_forward(conf, nruns):
+    """
+    :return: seconds of every forward pass of conf['batch_size'] samples, the first pass is graph warmup and not
+    returned
+    """
+    ncam, ctxt = conf['ncam'], conf['context_frames']
+    height, width = conf['orig_size']
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, [conf['batch_size'], ctxt, ncam, height, width, 3])
+        pix_distrib = tf.placeholder(tf.float32, [conf['batch_size'], ctxt, ncam, height, width, conf['ndesig']])
+        states = tf.placeholder(tf.float32, [conf['batch_size'], ctxt, conf['sdim']])
+        actions = tf.placeholder(tf.float32, [conf['batch_size'], conf['sequence_length'], conf['adim']])
+        model = Multi_View_Model(conf, images, actions, states, pix_distrib=pix_distrib, build_loss=False)
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True))
+        sess.run(tf.global_variables_initializer())
+
+    rng = np.random.RandomState(0)
+    feed_dict = {images: rng.uniform(size=images.get_shape().as_list()),
+                 pix_distrib: np.zeros(pix_distrib.get_shape().as_list()),
+                 states: np.zeros(states.get_shape().as_list()),
+                 actions: rng.normal(size=actions.get_shape().as_list()),
+                 model.iter_num: 0}
+    times = []
+    for _ in range(nruns + 1):
+        t_start = time.time()
+        sess.run([model.gen_images, model.gen_distrib], feed_dict)
+        times.append(time.time() - t_start)
+    sess.close()
+    return np.array(times[1:])
+
+
+def mode_conf(base_conf, folded, batch_size):
+    conf = copy.deepcopy(base_conf)
+    conf['batch_size'] = batch_size
+    for key in ('share_context', 'cache_context', 'fold_views'):
+        conf.pop(key, None)
+    if folded:
+        conf['fold_views'] = ''
+    return conf
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    flags.DEFINE_string('hyper', '', 'multi-view video prediction configuration file')
+    flags.DEFINE_list('batch_sizes', ['200'], 'batch sizes to time')
+    flags.DEFINE_integer('nruns', 20, 'number of forward passes to average over')
+    flags.DEFINE_string('output', '', 'json file for all results')
+    FLAGS(sys.argv)
+
+    if not os.path.exists(FLAGS.hyper):
+        sys.exit("Experiment configuration not found")
+    base_conf = imp.load_source('hyperparams', FLAGS.hyper).configuration
+    assert base_conf.get('ncam', 1) > 1, 'fold_views_timings needs a multi-view configuration'
+
+    results = []
+    for bsize in [int(b) for b in FLAGS.batch_sizes]:
+        for name, folded in MODES:
+            times = time_forward(mode_conf(base_conf, folded, bsize), FLAGS.nruns)
+            results.append({'mode': name, 'batch_size': bsize, 'mean': float(np.mean(times)),
+                            'p90': float(np.percentile(times, 90))})
+        per_camera, folded = results[-2:]
+        print('batch size {}, {} cameras: {:.4f}s per camera networks, {:.4f}s folded ({:.2f}x)'.format(
+            bsize, base_conf['ncam'], per_camera['mean'], folded['mean'], per_camera['mean'] / folded['mean']))
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as f:
+            json.dump({'ncam': base_conf['ncam'], 'nruns': FLAGS.nruns, 'results': results}, f, indent=1)
@@ -0,0 +1,50 @@
+""" Fetch lists per combination of requested outputs, so a predictor only runs and copies what the cost reads. """
+
+OUTPUT_KEYS = ('gen_images', 'gen_distrib', 'gen_states')
+
+
+class FetchCache(object):
+    """
+    builds the list of output tensors of every requested combination once
+
+        names, tensors = fetch_cache.get(['gen_distrib'])
+        outputs = unpack_outputs(names, sess.run(tensors, feed_dict))
+    """
+    def __init__(self, outputs):
+        """
+        :param outputs: dict from names in OUTPUT_KEYS to tensors, None for outputs the model does not have
+        """
+        self._outputs = dict((k, v) for k, v in outputs.items() if v is not None)
+        self._lists = {}
+
+    def get(self, fetches=None, with_distrib=True):
+        """
+        :param fetches: names of the requested outputs, None requests all outputs
+        :param with_distrib: False if no designated-pixel distribution is fed, gen_distrib is never fetched then
+        :return: names and tensors of the requested outputs the model has, in the order of OUTPUT_KEYS
+        """
+        key = (None if fetches is None else frozenset(fetches), with_distrib)
+        if key not in self._lists:
+            requested = frozenset(OUTPUT_KEYS) if fetches is None else key[0]
+            assert requested <= frozenset(OUTPUT_KEYS), 'unknown outputs {}'.format(requested - frozenset(OUTPUT_KEYS))
+            names = [k for k in OUTPUT_KEYS if k in requested and k in self._outputs
+                     and (with_distrib or k != 'gen_distrib')]
+            self._lists[key] = names, [self._outputs[k] for k in names]
+        return self._lists[key]
+
+
+def unpack_outputs(names, values):
+    """
+    :return: gen_images, gen_distrib, gen_states and None like predictor_func, None for every output not fetched
+    """
+    results = dict(zip(names, values))
+    return results.get('gen_images'), results.get('gen_distrib'), results.get('gen_states'), None
+
+
+def call_predictor(predictor, fetches, **inputs):
+    """
+    passes fetches on to predictors that accept them, other predictors compute all of their outputs
+    """
+    if getattr(predictor, 'accepts_fetches', False):
+        return predictor(fetches=fetches, **inputs)
+    return predictor(**inputs)
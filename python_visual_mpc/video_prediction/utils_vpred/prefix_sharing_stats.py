@@ -0,0 +1,51 @@
+""" fraction of recurrent predictor steps a prefix tree saves on the action samples drawn with an experiment's policy """
+import argparse
+import imp
+import numpy as np
+from python_visual_mpc.visual_mpc_core.algorithm.cem_controller_base import CEM_Controller_Base
+from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_controller_utils import construct_initial_sigma
+from python_visual_mpc.video_prediction.utils_vpred.rollout_tree import prefix_savings
+
+
+class SamplingOnlyController(CEM_Controller_Base):
+    """ draws the samples of the first CEM iteration the way the configured controller does, never predicts """
+    def get_rollouts(self, actions, cem_itr, itr_times):
+        raise NotImplementedError
+
+    def first_iteration_samples(self, t):
+        self.t = t
+        self.state = np.zeros((t + 1, self.sdim))
+        self.sigma = construct_initial_sigma(self._hp, self.adim, t)
+        self.mean = np.zeros(self.adim * self.naction_steps)
+        if self._hp.rejection_sampling:
+            actions = self.sample_actions_rej(0)
+        else:
+            actions = self.sample_actions(self.mean, self.cov, self._hp, self.M)
+        return self._apply_autograsp(actions)
+
+
+def base_policyparams(policy):
+    """ keeps the entries of an experiment's policy dict that CEM_Controller_Base understands """
+    defaults = SamplingOnlyController.__new__(SamplingOnlyController)._default_hparams()
+    return dict((k, v) for k, v in policy.items() if k in defaults and k != 'type' and v != getattr(defaults, k))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prefix sharing statistics')
+    parser.add_argument('hyperparams', type=str, nargs='+', help='experiment files defining policy')
+    parser.add_argument('--adim', type=int, required=True)
+    parser.add_argument('--sdim', type=int, required=True)
+    parser.add_argument('--t', type=int, default=1, help='time step of the planning call')
+    parser.add_argument('--context_frames', type=int, default=2)
+    args = parser.parse_args()
+
+    for path in args.hyperparams:
+        policy = imp.load_source('hyperparams', path).policy
+        ctrl = SamplingOnlyController({'adim': args.adim, 'sdim': args.sdim}, base_policyparams(policy))
+        actions = ctrl.first_iteration_samples(args.t)
+        nsteps = actions.shape[1] - 1    # the predictor consumes all but the last action
+        depths = range(max(args.context_frames - 1, 1), nsteps)
+        print(path)
+        for depth, (nprefixes, saved) in sorted(prefix_savings(actions, nsteps, depths).items()):
+            print('  depth {}: {} distinct prefixes for {} samples, {:.1%} of the recurrent steps saved'.format(
+                depth, nprefixes, actions.shape[0], saved))
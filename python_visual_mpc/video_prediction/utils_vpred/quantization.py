@@ -0,0 +1,50 @@
+""" Post-training weight quantization and accuracy measures for reduced-precision video prediction. """
+import numpy as np
+
+
+def quantizable(value):
+    """
+    only kernels (rank >= 2) are quantized, biases, normalization parameters and scalars keep their precision
+    """
+    return value.ndim >= 2 and np.issubdtype(value.dtype, np.floating)
+
+
+def quantize_int8(value, clip_percentile=100.):
+    """
+    symmetric per-output-channel int8 quantization, the output channels are the last axis as in tf kernels
+    :param clip_percentile: percentile of the absolute weights of each channel mapped to 127, lower values clip outliers
+    for a finer resolution of the remaining weights
+    :return: int8 values and float32 scale per output channel
+    """
+    reduce_axes = tuple(range(value.ndim - 1))
+    scale = np.percentile(np.abs(value), clip_percentile, axis=reduce_axes) / 127.
+    scale = np.where(scale > 0, scale, 1.).astype(np.float32)
+    q = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+    return q, scale
+
+
+def dequantize_int8(q, scale):
+    return q.astype(np.float32) * scale
+
+
+def fake_quantize(value, clip_percentile=100.):
+    """
+    :return: value rounded to the int8 grid of quantize_int8, in the dtype of value
+    """
+    return dequantize_int8(*quantize_int8(value, clip_percentile)).astype(value.dtype)
+
+
+def distrib_divergence(ref_distrib, distrib, eps=1e-8):
+    """
+    compares predicted designated-pixel distributions after normalizing every image to sum to one
+    :param ref_distrib, distrib: shape [batch, t, ncam, r, c, ndesig]
+    :return: total variation distance and KL(ref || distrib) per predicted step, averaged over batch, cameras and
+    designated pixels, each of shape [t]
+    """
+    def normalize(d):
+        d = np.maximum(d.astype(np.float64), 0) + eps
+        return d / np.sum(d, axis=(3, 4), keepdims=True)
+    p, q = normalize(ref_distrib), normalize(distrib)
+    tv = 0.5 * np.sum(np.abs(p - q), axis=(3, 4))
+    kl = np.sum(p * np.log(p / q), axis=(3, 4))
+    return np.mean(tv, axis=(0, 2, 3)), np.mean(kl, axis=(0, 2, 3))
@@ -0,0 +1,44 @@
+""" Groups planning samples by identical action prefixes so that every prefix is predicted only once. """
+import numpy as np
+
+
+class PrefixTree(object):
+    """
+    two-level rollout tree: the first depth steps of all samples with the same actions are predicted once, the
+    recurrent state at the branch point is then gathered for every sample and only the suffixes are predicted per sample
+    """
+    def __init__(self, actions, depth):
+        """
+        :param actions: shape [M, T, adim]
+        :param depth: number of actions in the shared prefix
+        """
+        nsamples = actions.shape[0]
+        flat = np.ascontiguousarray(actions[:, :depth]).reshape(nsamples, -1)
+        _, first, index = np.unique(flat, axis=0, return_index=True, return_inverse=True)
+        self.prefixes = actions[first, :depth]
+        self.index = index.reshape(-1)      # prefix of every sample
+        self.depth = depth
+        self.nsamples = nsamples
+
+    @property
+    def nprefixes(self):
+        return self.prefixes.shape[0]
+
+    def cell_steps(self, nsteps):
+        """
+        :param nsteps: number of recurrent steps of a full rollout
+        :return: recurrent steps summed over the batch without and with sharing the prefixes
+        """
+        return self.nsamples * nsteps, self.nprefixes * self.depth + self.nsamples * (nsteps - self.depth)
+
+
+def prefix_savings(actions, nsteps, depths):
+    """
+    :return: dict mapping each depth to the number of unique prefixes and the fraction of recurrent steps saved
+    """
+    savings = {}
+    for depth in depths:
+        tree = PrefixTree(actions, depth)
+        flat, shared = tree.cell_steps(nsteps)
+        savings[depth] = (tree.nprefixes, 1. - shared / float(flat))
+    return savings
@@ -0,0 +1,160 @@
+"""
+times the predictor calls of one CEM step with the context tiled to the batch, shared by all samples and cached, and
+reports the peak memory of each mode
+
+Every mode and batch size runs in its own process, the peak of TF's device allocator covers the whole process:
+
+    python shared_context_timings.py --hyper <netconf.py> --context_frames 2 --output shared_context_timings.json
+
+--ncalls should be the predictor calls of one control step, CEM iterations times M / batch_size.
+
+The per-CEM-step savings of sharing and caching the context are printed per batch size and written to the output
+under step_savings.
+"""
+import sys
+import imp
+import os
+import copy
+import json
+import time
+import resource
+import subprocess
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import flags
+
+from python_visual_mpc.video_prediction.setup_predictor_towers import setup_predictor
+
+
+MODES = [('tiled', []), ('shared', ['share_context']), ('cached', ['share_context', 'cache_context'])]
+BATCH_SIZES = [200, 400, 600, 1000]
+
+
+def time_cem_step(predictor, conf, ncalls, nsteps):
+    """
+    :param ncalls: predictor calls per CEM step, i.e. iterations times runs
+    :return: seconds of every CEM step and of every predictor call, a cached context is encoded once per step and
+    counted only in the step time. The first step is graph warmup and not returned.
+    """
+    ncam = conf.get('ncam', 1)
+    height, width = conf['orig_size']
+    images = np.random.uniform(size=(1, conf['context_frames'], ncam, height, width, 3))
+    states = np.zeros((1, conf['context_frames'], conf['sdim']))
+    actions = np.random.normal(size=(conf['batch_size'], conf['sequence_length'], conf['adim']))
+    pix_distrib = np.zeros((1, conf['context_frames'], ncam, height, width, conf.get('ndesig', 1)))
+    pix_distrib[:, :, :, height // 2, width // 2] = 1.
+    cached = hasattr(predictor, 'encode_context')
+
+    step_times, call_times = [], []
+    for _ in range(nsteps + 1):
+        t_start = time.time()
+        if cached:
+            predictor.encode_context(images, pix_distrib, states)
+        for _ in range(ncalls):
+            t_call = time.time()
+            if cached:
+                predictor(images, pix_distrib, states, actions, reuse_context=True)
+            else:
+                predictor(images, pix_distrib, states, actions)
+            call_times.append(time.time() - t_call)
+        step_times.append(time.time() - t_start)
+    return np.array(step_times[1:]), np.array(call_times[ncalls:])
+
+
+def peak_device_bytes(predictor):
+    """
+    :return: peak bytes of TF's allocator on the predictor's first device since the process started, None if the
+    device does not track it
+    """
+    sess = predictor.graph_io['session']
+    with sess.graph.as_default():
+        max_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+    try:
+        return int(sess.run(max_bytes))
+    except tf.errors.OpError:
+        return None
+
+
+def measure(conf, ncalls, nsteps):
+    """
+    :return: dict with the step and call latencies in seconds and the peak device and host memory in bytes
+    """
+    predictor = setup_predictor({}, conf)
+    step_times, call_times = time_cem_step(predictor, conf, ncalls, nsteps)
+    return {'step_mean': float(np.mean(step_times)), 'step_p90': float(np.percentile(step_times, 90)),
+            'call_mean': float(np.mean(call_times)), 'call_p90': float(np.percentile(call_times, 90)),
+            'peak_device_bytes': peak_device_bytes(predictor),
+            'peak_host_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def mode_conf(base_conf, mode, batch_size):
+    conf = copy.deepcopy(base_conf)
+    conf['batch_size'] = batch_size
+    for key in MODES[-1][1]:
+        conf.pop(key, None)
+    for key in dict(MODES)[mode]:
+        conf[key] = ''
+    return conf
+
+
+def step_savings(results):
+    """
+    :param results: results of all modes for one batch size
+    :return: seconds per CEM step saved by sharing the context instead of tiling it and by caching it instead of
+    encoding it in every call
+    """
+    step = dict((r['mode'], r['step_mean']) for r in results)
+    return {'shared_vs_tiled': step['tiled'] - step['shared'], 'cached_vs_shared': step['shared'] - step['cached'],
+            'cached_vs_tiled': step['tiled'] - step['cached']}
+
+
+def megabytes(nbytes):
+    return 'n/a' if nbytes is None else '{:.0f}MB'.format(nbytes / 2. ** 20)
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    flags.DEFINE_string('hyper', '', 'video prediction configuration file')
+    flags.DEFINE_integer('ncalls', 3, 'predictor calls per CEM step, iterations times runs')
+    flags.DEFINE_integer('nsteps', 10, 'number of CEM steps to average over')
+    flags.DEFINE_integer('context_frames', 2, 'number of context frames')
+    flags.DEFINE_string('mode', '', 'measure only this mode and batch size in this process and print it as json')
+    flags.DEFINE_integer('batch_size', 200, 'batch size measured with --mode')
+    flags.DEFINE_string('output', '', 'json file for all results')
+    FLAGS(sys.argv)
+
+    if not os.path.exists(FLAGS.hyper):
+        sys.exit("Experiment configuration not found")
+    base_conf = imp.load_source('hyperparams', FLAGS.hyper).configuration
+    base_conf['context_frames'] = FLAGS.context_frames
+
+    if FLAGS.mode:
+        result = measure(mode_conf(base_conf, FLAGS.mode, FLAGS.batch_size), FLAGS.ncalls, FLAGS.nsteps)
+        print('RESULT ' + json.dumps(result))
+        sys.exit()
+
+    results, savings = [], {}
+    for bsize in BATCH_SIZES:
+        for name, _ in MODES:
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--hyper', FLAGS.hyper,
+                                           '--ncalls', str(FLAGS.ncalls), '--nsteps', str(FLAGS.nsteps),
+                                           '--context_frames', str(FLAGS.context_frames), '--mode', name,
+                                           '--batch_size', str(bsize)])
+            line = [l for l in out.decode().splitlines() if l.startswith('RESULT ')][-1]
+            result = dict(json.loads(line[len('RESULT '):]), mode=name, batch_size=bsize)
+            results.append(result)
+            if name == 'tiled':
+                tiled = result
+            print('batch size {}, {} context: {:.4f}s per CEM step ({:.2f}x), {:.4f}s per call (p90 {:.4f}s), '
+                  'peak device {}, peak host {}'.format(bsize, name, result['step_mean'],
+                                                        tiled['step_mean'] / result['step_mean'], result['call_mean'],
+                                                        result['call_p90'], megabytes(result['peak_device_bytes']),
+                                                        megabytes(result['peak_host_bytes'])))
+        savings[bsize] = step_savings(results[-len(MODES):])
+        print('batch size {}, saved per CEM step: {:.1f}ms shared vs tiled, {:.1f}ms cached vs shared, '
+              '{:.1f}ms cached vs tiled'.format(bsize, *[1e3 * savings[bsize][k] for k in
+                                                         ('shared_vs_tiled', 'cached_vs_shared', 'cached_vs_tiled')]))
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as f:
+            json.dump({'ncalls': FLAGS.ncalls, 'nsteps': FLAGS.nsteps, 'context_frames': FLAGS.context_frames,
+                       'results': results, 'step_savings': savings}, f, indent=1)
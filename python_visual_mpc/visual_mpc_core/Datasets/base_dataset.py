@@ -34,10 +34,25 @@ class BaseVideoDataset:
                         'buffer_size': 512,
                         'compressed': True,
                         'sequence_length':None,  # read from manifest if None
+                        'num_parallel_reads': 4,    # number of record files read interleaved
+                        'num_parallel_calls': 4,    # number of batches parsed and decoded in parallel
+                        'batch_parse': True,        # parse and decode whole batches instead of single records
+                        'prefetch': 2,              # number of batches prepared ahead, 0 disables prefetching
                         }
         return HParams(**default_dict)
 
     def _parse_record(self, serialized_example):
+        return self._parse_examples(serialized_example, batched=False)
+
+    def _parse_batch(self, serialized_examples):
+        return self._parse_examples(serialized_examples, batched=True)
+
+    def _parse_examples(self, serialized, batched):
+        """
+        :param batched: if True serialized is a vector of records and all outputs get a leading batch dimension
+        """
+        lead_shape = [-1] if batched else []
+
         def get_feature(manifest_entry):
             shape, dtype = manifest_entry
             if dtype == 'Byte':
@@ -53,13 +68,11 @@ class BaseVideoDataset:
             shape = [s for s in orig_shape]
             if pad_t:
                 shape = [1] + shape
+            shape = lead_shape + shape
 
             if dtype == 'Byte':
-                uint_data = tf.decode_raw(feat, tf.uint8)
-                img_flat = tf.reshape(uint_data, shape=[1, mult_elems(shape)])
-                image = tf.reshape(img_flat, shape=orig_shape)
-                image = tf.reshape(image, shape=shape)
-                return image
+                uint_data = tf.decode_raw(feat, tf.uint8)   # decodes all records of a batch in one op
+                return tf.reshape(uint_data, shape=shape)
             elif dtype == 'Float' or dtype == 'Int':
                 return tf.reshape(feat, shape=shape)
             raise ValueError('Unknown dtype: {}'.format(dtype))
@@ -73,7 +86,10 @@ class BaseVideoDataset:
                 for t in range(self._T):
                     features_names['{}/{}'.format(t, k)] = get_feature(self._sequence_keys[k])
 
-        feature = tf.parse_single_example(serialized_example, features=features_names)
+        if batched:
+            feature = tf.parse_example(serialized, features=features_names)
+        else:
+            feature = tf.parse_single_example(serialized, features=features_names)
 
         return_dict = {}
         if self._T > 0:
@@ -82,30 +98,58 @@ class BaseVideoDataset:
                 for t in range(self._T):
                     k_feat = decode_feat(feature['{}/{}'.format(t, k)], self._sequence_keys[k], True)
                     k_feats.append(k_feat)
-                return_dict[k] = tf.concat(k_feats, 0)
+                return_dict[k] = tf.concat(k_feats, len(lead_shape))
         for k in self._metadata_keys:
             return_dict[k] = decode_feat(feature[k], self._metadata_keys[k])
 
         return return_dict
 
+    def _get_filenames(self, mode):
+        fnames = []
+        for d in self._record_dirs:
+            fnames += glob.glob('{}/{}/*.tfrecords'.format(d, mode))
+        return fnames
+
+    def _make_dataset(self, fnames):
+        """
+        :return: dataset of batches, files are read interleaved, records are shuffled while still serialized and
+        parsed and decoded batch-wise in parallel
+        """
+        compression_type = 'GZIP' if self._hparams.compressed else ''
+
+        def read_file(fname):
+            return tf.data.TFRecordDataset(fname, compression_type=compression_type, buffer_size=self._hparams.buffer_size)
+
+        dataset = tf.data.Dataset.from_tensor_slices(fnames)
+        if self._hparams.shuffle:
+            dataset = dataset.shuffle(len(fnames))
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(read_file,
+                                                                    cycle_length=self._hparams.num_parallel_reads,
+                                                                    sloppy=self._hparams.shuffle))
+        dataset = dataset.repeat(self._hparams.num_epochs)
+        if self._hparams.shuffle:
+            dataset = dataset.shuffle(buffer_size=self._hparams.buffer_size)
+
+        if self._hparams.batch_parse:
+            dataset = dataset.batch(self._batch_size)
+            dataset = dataset.map(self._parse_batch, num_parallel_calls=self._hparams.num_parallel_calls)
+        else:
+            dataset = dataset.map(self._parse_record, num_parallel_calls=self._hparams.num_parallel_calls)
+            dataset = dataset.batch(self._batch_size)
+
+        if self._hparams.prefetch > 0:
+            dataset = dataset.prefetch(self._hparams.prefetch)
+        return dataset
+
     def _initialize_batches(self):
         self._raw_data = {}
         for m in self.MODES:
-            fnames = glob.glob('{}/{}/*.tfrecords'.format(self._base_dir, m))
+            fnames = self._get_filenames(m)
             if len(fnames) == 0:
                 print('Warning dataset does not have files for mode: {}'.format(m))
                 continue
 
-            if self._hparams.compressed:
-                dataset = tf.data.TFRecordDataset(fnames, buffer_size=self._hparams.buffer_size, compression_type='GZIP')
-            else:
-                dataset = tf.data.TFRecordDataset(fnames, buffer_size=self._hparams.buffer_size)
-
-            dataset = dataset.map(self._parse_record)
-            dataset = dataset.repeat(self._hparams.num_epochs)
-            if self._hparams.shuffle:
-                dataset = dataset.shuffle(buffer_size=self._hparams.buffer_size)
-            dataset = dataset.batch(self._batch_size)
+            dataset = self._make_dataset(fnames)
             iterator = dataset.make_one_shot_iterator()
             next_element = iterator.get_next()
 
@@ -158,29 +202,21 @@ class BaseVideoDataset:
         return self.get(item)
 
     def get_iterator(self, item, mode):
-        fnames = glob.glob('{}/{}/*.tfrecords'.format(self._base_dir, mode))
-        if self._hparams.compressed:
-            dataset = tf.data.TFRecordDataset(fnames, buffer_size=self._hparams.buffer_size,
-                                              compression_type='GZIP')
-        else:
-            dataset = tf.data.TFRecordDataset(fnames, buffer_size=self._hparams.buffer_size)
-
-        def parse_record(ex):
-            return self._parse_record(ex)[item]
-
-
-        dataset = dataset.map(parse_record)
-        dataset = dataset.repeat(self._hparams.num_epochs)
-        if self._hparams.shuffle:
-            dataset = dataset.shuffle(buffer_size=self._hparams.buffer_size)
-        dataset = dataset.batch(self._batch_size)
+        dataset = self._make_dataset(self._get_filenames(mode))
+        dataset = dataset.map(lambda batch: batch[item])
         iterator = dataset.make_one_shot_iterator()
         return iterator
 
     def _read_manifest(self):
         pkl_path = '{}/manifest.pkl'.format(self._base_dir)
-        if not os.path.exists(pkl_path):
-            raise FileNotFoundError('Manifest not found at {}/manifest.pkl'.format(self._base_dir))
+        if os.path.exists(pkl_path):
+            self._record_dirs = [self._base_dir]
+        else:
+            # datasets written by several record workers keep one manifest per shard
+            self._record_dirs = sorted([os.path.dirname(p) for p in glob.glob('{}/shard*/manifest.pkl'.format(self._base_dir))])
+            if len(self._record_dirs) == 0:
+                raise FileNotFoundError('Manifest not found at {}/manifest.pkl'.format(self._base_dir))
+            pkl_path = '{}/manifest.pkl'.format(self._record_dirs[0])
 
         manifest_dict = pkl.load(open(pkl_path, 'rb'))
         self._sequence_keys = manifest_dict['sequence_data']
@@ -0,0 +1,200 @@
+import pickle as pkl
+import os
+import glob
+import argparse
+import numpy as np
+from python_visual_mpc.visual_mpc_core.Datasets.save_util.record_saver import column_filename, save_columnar_chunk, \
+    COLUMN_DTYPES
+
+
+class ColumnarDataset:
+    """
+    Reads datasets saved by RecordSaver with save_format='columnar'. Every key of a chunk is a memory-mapped .npy file,
+    batches of (trajectory, time-window) slices are copied straight out of them without any parsing or decompression.
+    """
+    MODES = ['train', 'test', 'val']
+
+    def __init__(self, directory, batch_size, hparams_dict=dict()):
+        if not os.path.exists(directory):
+            raise IOError('Base directory {} does not exist'.format(directory))
+
+        self._base_dir = directory
+        self._batch_size = batch_size
+        self._hparams = self._get_default_hparams()
+        for k in hparams_dict:
+            assert k in self._hparams, 'unknown hparam {}'.format(k)
+            self._hparams[k] = hparams_dict[k]
+        self._rng = np.random.RandomState(self._hparams['seed'])
+
+        self._read_manifest()
+        self._open_columns()
+
+    def _get_default_hparams(self):
+        return {'shuffle': True,
+                'sequence_length': None,  # length of the time-windows, all T steps if None
+                'seed': None,
+                }
+
+    def _read_manifest(self):
+        pkl_path = '{}/manifest.pkl'.format(self._base_dir)
+        if os.path.exists(pkl_path):
+            self._record_dirs = [self._base_dir]
+        else:
+            self._record_dirs = sorted([os.path.dirname(p) for p in glob.glob('{}/shard*/manifest.pkl'.format(self._base_dir))])
+            if len(self._record_dirs) == 0:
+                raise IOError('Manifest not found at {}/manifest.pkl'.format(self._base_dir))
+            pkl_path = '{}/manifest.pkl'.format(self._record_dirs[0])
+
+        with open(pkl_path, 'rb') as f:
+            manifest_dict = pkl.load(f)
+        if manifest_dict.get('format', 'tfrecord') != 'columnar':
+            raise ValueError('{} is not a columnar dataset, convert it with convert_tfrecords'.format(self._base_dir))
+        self._sequence_keys = manifest_dict['sequence_data'] or {}
+        self._metadata_keys = manifest_dict['traj_metadata'] or {}
+        self._T = manifest_dict['T']
+        if self._hparams['sequence_length'] is None:
+            self._window = self._T
+        else:
+            self._window = self._hparams['sequence_length']
+        assert self._window <= self._T
+
+    def _open_columns(self):
+        self._columns, self._chunk_offsets, self._order, self._next = {}, {}, {}, {}
+        for m in self.MODES:
+            columns, ntraj = dict([(k, []) for k in list(self._sequence_keys) + list(self._metadata_keys)]), [0]
+            for d in self._record_dirs:
+                index_path = '{}/{}/index.pkl'.format(d, m)
+                if not os.path.exists(index_path):
+                    continue
+                with open(index_path, 'rb') as f:
+                    index = pkl.load(f)
+                for chunk, n in index['chunks']:
+                    for k in columns:
+                        columns[k].append(np.load(os.path.join(d, m, chunk, column_filename(k)), mmap_mode='r'))
+                    ntraj.append(ntraj[-1] + n)
+            if ntraj[-1] == 0:
+                print('Warning dataset does not have files for mode: {}'.format(m))
+                continue
+            self._columns[m] = columns
+            self._chunk_offsets[m] = np.array(ntraj)
+            self._order[m], self._next[m] = np.arange(ntraj[-1]), 0
+
+    def num_traj(self, mode='train'):
+        return int(self._chunk_offsets[mode][-1])
+
+    def get_slices(self, mode, traj_inds, t_starts, keys=None):
+        """
+        :param traj_inds: trajectory indices within the mode
+        :param t_starts: first time step of the window of each trajectory
+        :return: dict mapping keys to arrays of shape [len(traj_inds), window, ...] for sequence data and
+        [len(traj_inds), ...] for meta-data
+        """
+        if keys is None:
+            keys = list(self._sequence_keys) + list(self._metadata_keys)
+        offsets = self._chunk_offsets[mode]
+        chunks = np.searchsorted(offsets, traj_inds, side='right') - 1
+        batch = {}
+        for k in keys:
+            columns = self._columns[mode][k]
+            if k in self._sequence_keys:
+                shape, dtype = self._sequence_keys[k]
+                out = np.empty((len(traj_inds), self._window) + tuple(shape), dtype=COLUMN_DTYPES[dtype])
+                for i, (c, ind, t0) in enumerate(zip(chunks, traj_inds, t_starts)):
+                    out[i] = columns[c][ind - offsets[c], t0:t0 + self._window]
+            else:
+                shape, dtype = self._metadata_keys[k]
+                out = np.empty((len(traj_inds),) + tuple(shape), dtype=COLUMN_DTYPES[dtype])
+                for i, (c, ind) in enumerate(zip(chunks, traj_inds)):
+                    out[i] = columns[c][ind - offsets[c]]
+            batch[k] = out
+        return batch
+
+    def next_batch(self, mode='train', keys=None):
+        """
+        draws the next batch_size trajectories (reshuffled every epoch if shuffle is set) with random windows
+        :return: dict with the raw keys and 'images', 'state', 'actions' mapped like in BaseVideoDataset
+        """
+        if mode not in self._columns:
+            raise ValueError('Mode {} not valid! Dataset has following modes: {}'.format(mode, list(self._columns.keys())))
+        order, ntraj = self._order[mode], self.num_traj(mode)
+        inds = []
+        while len(inds) < self._batch_size:
+            if self._next[mode] == 0 and self._hparams['shuffle']:
+                self._rng.shuffle(order)
+            n = min(self._batch_size - len(inds), ntraj - self._next[mode])
+            inds.extend(order[self._next[mode]:self._next[mode] + n])
+            self._next[mode] = (self._next[mode] + n) % ntraj
+        t_starts = self._rng.randint(0, self._T - self._window + 1, size=self._batch_size)
+        batch = self.get_slices(mode, np.array(inds), t_starts, keys)
+        return self._map_keys(batch)
+
+    def _map_keys(self, batch):
+        if 'env/state' in batch:
+            batch['state'] = batch['env/state']
+        if 'policy/actions' in batch:
+            batch['actions'] = batch['policy/actions']
+        image_keys = sorted([k for k in batch if k.startswith('env/image_view')])
+        if len(image_keys) == 1:
+            batch['images'] = batch[image_keys[0]]
+        elif len(image_keys) > 1:
+            batch['images'] = np.stack([batch['env/image_view{}/encoded'.format(i)] for i in range(len(image_keys))], 2)
+        return batch
+
+    @property
+    def T(self):
+        return self._window
+
+
+def _example_to_arrays(example, sequence_manifest, metadata_manifest, T):
+    def to_array(feature, manifest_entry):
+        shape, dtype = manifest_entry
+        if dtype == 'Byte':
+            return np.frombuffer(feature.bytes_list.value[0], dtype=np.uint8).reshape(shape)
+        elif dtype == 'Float':
+            return np.array(feature.float_list.value, dtype=np.float32).reshape(shape)
+        return np.array(feature.int64_list.value, dtype=np.int64).reshape(shape)
+
+    features = example.features.feature
+    meta_data = dict([(k, to_array(features[k], metadata_manifest[k])) for k in metadata_manifest])
+    sequence_data = [dict([(k, to_array(features['{}/{}'.format(t, k)], sequence_manifest[k]))
+                           for k in sequence_manifest]) for t in range(T)]
+    return meta_data, sequence_data
+
+
+def convert_tfrecords(source_dir, target_dir):
+    """
+    converts a directory with manifest.pkl and train/test/val TFRecords into the columnar format, every TFRecord file
+    becomes one chunk
+    """
+    import tensorflow as tf
+    with open('{}/manifest.pkl'.format(source_dir), 'rb') as f:
+        manifest_dict = pkl.load(f)
+    sequence_manifest = manifest_dict['sequence_data'] or {}
+    metadata_manifest = manifest_dict['traj_metadata'] or {}
+    T = manifest_dict['T']
+
+    options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.GZIP)
+    for mode in ColumnarDataset.MODES:
+        for fname in sorted(glob.glob('{}/{}/*.tfrecords'.format(source_dir, mode))):
+            trajectories = [_example_to_arrays(tf.train.Example.FromString(record), sequence_manifest,
+                                               metadata_manifest, T)
+                            for record in tf.python_io.tf_record_iterator(fname, options=options)]
+            if len(trajectories) == 0:
+                continue
+            chunk = os.path.splitext(os.path.basename(fname))[0]
+            save_columnar_chunk('{}/{}/{}'.format(target_dir, mode, chunk), trajectories,
+                                manifest_dict['sequence_data'], manifest_dict['traj_metadata'])
+
+    manifest_dict = dict(manifest_dict)
+    manifest_dict['format'] = 'columnar'
+    with open('{}/manifest.pkl'.format(target_dir), 'wb') as f:
+        pkl.dump(manifest_dict, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert a TFRecord dataset into the columnar format')
+    parser.add_argument('source_dir', type=str, help='folder with manifest.pkl and train/test/val TFRecords')
+    parser.add_argument('target_dir', type=str)
+    args = parser.parse_args()
+
+    convert_tfrecords(args.source_dir, args.target_dir)
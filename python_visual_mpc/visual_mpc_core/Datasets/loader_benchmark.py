@@ -0,0 +1,39 @@
+""" compares batches per second of the TFRecord pipeline and the columnar memory-mapped reader on the same data """
+import argparse
+import time
+from python_visual_mpc.visual_mpc_core.Datasets.columnar_dataset import ColumnarDataset
+
+
+def time_tfrecords(directory, batch_size, nbatches):
+    import tensorflow as tf
+    from python_visual_mpc.visual_mpc_core.Datasets.base_dataset import BaseVideoDataset
+    dataset = BaseVideoDataset(directory, batch_size)
+    fetches = [dataset['images'], dataset['actions'], dataset['state']]
+    sess = tf.Session()
+    sess.run(fetches)   # warmup, fills the shuffle buffer
+    t_start = time.time()
+    for _ in range(nbatches):
+        sess.run(fetches)
+    return nbatches / (time.time() - t_start)
+
+
+def time_columnar(directory, batch_size, nbatches):
+    dataset = ColumnarDataset(directory, batch_size)
+    t_start = time.time()
+    for _ in range(nbatches):
+        dataset.next_batch('train')
+    return nbatches / (time.time() - t_start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='loader benchmark')
+    parser.add_argument('tfrecord_dir', type=str, help='dataset with manifest.pkl and TFRecords')
+    parser.add_argument('columnar_dir', type=str, help='the same dataset converted with columnar_dataset.py')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--nbatches', type=int, default=200)
+    args = parser.parse_args()
+
+    tfrecord_rate = time_tfrecords(args.tfrecord_dir, args.batch_size, args.nbatches)
+    columnar_rate = time_columnar(args.columnar_dir, args.batch_size, args.nbatches)
+    print('batch size {}: TFRecords {:.1f} batches/s, columnar {:.1f} batches/s ({:.1f}x)'.format(
+        args.batch_size, tfrecord_rate, columnar_rate, columnar_rate / tfrecord_rate))
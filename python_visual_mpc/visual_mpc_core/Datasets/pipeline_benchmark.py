@@ -0,0 +1,38 @@
+""" records per second of the BaseVideoDataset input pipeline for the sequential and the parallel configuration """
+import argparse
+import time
+import tensorflow as tf
+from python_visual_mpc.visual_mpc_core.Datasets.base_dataset import BaseVideoDataset
+
+
+SEQUENTIAL = {'num_parallel_reads': 1, 'num_parallel_calls': 1, 'batch_parse': False, 'prefetch': 0}
+
+
+def records_per_second(directory, batch_size, nbatches, hparams_dict):
+    with tf.Graph().as_default():
+        dataset = BaseVideoDataset(directory, batch_size, hparams_dict)
+        fetches = [dataset['images'], dataset['actions'], dataset['state']]
+        sess = tf.Session()
+        sess.run(fetches)   # warmup, fills the shuffle buffer
+        t_start = time.time()
+        for _ in range(nbatches):
+            sess.run(fetches)
+        elapsed = time.time() - t_start
+        sess.close()
+    return nbatches * batch_size / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='input pipeline benchmark')
+    parser.add_argument('data_dir', type=str, help='dataset with manifest.pkl and TFRecords')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--nbatches', type=int, default=200)
+    parser.add_argument('--num_parallel', type=int, default=4, help='num_parallel_reads and num_parallel_calls')
+    args = parser.parse_args()
+
+    parallel = {'num_parallel_reads': args.num_parallel, 'num_parallel_calls': args.num_parallel,
+                'batch_parse': True, 'prefetch': 2}
+    sequential_rate = records_per_second(args.data_dir, args.batch_size, args.nbatches, SEQUENTIAL)
+    parallel_rate = records_per_second(args.data_dir, args.batch_size, args.nbatches, parallel)
+    print('batch size {}: sequential {:.1f} records/s, parallel {:.1f} records/s ({:.1f}x)'.format(
+        args.batch_size, sequential_rate, parallel_rate, parallel_rate / sequential_rate))
@@ -17,6 +17,67 @@ def int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
 
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _length_delimited(tag, payload):
+    return tag + _varint(len(payload)) + payload
+
+
+# The functions below write the protobuf wire format of tf.train.Feature directly from numpy buffers, which avoids
+# building python lists of every value. Feature fields: bytes_list = 1, float_list = 2, int64_list = 3, all lists
+# store their values in field 1.
+
+def float_feature_bytes(array):
+    """
+    :return: serialized tf.train.Feature with a packed float_list
+    """
+    values = np.ascontiguousarray(array, dtype='<f4').tobytes()
+    return _length_delimited(b'\x12', _length_delimited(b'\x0a', values))
+
+
+def int64_feature_bytes(array):
+    """
+    :return: serialized tf.train.Feature with a packed int64_list
+    """
+    values = np.asarray(array, dtype=np.int64).ravel().view(np.uint64)
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    shifted = values[:, None] >> shifts[None]
+    nbytes = np.maximum(np.sum(shifted > 0, axis=1), 1)
+    groups = (shifted & np.uint64(0x7f)).astype(np.uint8)
+    index = np.arange(10)[None]
+    groups[index < nbytes[:, None] - 1] |= 0x80      # continuation bits
+    payload = groups[index < nbytes[:, None]].tobytes()
+    return _length_delimited(b'\x1a', _length_delimited(b'\x0a', payload))
+
+
+def bytes_feature_bytes(value):
+    """
+    :return: serialized tf.train.Feature with a bytes_list holding value
+    """
+    return _length_delimited(b'\x0a', _length_delimited(b'\x0a', value))
+
+
+def serialize_example(features):
+    """
+    :param features: dict mapping feature names to tf.train.Feature or to already serialized features
+    :return: serialized tf.train.Example
+    """
+    entries = []
+    for k, v in features.items():
+        if not isinstance(v, bytes):
+            v = v.SerializeToString()
+        entries.append(_length_delimited(b'\x0a', _length_delimited(b'\x0a', k.encode('utf-8')) +
+                                         _length_delimited(b'\x12', v)))
+    return _length_delimited(b'\x0a', b''.join(entries))
+
+
 def save_tf_record(filename, trajectory_list, sequence_manifest, metadata_manifest):
     """
     saves data_files from one sample trajectory into one tf-record file
@@ -49,14 +110,57 @@ def save_tf_record(filename, trajectory_list, sequence_manifest, metadata_manife
         for k in meta_data:
             feature[k] = meta_data[k]
 
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
-        writer.write(example.SerializeToString())
+        writer.write(serialize_example(feature))
 
     writer.close()
 
 
+# numpy dtypes of the manifest types in the columnar format, same as the types the TFRecords are parsed to
+COLUMN_DTYPES = {'Float': np.float32, 'Int': np.int64, 'Byte': np.uint8}
+
+
+def column_filename(key):
+    return key.replace('/', '.') + '.npy'
+
+
+def save_columnar_chunk(folder, trajectory_list, sequence_manifest, metadata_manifest):
+    """
+    saves trajectories as one .npy file per key with leading dimensions [n_traj, T] for sequence data and [n_traj] for
+    meta-data, the chunk is appended to the index.pkl of the parent folder
+    """
+    os.makedirs(folder)
+    print(folder)
+    if metadata_manifest is not None:
+        for k, (shape, dtype) in metadata_manifest.items():
+            column = np.stack([np.asarray(meta_data[k]).reshape(shape) for meta_data, _ in trajectory_list])
+            np.save(os.path.join(folder, column_filename(k)), column.astype(COLUMN_DTYPES[dtype], copy=False))
+    if sequence_manifest is not None:
+        for k, (shape, dtype) in sequence_manifest.items():
+            column = np.stack([np.stack([np.asarray(feats[k]).reshape(shape) for feats in sequence_data])
+                               for _, sequence_data in trajectory_list])
+            np.save(os.path.join(folder, column_filename(k)), column.astype(COLUMN_DTYPES[dtype], copy=False))
+
+    index_path = os.path.join(os.path.dirname(folder), 'index.pkl')
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            index = pkl.load(f)
+    else:
+        index = {'chunks': []}
+    index['chunks'].append((os.path.basename(folder), len(trajectory_list)))
+    with open(index_path + '.tmp', 'wb') as f:
+        pkl.dump(index, f)
+    os.rename(index_path + '.tmp', index_path)   # readers never see a partially written index
+
+
 class RecordSaver:
-    def __init__(self, data_save_dir, sequence_length=None, traj_per_file=1, offset=0, split=(0.90, 0.05, 0.05)):
+    def __init__(self, data_save_dir, sequence_length=None, traj_per_file=1, offset=0, split=(0.90, 0.05, 0.05),
+                 save_format='tfrecord'):
+        """
+        :param save_format: 'tfrecord' for GZIP'd TFRecords of serialized features, 'columnar' for memory-mappable
+        .npy chunks of the raw arrays (see save_columnar_chunk)
+        """
+        assert save_format in ['tfrecord', 'columnar'], 'Given save_format: {} is invalid'.format(save_format)
+        self._save_format = save_format
         self._traj_buffers = [[] for _ in range(3)]
         self._save_counters = [0 for _ in range(3)]
 
@@ -156,6 +260,7 @@ class RecordSaver:
             manifest_dict['sequence_data'] = self._sequence_keys
             manifest_dict['traj_metadata'] = self._metadata_keys
             manifest_dict['T'] = self._T
+            manifest_dict['format'] = self._save_format
             pkl.dump(manifest_dict, f)
 
     def __len__(self):
@@ -174,7 +279,10 @@ class RecordSaver:
 
                 folder = '{}/{}'.format(self._base_dir, name)
                 file = '{}/traj_{}_to_{}'.format(folder, num_saved, next_total - 1)
-                save_tf_record(file, buffer, self._sequence_keys, self._metadata_keys)
+                if self._save_format == 'columnar':
+                    save_columnar_chunk(file, buffer, self._sequence_keys, self._metadata_keys)
+                else:
+                    save_tf_record(file, buffer, self._sequence_keys, self._metadata_keys)
 
                 self._traj_buffers[i] = []
                 self._save_counters[i] = next_counter
@@ -0,0 +1,46 @@
+""" measures how many trajectories per second the record workers serialize, compress and write """
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+from multiprocessing import Manager
+from python_visual_mpc.visual_mpc_core.agent.utils.traj_saver import start_record_workers, stop_record_workers
+
+
+def make_traj(T, ncam, height, width, adim, sdim):
+    agent_data = {'goal_reached': False, 'traj_ok': True}
+    obs = {'images': np.random.randint(0, 256, size=(T, ncam, height, width, 3), dtype=np.uint8),
+           'state': np.random.normal(size=(T, sdim)),
+           'qpos': np.random.normal(size=(T, 2 * sdim))}
+    policy_out = [{'actions': np.random.normal(size=adim)} for _ in range(T)]
+    return agent_data, obs, policy_out
+
+
+def measure(nworkers, ntraj, traj, T, traj_per_file, queue_size):
+    save_dir = tempfile.mkdtemp()
+    m = Manager()
+    queue = m.Queue(queue_size)
+    t_start = time.time()
+    procs = start_record_workers(queue, nworkers, save_dir, T, False, traj_per_file)
+    for _ in range(ntraj):
+        agent_data, obs, policy_out = traj
+        queue.put((dict(agent_data), dict(obs), policy_out))
+    stop_record_workers(queue, procs)
+    elapsed = time.time() - t_start
+    shutil.rmtree(save_dir)
+    return ntraj / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='record saver throughput')
+    parser.add_argument('--ntraj', type=int, default=256)
+    parser.add_argument('--T', type=int, default=30)
+    parser.add_argument('--ncam', type=int, default=2)
+    parser.add_argument('--traj_per_file', type=int, default=16)
+    args = parser.parse_args()
+
+    traj = make_traj(args.T, args.ncam, 48, 64, 4, 5)
+    for nworkers in [1, 2, 4, 8]:
+        rate = measure(nworkers, args.ntraj, traj, args.T, args.traj_per_file, 8 * nworkers)
+        print('{} record workers: {:.1f} trajectories/s'.format(nworkers, rate))
@@ -0,0 +1,106 @@
+"""
+Hands trajectories from the Sim workers to the record workers through shared memory, only small descriptors go through
+the record queue.
+"""
+import os
+import numpy as np
+from collections import namedtuple
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:   # python < 3.8
+    shared_memory = None
+
+
+# obs arrays are stored in the slot, layout maps obs keys to (offset, shape, dtype)
+SharedTrajectory = namedtuple('SharedTrajectory', ['slot', 'layout', 'agent_data', 'obs', 'policy_out'])
+
+ALIGNMENT = 64
+
+
+def _aligned(nbytes):
+    return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _attach(name):
+    """
+    attaches without registering the block with the resource tracker, which would otherwise unlink it when the attaching
+    process exits
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)   # python >= 3.13
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedTrajectoryBuffer(object):
+    """
+    One shared memory block split into nslots equally sized slots. A writer takes a free slot (blocking while all are in
+    use), copies the obs arrays into it and sends the SharedTrajectory descriptor, the reader uses the arrays in place
+    and releases the slot afterwards.
+    """
+    def __init__(self, nslots, slot_bytes, free_slots, name=None):
+        """
+        :param free_slots: queue shared by all processes holding the indices of the free slots
+        :param name: name of an existing block to attach to, a new block is created if None
+        """
+        if shared_memory is None:
+            raise ImportError('shared memory trajectory handoff requires python >= 3.8')
+        self.nslots, self.slot_bytes = nslots, slot_bytes
+        self._free_slots = free_slots
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=nslots * slot_bytes)
+            self._owner_pid = os.getpid()   # forked children inherit this object but must not unlink the block
+            for i in range(nslots):
+                free_slots.put(i)
+        else:
+            self._shm = _attach(name)
+            self._owner_pid = None
+
+    def __getstate__(self):
+        return self.nslots, self.slot_bytes, self._free_slots, self._shm.name
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def pack(self, agent_data, obs, policy_out):
+        """
+        :return: SharedTrajectory, or the unchanged tuple if the arrays do not fit into one slot
+        """
+        arrays = [(k, v) for k, v in obs.items() if isinstance(v, np.ndarray)]
+        if sum(_aligned(v.nbytes) for _, v in arrays) > self.slot_bytes:
+            print('trajectory larger than shared memory slot, sending it through the queue')
+            return agent_data, obs, policy_out
+
+        slot = self._free_slots.get()
+        offset = slot * self.slot_bytes
+        layout = {}
+        for k, v in arrays:
+            np.ndarray(v.shape, dtype=v.dtype, buffer=self._shm.buf, offset=offset)[...] = v
+            layout[k] = (offset, v.shape, v.dtype.str)
+            offset += _aligned(v.nbytes)
+        small_obs = dict([(k, v) for k, v in obs.items() if k not in layout])
+        return SharedTrajectory(slot, layout, agent_data, small_obs, policy_out)
+
+    def unpack(self, traj):
+        """
+        :return: agent_data, obs, policy_out where the obs arrays are views into the slot, they are only valid until
+        the slot is released
+        """
+        obs = dict(traj.obs)
+        for k, (offset, shape, dtype) in traj.layout.items():
+            obs[k] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self._shm.buf, offset=offset)
+        return traj.agent_data, obs, traj.policy_out
+
+    def release(self, traj):
+        self._free_slots.put(traj.slot)
+
+    def close(self):
+        self._shm.close()
+        if self._owner_pid == os.getpid():
+            self._shm.unlink()
@@ -1,4 +1,7 @@
-from python_visual_mpc.visual_mpc_core.Datasets.save_util.record_saver import RecordSaver, float_feature, bytes_feature, int64_feature
+from python_visual_mpc.visual_mpc_core.Datasets.save_util.record_saver import RecordSaver, float_feature_bytes, \
+    bytes_feature_bytes, int64_feature_bytes
+from python_visual_mpc.visual_mpc_core.agent.utils.shared_traj_buffer import SharedTrajectory
+from multiprocessing import Process
 import numpy as np
 import os
 
@@ -27,19 +30,22 @@ def get_dtype(datum):
 
 
 def convert_datum(datum):
+    """
+    :return: serialized tf.train.Feature, arrays are written from their buffers without going through python lists
+    """
     if isinstance(datum, np.ndarray):
         if datum.dtype == np.uint8:
-            return bytes_feature(datum.tostring())
+            return bytes_feature_bytes(datum.tostring())
         elif datum.dtype.kind == 'i':
-            return int64_feature(datum.flatten().tolist())
+            return int64_feature_bytes(datum)
         elif datum.dtype.kind == 'f':
-            return float_feature(datum.flatten().tolist())
+            return float_feature_bytes(datum)
     elif isinstance(datum, float):
-        return float_feature([datum])
+        return float_feature_bytes([datum])
     elif isinstance(datum, int):
-        return int64_feature([datum])
+        return int64_feature_bytes([datum])
     elif isinstance(datum, bool):
-        return int64_feature([int(datum)])
+        return int64_feature_bytes([int(datum)])
 
     raise ValueError('datum {} has unknown dtype'.format(datum))
 
@@ -48,16 +54,33 @@ class GeneralAgentSaver:
     """
     Serializes trajectory data and sends to RecordSaver to store as TFRecord
     """
-    def __init__(self, save_dir, sequence_length, seperate_good=False, traj_per_file=128, offset=0, split=(0.90, 0.05, 0.05)):
+    def __init__(self, save_dir, sequence_length, seperate_good=False, traj_per_file=128, offset=0, split=(0.90, 0.05, 0.05),
+                 shard=None, save_format='tfrecord'):
+        """
+        :param shard: if not None records and manifest are written to a shard{shard} sub-directory, so that several
+        savers can write to the same save_dir in parallel
+        :param save_format: 'tfrecord' or 'columnar', see RecordSaver
+        """
         self._base_dir = save_dir
         self._seperate_good = seperate_good
         self._manifest_saved, self._T = False, sequence_length
+        if save_format == 'columnar':
+            self._convert = np.array      # copies, the inputs may be views into buffers that are reused
+        else:
+            self._convert = convert_datum
+
+        def shard_dir(d):
+            if shard is None:
+                return d
+            return '{}/shard{}'.format(d, shard)
 
         if seperate_good:
-            self._good_saver = RecordSaver('{}/good'.format(self._base_dir), sequence_length, traj_per_file, offset, split)
-            self._bad_saver = RecordSaver('{}/bad'.format(self._base_dir), sequence_length, traj_per_file, offset, split)
+            self._good_saver = RecordSaver(shard_dir('{}/good'.format(self._base_dir)), sequence_length, traj_per_file,
+                                           offset, split, save_format)
+            self._bad_saver = RecordSaver(shard_dir('{}/bad'.format(self._base_dir)), sequence_length, traj_per_file,
+                                          offset, split, save_format)
         else:
-            self._saver = RecordSaver(self._base_dir, sequence_length, traj_per_file, offset, split)
+            self._saver = RecordSaver(shard_dir(self._base_dir), sequence_length, traj_per_file, offset, split, save_format)
 
     def _save_manifests(self, agent_data, obs, policy_out):
         def get_shape(datum):
@@ -106,7 +129,7 @@ class GeneralAgentSaver:
         meta_data_dict = {}
 
         for k in agent_data:
-            meta_data_dict[k] = convert_datum(agent_data[k])
+            meta_data_dict[k] = self._convert(agent_data[k])
 
         for t in range(self._T):
             step_dict = {}
@@ -114,12 +137,12 @@ class GeneralAgentSaver:
                 if k == 'images':
                     ncam = obs[k].shape[1]
                     for c in range(ncam):
-                        step_dict['env/image_view{}/encoded'.format(c)] = convert_datum(obs[k][t, c])
+                        step_dict['env/image_view{}/encoded'.format(c)] = self._convert(obs[k][t, c])
                 else:
-                    step_dict['env/{}'.format(k)] = convert_datum(obs[k][t])
+                    step_dict['env/{}'.format(k)] = self._convert(obs[k][t])
             if len(policy_out) > t:
                 for k in policy_out[t]:
-                    step_dict['policy/{}'.format(k)] = convert_datum(policy_out[t][k])
+                    step_dict['policy/{}'.format(k)] = self._convert(policy_out[t][k])
 
             sequence_data.append(step_dict)
 
@@ -143,16 +166,51 @@ class GeneralAgentSaver:
             self._saver.flush()
 
 
-def record_worker(queue, save_dir, sequence_length, seperate_good, traj_per_file, offset=0, split=(0.90, 0.05, 0.05)):
+def record_worker(queue, save_dir, sequence_length, seperate_good, traj_per_file, offset=0, split=(0.90, 0.05, 0.05),
+                  shard=None, shared_buffer=None, save_format='tfrecord'):
+    """
+    :param shared_buffer: SharedTrajectoryBuffer the SharedTrajectory descriptors in the queue refer to
+    """
     print('started saver with PID:', os.getpid())
     print('saving to {}'.format(save_dir))
-    saver = GeneralAgentSaver(save_dir, sequence_length, seperate_good, traj_per_file, offset, split)
+    saver = GeneralAgentSaver(save_dir, sequence_length, seperate_good, traj_per_file, offset, split, shard, save_format)
     data = queue.get(True)
     counter = 0
     while data is not None:
         counter += 1
-        agent_data, obs, policy_out = data
-        saver.save_traj(agent_data, obs, policy_out)
+        if isinstance(data, SharedTrajectory):
+            # the arrays are serialized straight from shared memory, the slot is free again afterwards
+            saver.save_traj(*shared_buffer.unpack(data))
+            shared_buffer.release(data)
+        else:
+            agent_data, obs, policy_out = data
+            saver.save_traj(agent_data, obs, policy_out)
         data = queue.get(True)
     print('Saved {} as tfrecords'.format(counter))
     saver.flush()
+    if shared_buffer is not None:
+        shared_buffer.close()
+
+
+def start_record_workers(queue, nworkers, save_dir, sequence_length, seperate_good, traj_per_file, offset=0,
+                         split=(0.90, 0.05, 0.05), shared_buffer=None, save_format='tfrecord'):
+    """
+    starts nworkers record_worker processes that consume the same queue, every worker serializes, compresses and writes
+    its own shard. With a bounded queue, producers block once the writers fall behind.
+    :return: list of processes, stop them with stop_record_workers
+    """
+    procs = []
+    for i in range(nworkers):
+        shard = i if nworkers > 1 else None
+        p = Process(target=record_worker, args=(queue, save_dir, sequence_length, seperate_good, traj_per_file,
+                                                offset, split, shard, shared_buffer, save_format))
+        p.start()
+        procs.append(p)
+    return procs
+
+
+def stop_record_workers(queue, procs):
+    for _ in procs:
+        queue.put(None)           # every worker stops after the first None it receives
+    for p in procs:
+        p.join()
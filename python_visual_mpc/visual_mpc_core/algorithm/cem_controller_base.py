@@ -17,8 +17,13 @@ from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_controller_utils impo
 
 import time
 from .utils.cem_controller_utils import construct_initial_sigma, reuse_cov, \
-    reuse_action, truncate_movement, make_blockdiagonal, apply_ag_epsilon
+    reuse_action, truncate_movement, apply_ag_epsilon, batch_rejection_sample, warmstart_shift
 
+from .utils.cem_scheduler import CEMScheduler
+from .utils.elite_archive import EliteArchive
+from .utils.cem_covariance import COVARIANCE_TYPES
+from .utils.sampling_optimizers import colored_noise, mppi_weights, population_sizes
+from .utils.plan_timing import PlanTimer
 from python_visual_mpc.visual_mpc_core.algorithm.policy import Policy
 
 class CEM_Controller_Base(Policy):
@@ -76,6 +81,7 @@ class CEM_Controller_Base(Policy):
         self.sdim = self.agentparams['sdim']                             # state dimension
 
         self.indices =[]
+        self._cov_class = self._get_cov_class()
         self.mean =None
         self.sigma =None
         self.state = None
@@ -88,6 +94,7 @@ class CEM_Controller_Base(Policy):
             self.gen_score_publisher = rospy.Publisher('gen_score', numpy_msg(floatarray), queue_size=10)
 
         self.plan_stat = {} #planning statistics
+        self.timer = PlanTimer()    # timing spans of all planning calls since the last reset
 
         self.warped_image_goal, self.warped_image_start = None, None
 
@@ -102,6 +109,25 @@ class CEM_Controller_Base(Policy):
         self.best_cost_perstep = np.zeros([self.ncam, self.ndesig, self.len_pred])
         self._close_override = False
 
+        self._cold_M = None               # number of samples without warm start, subclasses may override self.M
+        self._last_cem_t = None
+        self._warmstart_residual = 0
+        self._prev_bestscore = None
+        self._scheduler = None
+        self._archive = None
+        if self._hp.elite_archive:
+            assert not self._hp.stochastic_planning, 'elite archive does not support stochastic planning'
+            self._archive = EliteArchive(self.K)
+        assert not self._hp.carry_elites or self._hp.elite_archive, 'carry_elites shifts the elites of elite_archive'
+        if self._hp.optimizer not in ('cem', 'icem', 'mppi'):
+            raise ValueError('unknown optimizer {}'.format(self._hp.optimizer))
+        if self._hp.optimizer != 'cem':
+            assert not self._hp.stochastic_planning and self._hp.custom_sampler is None, \
+                '{} does not support stochastic planning or custom samplers'.format(self._hp.optimizer)
+        if self._hp.optimizer == 'mppi':
+            assert self._hp.autograsp_epsilon[0] is None, 'mppi executes the weighted mean, autograsp is not supported'
+        self._icem_elites = None
+
     def _default_hparams(self):
         default_dict = {
             'verbose': False,
@@ -134,6 +160,32 @@ class CEM_Controller_Base(Policy):
             'add_zero_action':False,   # add one action sample with zero actions, this might prevent random walks in the end
             'reduce_std_dev':1., # reduce standard dev in later timesteps when reusing action
             'visualize_best': True,    # visualizer selects K best if True (random K trajectories otherwise)
+            'warmstart_prior': 'zero',     # mean of the action blocks appended after shifting the previous plan,
+                                           # 'zero' or 'repeat_last'
+            'warmstart_iterations': -1,    # stop a warm-started CEM after this many iterations if it has converged,
+                                           # -1 always runs all iterations
+            'warmstart_tol': 0.05,         # warm start counts as converged if the best score is within this relative
+                                           # tolerance of the final best score of the previous plan
+            'adaptive_schedule': False,    # stop early and shrink M when the elites collapse, see CEMScheduler
+            'schedule_min_iterations': 1,
+            'schedule_spread_tol': 1e-3,   # stop if std/|mean| of the elite scores falls below this
+            'schedule_trace_tol': 1e-2,    # stop if the covariance trace falls below this fraction of the initial one
+            'schedule_min_frac': 0.25,     # M never shrinks below this fraction of the initial number of samples
+            'elite_archive': False,        # merge the K best samples of earlier iterations into the fit, they are not
+                                           # predicted again and replace fresh samples in multiples of the sample batch
+            'carry_elites': False,         # shift the archived elites to the next MPC step, where they are evaluated
+                                           # again as part of the first iteration, requires elite_archive
+            'cov_type': None,              # 'dense', 'diag', 'banded' or 'lowrank', see cem_covariance. None selects
+                                           # 'banded' if cov_blockdiag is set and 'dense' otherwise
+            'cov_rank': 4,                 # rank of the 'lowrank' covariance
+            'optimizer': 'cem',            # 'cem', 'icem' (colored noise, shrinking population, kept elites) or
+                                           # 'mppi' (exponentially weighted mean), all evaluate through get_rollouts
+            'noise_beta': 2.,              # icem and mppi sample noise with power spectrum 1/f^beta over the action
+                                           # blocks, 0 is white noise
+            'icem_population_decay': 1.25, # iteration i draws num_samples / decay^i samples, but at least 2K
+            'icem_keep_elites': 0.3,       # fraction of the K elites kept for the next iteration and the next MPC step
+            'icem_momentum': 0.1,          # weight of the previous mean and std in the iCEM update
+            'mppi_temperature': 0.5,       # MPPI temperature in units of the standard deviation of the scores
         }
 
         parent_params = super(CEM_Controller_Base, self)._default_hparams()
@@ -143,68 +195,199 @@ class CEM_Controller_Base(Policy):
 
     def reset(self):
         self.plan_stat = {} #planning statistics
+        self.timer.reset()
         self.indices =[]
         self.action_list = []
+        self._last_cem_t = None
+        self._warmstart_residual = 0
+        self._prev_bestscore = None
+        if self._archive is not None:
+            self._archive.clear()
+        if self._icem_elites is not None:
+            self._icem_elites.clear()
+
+    def _max_samples(self):
+        """
+        largest number of samples drawn in one iteration, e.g. to size shared buffers
+        """
+        if isinstance(self._hp.num_samples, list):
+            return max(max(self._hp.num_samples), self.M)
+        return max(self._hp.num_samples, self.M)
+
+    def _set_num_samples(self, M):
+        self.M = M
+        if self._hp.selection_frac != -1:
+            self.K = int(np.ceil(self.M*self._hp.selection_frac))
+        else:
+            self.K = 10
+
+    def _get_cov_class(self):
+        cov_type = self._hp.cov_type
+        if cov_type is None:
+            cov_type = 'banded' if self._hp.cov_blockdiag else 'dense'
+        cov_class = COVARIANCE_TYPES[cov_type]
+        class_kwargs = {}
+        if cov_type == 'lowrank':
+            class_kwargs['rank'] = self._hp.cov_rank
+        return cov_class, class_kwargs
+
+    @property
+    def sigma(self):
+        """
+        dense view of the covariance, assigning a dense matrix converts it into the configured representation
+        """
+        if self.cov is None:
+            return None
+        return self.cov.dense()
+
+    @sigma.setter
+    def sigma(self, sigma):
+        if sigma is None:
+            self.cov = None
+        else:
+            cov_class, class_kwargs = self._cov_class
+            self.cov = cov_class.from_dense(sigma, self.naction_steps, self.adim, **class_kwargs)
+
+    def _sample_batch(self):
+        """
+        :return: number the sample count has to be a multiple of when the scheduler changes it
+        """
+        return 1
+
+    def _warm_start(self):
+        """
+        shifts mean and covariance of the previous plan by the number of action blocks executed since it was made
+        :return: True if the previous plan was reused
+        """
+        shift = self._plan_shift()
+        if shift is None:
+            return False
+        if self._hp.carry_elites and len(self._archive) > 0:
+            self._carried = self._shift_elites(shift)
+        if not (self._hp.reuse_mean or self._hp.reuse_cov):
+            return False
+        if self._hp.reuse_cov:
+            self.sigma = reuse_cov(self.sigma, self.adim, self._hp, shift)
+        if self._hp.reuse_mean:
+            self.mean = reuse_action(self.bestaction, self._hp, shift)
+        return True
+
+    def _plan_shift(self):
+        """
+        :return: number of action blocks executed since the previous plan was made, None if there is none
+        """
+        if self._last_cem_t is None:
+            self._warmstart_residual = 0
+            return None
+        shift, self._warmstart_residual = warmstart_shift(self.t - self._last_cem_t, self._warmstart_residual,
+                                                          self.repeat)
+        self.plan_stat['warmstart_shift'] = shift
+        return shift
+
+    def _shift_elites(self, shift):
+        """
+        shifts the archived elites by shift action blocks, the new blocks at the end are drawn from the initial
+        distribution around the warm start prior
+        """
+        nblocks = min(shift, self.naction_steps)
+        std = np.sqrt(np.diag(construct_initial_sigma(self._hp, self.adim, 0))[:self.adim])
+        noise = std * np.random.standard_normal((len(self._archive), nblocks, self.adim))
+        noise = np.repeat(noise, self.repeat, axis=1)
+        return self._archive.shift(shift * self.repeat, self._hp.warmstart_prior, noise)
+
+    def _warm_start_converged(self, bestscore):
+        if self._prev_bestscore is None:
+            return False
+        return bestscore <= self._prev_bestscore + self._hp.warmstart_tol * np.abs(self._prev_bestscore)
 
     def perform_CEM(self):
+        if self._hp.optimizer == 'icem':
+            return self.perform_iCEM()
+        if self._hp.optimizer == 'mppi':
+            return self.perform_MPPI()
         self.logger.log('starting cem at t{}...'.format(self.t))
-        timings = OrderedDict()
-        t = time.time()
-        if not self._hp.reuse_cov or self.t < 2:
+        if self._cold_M is None:
+            self._cold_M = self.M
+        self._carried = None
+        warm = self._warm_start()
+        if self._archive is not None:
+            self._archive.clear()
+        if not warm or not self._hp.reuse_cov:
             self.sigma = construct_initial_sigma(self._hp, self.adim, self.t)
-            self.sigma_prev = self.sigma
-        else:
-            self.sigma = reuse_cov(self.sigma, self.adim, self._hp)
-
-        if not self._hp.reuse_mean or self.t < 2:
+            self.cov_prev = self.cov
+        if not warm or not self._hp.reuse_mean:
             self.mean = np.zeros(self.adim * self.naction_steps)
-        else:
-            self.mean = reuse_action(self.bestaction, self._hp)
+        self._last_cem_t = self.t
+        self.plan_stat['num_rollouts'] = 0
 
-        if (self._hp.reuse_mean or self._hp.reuse_cov) and self.t >= 2:
-            self.M = self._hp.num_samples[1]
-            self.K = int(np.ceil(self.M*self._hp.selection_frac))
+        if warm and isinstance(self._hp.num_samples, list) and len(self._hp.num_samples) > 1:
+            self._set_num_samples(self._hp.num_samples[1])
+        else:
+            self._set_num_samples(self._cold_M)
+        if self._archive is not None:
+            self._archive.size = self.K
 
         self.bestindices_of_iter = np.zeros((self.niter, self.K))
         self.cost_perstep = np.zeros([self.M, self.ncam, self.ndesig, self.repeat*self.naction_steps - self.ncontxt])
 
+        if self._hp.adaptive_schedule:
+            if self._scheduler is None:
+                self._scheduler = CEMScheduler(self._hp, int(np.lcm(self._sample_batch(), self.smp_peract)))
+            self._scheduler.start(self.M, self.K, self.cov)
+
         self.logger.log('M {}, K{}'.format(self.M, self.K))
         self.logger.log('------------------------------------------------')
         self.logger.log('starting CEM cylce')
-        timings['pre_itr'] = time.time() - t
         for itr in range(self.niter):
             itr_times = OrderedDict()
             self.logger.log('------------')
             self.logger.log('iteration: ', itr)
             t_startiter = time.time()
+            span = self.timer.start('sampling', itr=itr)
+            budget = self.M
+            nskip, ncarried = 0, 0
+            if self._archive is not None:
+                # archived elites replace fresh samples in whole sample batches, leaving at least K fresh samples
+                g = self._sample_batch()
+                if self._archive.scored:
+                    nskip = min(len(self._archive) // g * g, max(budget - self.K, 0) // g * g)
+                if self._carried is not None:
+                    self._carried = self._carried[:max(budget - nskip - self.K, 0)]
+                    ncarried = self._carried.shape[0]
+            self.M = budget - nskip    # number of samples evaluated in this iteration
+            nfresh = self.M - ncarried
+
             if self._hp.custom_sampler is None:
                 if self._hp.rejection_sampling:
-                    actions = self.sample_actions_rej()
+                    actions = self.sample_actions_rej(itr, nfresh)
                 else:
-                    actions = self.sample_actions(self.mean, self.sigma, self._hp, self.M)
+                    actions = self.sample_actions(self.mean, self.cov, self._hp, nfresh)
 
-                if self._hp.autograsp_epsilon[0] is not None:
-                    assert len(self._hp.autograsp_epsilon) == 2 or len(self._hp.autograsp_epsilon) == 3, \
-                        "Should be array of [z_thresh, epsilon] or [z_thresh, epsilon, norm]"
-                    if len(self._hp.autograsp_epsilon) == 2:
-                        self._hp.autograsp_epsilon = [i for i in self._hp.autograsp_epsilon] + [1]
-
-                    actions = apply_ag_epsilon(actions, self.state, self._hp,
-                                               self._close_override, self.t < self._hp.repeat)
+                actions = self._apply_autograsp(actions)
             else:
                 sampler = self._hp.custom_sampler(self.sigma, self.mean, self._hp, self.repeat, self.adim)
-                actions = sampler.sample(self.M, self.state)
+                actions = sampler.sample(nfresh, self.state)
+            if self._carried is not None:
+                actions = np.concatenate([self._carried, actions], 0)
+                self.plan_stat['carried_elites'] = self._carried.shape[0]
+                self._carried = None
 
-            itr_times['action_sampling'] = time.time() - t_startiter
-            t_start = time.time()
+            itr_times['action_sampling'] = self.timer.stop(span)
+            span = self.timer.start('rollouts', itr=itr, nsamples=actions.shape[0])
 
             scores = self.get_rollouts(actions, itr, itr_times)
-            itr_times['vid_pred_total'] = time.time() - t_start
+            self.plan_stat['num_rollouts'] += actions.shape[0]
+            itr_times['vid_pred_total'] = self.timer.stop(span)
             t = time.time()
-            self.logger.log('overall time for evaluating actions {}'.format(time.time() - t_start))
+            self.logger.log('overall time for evaluating actions {}'.format(itr_times['vid_pred_total']))
 
             if self._hp.stochastic_planning:
                 actions, scores = self.action_preselection(actions, scores)
+            if self._archive is not None:
+                self.plan_stat['archived_elites_itr{}'.format(itr)] = len(self._archive) if self._archive.scored else 0
+                actions, scores = self._archive.merge(actions, scores)
+                self._archive.update(actions, scores)
+            self.M = budget
 
             self.indices = scores.argsort()[:self.K]
             self.bestindices_of_iter[itr] = self.indices
@@ -215,22 +398,212 @@ class CEM_Controller_Base(Policy):
             if hasattr(self, 'best_cost_perstep'):
                 self.plan_stat['best_cost_perstep'] = self.best_cost_perstep
 
+            span = self.timer.start('fit', itr=itr)
             actions_flat = self.post_process_actions(actions)
 
             self.fit_gaussians(actions_flat)
+            itr_times['fit'] = self.timer.stop(span)
 
             self.logger.log('iter {0}, bestscore {1}'.format(itr, scores[self.indices[0]]))
             self.logger.log('overall time for iteration {}'.format(time.time() - t_startiter))
             itr_times['post_pred'] = time.time() - t
-            timings['itr{}'.format(itr)] = itr_times
 
-        # pkl.dump(timings, open('{}/timings_CEM_{}.pkl'.format(self.agentparams['record'], self.t), 'wb'))
+            if warm and self._hp.warmstart_iterations != -1 and itr + 1 >= self._hp.warmstart_iterations \
+                    and self._warm_start_converged(scores[self.indices[0]]):
+                self.logger.log('warm start converged, stopping after iteration', itr)
+                break
+
+            if self._hp.adaptive_schedule:
+                stop, next_M, stat = self._scheduler.update(itr, self.M, scores[self.indices], self.cov)
+                self.plan_stat['schedule_itr{}'.format(itr)] = stat
+                if stop:
+                    self.logger.log('scheduler stopping after iteration {}: {}'.format(itr, stat['stop']))
+                    break
+                if next_M != self.M:
+                    self.logger.log('scheduler reducing M from {} to {}'.format(self.M, next_M))
+                    self.M = next_M
+
+        self.plan_stat['cem_iterations'] = itr + 1
+        self._prev_bestscore = scores[self.indices[0]]
+
+    def _apply_autograsp(self, actions):
+        if self._hp.autograsp_epsilon[0] is not None:
+            assert len(self._hp.autograsp_epsilon) == 2 or len(self._hp.autograsp_epsilon) == 3, \
+                "Should be array of [z_thresh, epsilon] or [z_thresh, epsilon, norm]"
+            if len(self._hp.autograsp_epsilon) == 2:
+                self._hp.autograsp_epsilon = [i for i in self._hp.autograsp_epsilon] + [1]
+
+            actions = apply_ag_epsilon(actions, self.state, self._hp,
+                                       self._close_override, self.t < self._hp.repeat)
+        return actions
+
+    def _initial_std(self):
+        """
+        :return: standard deviation of the initial distribution, shape [nactions, adim]
+        """
+        return np.sqrt(np.diag(construct_initial_sigma(self._hp, self.adim, 0))).reshape(self.naction_steps, self.adim)
 
-    def sample_actions(self, mean, sigma, hp, M):
-        actions = np.random.multivariate_normal(mean, sigma, M)
-        actions = actions.reshape(M, hp.naction_steps, hp.adim)
+    def _evaluate_blocks(self, blocks, itr, itr_times):
+        """
+        discretizes and repeats action blocks of shape [n, nactions, adim] and scores them with get_rollouts
+        :return: the repeated actions, the blocks as evaluated and the scores
+        """
+        n = blocks.shape[0]
+        if self._hp.discrete_ind != None:
+            blocks = discretize(blocks, n, self.naction_steps, self._hp.discrete_ind)
+        actions = self._apply_autograsp(np.repeat(blocks, self.repeat, axis=1))
+        blocks = actions[:, self.repeat - 1::self.repeat]
+
+        self.M = n
+        span = self.timer.start('rollouts', itr=itr, nsamples=n)
+        scores = self.get_rollouts(actions, itr, itr_times)
+        itr_times['vid_pred_total'] = self.timer.stop(span)
+        self.plan_stat['num_rollouts'] += n
+        return actions, blocks, scores
+
+    def _record_itr(self, itr, scores):
+        self.bestindices_of_iter[itr] = self.indices
+        self.plan_stat['scores_itr{}'.format(itr)] = scores
+        self.plan_stat['bestscore_itr{}'.format(itr)] = scores[self.indices[0]]
+        if hasattr(self, 'best_cost_perstep'):
+            self.plan_stat['best_cost_perstep'] = self.best_cost_perstep
+        self.logger.log('iter {0}, bestscore {1}'.format(itr, scores[self.indices[0]]))
+
+    def _start_sampling_optimizer(self):
+        """
+        common setup of perform_iCEM and perform_MPPI, the mean of the previous plan is always shifted to the current
+        time step
+        :return: initial mean of shape [nactions, adim], number of action blocks shifted or None
+        """
+        if self._cold_M is None:
+            self._cold_M = self.M
+        self._set_num_samples(self._cold_M)
+        self.plan_stat['num_rollouts'] = 0
+        shift = self._plan_shift()
+        if shift is None:
+            mean = np.zeros((self.naction_steps, self.adim))
+        else:
+            mean = reuse_action(self.mean.reshape(self.naction_steps, self.adim), self._hp, shift)
+            mean = mean.reshape(self.naction_steps, self.adim)
+        self._last_cem_t = self.t
+        self.bestindices_of_iter = np.zeros((self.niter, self.K))
+        self.cost_perstep = np.zeros([self.M, self.ncam, self.ndesig, self.repeat*self.naction_steps - self.ncontxt])
+        return mean, shift
+
+    def perform_iCEM(self):
+        """
+        improved CEM (Pinneri et al. 2020): samples colored noise, shrinks the population by icem_population_decay in
+        every iteration, keeps a fraction of the elites for the next iteration without predicting them again and
+        shifts them to the next MPC step, updates mean and std with momentum and evaluates the mean in the last
+        iteration. Executes the best sequence found.
+        """
+        self.logger.log('starting icem at t{}...'.format(self.t))
+        mean, shift = self._start_sampling_optimizer()
+        std = self._initial_std()
+        bound = self._sampling_bound().reshape(self.naction_steps, self.adim)
+        budget = self.M
+
+        nkeep = int(np.ceil(self._hp.icem_keep_elites * self.K))
+        if self._icem_elites is None:
+            self._icem_elites = EliteArchive(nkeep)
+        carried = None
+        if shift is not None and len(self._icem_elites) > 0:
+            nblocks = min(shift, self.naction_steps)
+            tail_noise = colored_noise(self._hp.noise_beta, len(self._icem_elites), nblocks, self.adim) * std[-1]
+            carried = self._icem_elites.shift(shift, self._hp.warmstart_prior, tail_noise)
+        self._icem_elites.clear()
+
+        sizes = population_sizes(budget, self.niter, self._hp.icem_population_decay, 2 * self.K,
+                                 self._sample_batch())
+        best_score = np.inf
+        for itr, n in enumerate(sizes):
+            itr_times = OrderedDict()
+            span = self.timer.start('sampling', itr=itr)
+            extra = []
+            if carried is not None:
+                extra.append(carried[:max(n - self.K, 0)])
+                self.plan_stat['carried_elites'] = extra[-1].shape[0]
+                carried = None
+            if itr == self.niter - 1:
+                extra.append(mean[None])
+            nfresh = n - sum(e.shape[0] for e in extra)
+            noise = colored_noise(self._hp.noise_beta, nfresh, self.naction_steps, self.adim) * std[None]
+            blocks = np.concatenate(extra + [np.clip(mean[None] + noise, -bound, bound)], 0)
+            itr_times['action_sampling'] = self.timer.stop(span)
+
+            actions, blocks, scores = self._evaluate_blocks(blocks, itr, itr_times)
+            span = self.timer.start('fit', itr=itr)
+            self.plan_stat['num_samples_itr{}'.format(itr)] = n
+
+            all_blocks, all_scores = self._icem_elites.merge(blocks, scores)
+            self._icem_elites.update(all_blocks, all_scores)
+            self.indices = all_scores.argsort()[:self.K]
+            if all_scores[self.indices[0]] < best_score:
+                best_score = all_scores[self.indices[0]]
+                self.bestaction = all_blocks[self.indices[0]]
+                if self.indices[0] < n:
+                    self.bestaction_withrepeat = actions[self.indices[0]]
+                else:   # kept elites only store the action blocks
+                    self.bestaction_withrepeat = np.repeat(self.bestaction, self.repeat, axis=0)
+            self._record_itr(itr, all_scores)
+
+            elites = all_blocks[self.indices]
+            w = self._hp.icem_momentum
+            mean = w * mean + (1 - w) * np.mean(elites, axis=0)
+            std = w * std + (1 - w) * np.std(elites, axis=0)
+            itr_times['post_pred'] = self.timer.stop(span)
+
+        self.M = budget
+        self.mean = mean.flatten()
+        self.plan_stat['cem_iterations'] = self.niter
+        self._prev_bestscore = best_score
+
+    def perform_MPPI(self):
+        """
+        model predictive path integral control: perturbs the mean with colored noise of the initial std, the new mean is
+        the average of the samples weighted with exp(-score / temperature). The first sample of every iteration is the
+        mean itself. Executes the mean.
+        """
+        self.logger.log('starting mppi at t{}...'.format(self.t))
+        mean, _ = self._start_sampling_optimizer()
+        std = self._initial_std()
+        bound = self._sampling_bound().reshape(self.naction_steps, self.adim)
+
+        for itr in range(self.niter):
+            itr_times = OrderedDict()
+            span = self.timer.start('sampling', itr=itr)
+            noise = colored_noise(self._hp.noise_beta, self.M, self.naction_steps, self.adim) * std[None]
+            noise[0] = 0
+            blocks = np.clip(mean[None] + noise, -bound, bound)
+            itr_times['action_sampling'] = self.timer.stop(span)
+
+            actions, blocks, scores = self._evaluate_blocks(blocks, itr, itr_times)
+            span = self.timer.start('fit', itr=itr)
+            self.indices = scores.argsort()[:self.K]
+            self._record_itr(itr, scores)
+
+            weights = mppi_weights(scores, self._hp.mppi_temperature)
+            self.plan_stat['effective_samples_itr{}'.format(itr)] = 1. / np.sum(np.square(weights))
+            mean = np.tensordot(weights, blocks, axes=1)
+            itr_times['post_pred'] = self.timer.stop(span)
+
+        self.mean = mean.flatten()
+        plan = mean[None].copy()
+        if self._hp.discrete_ind != None:
+            plan = discretize(plan, 1, self.naction_steps, self._hp.discrete_ind)
+        self.bestaction = plan[0]
+        self.bestaction_withrepeat = np.repeat(self.bestaction, self.repeat, axis=0)
+        self.plan_stat['cem_iterations'] = self.niter
+        self._prev_bestscore = scores[self.indices[0]]
+
+    def sample_actions(self, mean, cov, hp, M):
+        """
+        :param cov: covariance in one of the representations of cem_covariance, it is never made dense
+        """
+        actions = mean[None] + cov.sample_noise(M)
+        actions = actions.reshape(M, self.naction_steps, self.adim)
         if hp.discrete_ind != None:
-            actions = discretize(actions, M, hp.naction_steps, hp.discrete_ind)
+            actions = discretize(actions, M, self.naction_steps, hp.discrete_ind)
 
         if hp.action_bound:
             actions = truncate_movement(actions, hp)
@@ -243,16 +616,15 @@ class CEM_Controller_Base(Policy):
 
     def fit_gaussians(self, actions_flat):
         arr_best_actions = actions_flat[self.indices]  # only take the K best actions
-        self.sigma = np.cov(arr_best_actions, rowvar=False, bias=False)
-        if self._hp.cov_blockdiag:
-            self.sigma = make_blockdiagonal(self.sigma, self.naction_steps, self.adim)
+        cov_class, class_kwargs = self._cov_class
+        self.cov = cov_class.fit(arr_best_actions, self.naction_steps, self.adim, **class_kwargs)
         if self._hp.smooth_cov:
-            self.sigma = 0.5 * self.sigma + 0.5 * self.sigma_prev
-            self.sigma_prev = self.sigma
+            self.cov = self.cov.blend(self.cov_prev, 0.5)
+            self.cov_prev = self.cov
         self.mean = np.mean(arr_best_actions, axis=0)
 
     def post_process_actions(self, actions):
-        num_ex = self.M // self.smp_peract
+        num_ex = actions.shape[0]
         actions = actions.reshape(num_ex, self.naction_steps, self.repeat, self.adim)
         actions = actions[:, :, -1, :]  # taking only one of the repeated actions
         actions_flat = actions.reshape(num_ex, self.naction_steps * self.adim)
@@ -260,54 +632,46 @@ class CEM_Controller_Base(Policy):
         return actions_flat
 
 
-    def sample_actions_rej(self):
+    def sample_actions_rej(self, itr=0, M=None):
         """
-        Perform rejection sampling
+        Perform rejection sampling, samples are drawn in batches, see batch_rejection_sample
+        :param M: number of samples, self.M if None
         :return:
         """
-        runs = []
-        actions = []
-
+        if M is None:
+            M = self.M
         if self._hp.stochastic_planning:
-            num_distinct_actions = self.M // self.smp_peract
+            num_distinct_actions = M // self.smp_peract
         else:
-            num_distinct_actions = self.M
-
-        for i in range(num_distinct_actions):
-            ok = False
-            i = 0
-            while not ok:
-                i +=1
-                action_seq = np.random.multivariate_normal(self.mean, self.sigma, 1)
-
-                action_seq = action_seq.reshape(self.naction_steps, self.adim)
-                xy_std = self._hp.initial_std
-                lift_std = self._hp.initial_std_lift
-
-                std_fac = 1.5
-                if np.any(action_seq[:, :2] > xy_std*std_fac) or \
-                        np.any(action_seq[:, :2] < -xy_std*std_fac) or \
-                        np.any(action_seq[:, 2] > lift_std*std_fac) or \
-                        np.any(action_seq[:, 2] < -lift_std*std_fac):
-                    ok = False
-                else: ok = True
-
-            runs.append(i)
-            actions.append(action_seq)
-        actions = np.stack(actions, axis=0)
+            num_distinct_actions = M
+
+        bound = self._sampling_bound()
+        actions, acceptance_rate = batch_rejection_sample(self.mean, self.cov, num_distinct_actions, bound)
+        actions = actions.reshape(num_distinct_actions, self.naction_steps, self.adim)
+        self.plan_stat['rej_acceptance_itr{}'.format(itr)] = acceptance_rate
 
         if self._hp.stochastic_planning:
             actions = np.repeat(actions,self._hp.stochastic_planning[0], 0)
 
-        self.logger.log('rejection smp max trials', max(runs))
+        self.logger.log('rejection smp acceptance rate', acceptance_rate)
         if self._hp.discrete_ind != None:
-            actions = self.discretize(actions)
+            actions = discretize(actions, actions.shape[0], self.naction_steps, self._hp.discrete_ind)
         actions = np.repeat(actions, self.repeat, axis=1)
 
         self.logger.log('max action val xy', np.max(actions[:,:,:2]))
         self.logger.log('max action val z', np.max(actions[:,:,2]))
         return actions
 
+    def _sampling_bound(self):
+        """
+        :return: bound on the absolute value of the flattened action blocks, shape [nactions * adim]
+        """
+        std_fac = 1.5
+        bound = np.full(self.adim, np.inf)
+        bound[:2] = self._hp.initial_std * std_fac
+        bound[2] = self._hp.initial_std_lift * std_fac
+        return np.tile(bound, self.naction_steps)
+
     def action_preselection(self, actions, scores):
         actions = actions.reshape((self.M//self.smp_peract, self.smp_peract, self.naction_steps, self.repeat, self.adim))
         scores = scores.reshape((self.M//self.smp_peract, self.smp_peract))
@@ -325,6 +689,30 @@ class CEM_Controller_Base(Policy):
     def get_rollouts(self, actions, cem_itr, itr_times):
         raise NotImplementedError
 
+    def _may_stop_after(self, itr):
+        """
+        :return: True if itr may be the last iteration of the plan, the CEM loop only decides that after scoring it
+        """
+        if itr >= self.niter - 1:
+            return True
+        if self._hp.optimizer != 'cem':
+            return False
+        if self._hp.warmstart_iterations != -1 and itr + 1 >= self._hp.warmstart_iterations:
+            return True
+        return self._hp.adaptive_schedule and itr + 1 >= self._hp.schedule_min_iterations
+
+    def finish_plan(self, last_itr):
+        """
+        called after the last iteration of every plan, last_itr is smaller than niter - 1 if the loop stopped early
+        """
+        pass
+
+    def _plan(self):
+        span = self.timer.start('plan', t=self.t)
+        self.perform_CEM()
+        self.finish_plan(self.plan_stat['cem_iterations'] - 1)
+        self.plan_stat['plan_time'] = self.timer.stop(span)
+
     def act(self, t=None, i_tr=None):
         """
         Return a random action for a state.
@@ -344,17 +732,17 @@ class CEM_Controller_Base(Policy):
             if self._hp.use_first_plan:
                 self.logger.log('using actions of first plan, no replanning!!')
                 if t == 1:
-                    self.perform_CEM()
+                    self._plan()
                 action = self.bestaction_withrepeat[t]
             elif self._hp.replan_interval != -1:
                 if (t-1) % self._hp.replan_interval == 0:
                     self.last_replan = t
-                    self.perform_CEM()
+                    self._plan()
                 self.logger.log('last replan', self.last_replan)
                 self.logger.log('taking action of ', t - self.last_replan)
                 action = self.bestaction_withrepeat[t - self.last_replan]
             else:
-                self.perform_CEM()
+                self._plan()
                 action = self.bestaction[0]
                 self.logger.log('########')
                 self.logger.log('best action sequence: ')
@@ -6,22 +6,33 @@ from .cem_controller_base import CEM_Controller_Base
 from python_visual_mpc.visual_mpc_core.agent.general_agent import resize_store
 import ray
 import traceback
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
 
 
-@ray.remote
-class SimWorker(object):
+class SimRolloutWorker(object):
     def __init__(self):
         print('created worker')
         pass
 
     def create_sim(self, agentparams, reset_state, goal_pos, finalweight, len_pred,
-                   naction_steps, discrete_ind, action_bound, adim, repeat, initial_std):
+                   naction_steps, discrete_ind, action_bound, adim, repeat, initial_std, render=True):
+        """
+        :param render: if False the env skips rendering and rollouts only evaluate the distance score
+        """
         print('create sim')
         self.agentparams = agentparams
         self._goal_pos = goal_pos
         self.len_pred = len_pred
         self.finalweight = finalweight
         self.current_reset_state = reset_state
+        self.render = render
+        if not render:
+            env_type, env_params = self.agentparams['env']
+            env_params = copy.deepcopy(env_params)
+            env_params['skip_render'] = True
+            self.agentparams = copy.copy(agentparams)
+            self.agentparams['env'] = (env_type, env_params)
         env_type, env_params = self.agentparams['env']
         # env_params['verbose_dir'] = '/home/frederik/Desktop/'
         self.env = env_type(env_params, self.current_reset_state)
@@ -93,35 +104,130 @@ class SimWorker(object):
 
     def sim_rollout(self, curr_qpos, curr_qvel, actions):
         agent_data = {}
-        t = 0
-        done = False
         # initial_env_obs, _ = self.env.reset(curr_reset_state)
         initial_env_obs , _ = self.env.qpos_reset(curr_qpos, curr_qvel)
-        obs = self._post_process_obs(initial_env_obs, agent_data, initial_obs=True)
+        if self.render:
+            obs = self._post_process_obs(initial_env_obs, agent_data, initial_obs=True)
         costs = []
-        while not done:
-            # print('inner sim step', t)
-            obs = self._post_process_obs(self.env.step(actions[t]), agent_data)
-            if (self.len_pred - 1) == t:
-                done = True
-            t += 1
+        for t in range(self.len_pred):
+            env_obs = self.env.step(actions[t])
+            if self.render:
+                obs = self._post_process_obs(env_obs, agent_data)
             costs.append(self.eval_action())
+        if not self.render:
+            return costs, None
         return costs, obs['images']
 
     def perform_rollouts(self, curr_qpos, curr_qvel, actions, M):
+        """
+        :return: images (None if render is off), scores
+        """
         all_scores = np.empty(M, dtype=np.float64)
         image_list = []
 
+        per_time_multiplier = np.ones([self.len_pred])
+        per_time_multiplier[-1] = self.finalweight
         for smp in range(M):
             score, images = self.sim_rollout(curr_qpos, curr_qvel, actions[smp])
-            image_list.append(images.squeeze())
-            # print('score', score)
-            per_time_multiplier = np.ones([len(score)])
-            per_time_multiplier[-1] = self.finalweight
+            if self.render:
+                image_list.append(images.squeeze())
             all_scores[smp] = np.sum(per_time_multiplier*score)
 
+        if not self.render:
+            return None, all_scores
         images = np.stack(image_list, 0)[:,1:].astype(np.float32)/255.
-        return images, np.stack(all_scores, 0)
+        return images, all_scores
+
+
+SimWorker = ray.remote(SimRolloutWorker)
+
+
+def _pool_worker(worker_id, task_queue, done_queue, actions_buf, scores_buf, action_shape):
+    """
+    keeps one SimRolloutWorker alive across CEM iterations, actions are read from and scores written to shared memory
+    """
+    actions = np.frombuffer(actions_buf, dtype=np.float64).reshape(action_shape)
+    scores = np.frombuffer(scores_buf, dtype=np.float64)
+    worker = SimRolloutWorker()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        try:
+            if task[0] == 'create':
+                worker.create_sim(*task[1])
+                done_queue.put((worker_id, None, None))
+            else:
+                _, curr_qpos, curr_qvel, start, stop = task
+                images, scores[start:stop] = worker.perform_rollouts(curr_qpos, curr_qvel, actions[start:stop],
+                                                                     stop - start)
+                done_queue.put((worker_id, None, images))
+        except Exception:
+            done_queue.put((worker_id, traceback.format_exc(), None))
+
+
+class SimRolloutPool(object):
+    """
+    Persistent worker processes each holding a preloaded simulator. The action samples are written to a shared array
+    that every worker slices, the scores come back through a second shared array, only images (when rendering) go
+    through the result queue.
+    """
+    def __init__(self, nworkers, max_samples, len_pred, adim):
+        self.nworkers = nworkers
+        self._action_shape = (max_samples, len_pred, adim)
+        actions_buf = RawArray('d', max_samples * len_pred * adim)
+        scores_buf = RawArray('d', max_samples)
+        self._actions = np.frombuffer(actions_buf, dtype=np.float64).reshape(self._action_shape)
+        self._scores = np.frombuffer(scores_buf, dtype=np.float64)
+
+        self._task_queues = [mp.Queue() for _ in range(nworkers)]
+        self._done_queue = mp.Queue()
+        self._procs = []
+        for i in range(nworkers):
+            p = mp.Process(target=_pool_worker, args=(i, self._task_queues[i], self._done_queue, actions_buf,
+                                                      scores_buf, self._action_shape))
+            p.daemon = True
+            p.start()
+            self._procs.append(p)
+
+    def _gather(self, nresults):
+        results = {}
+        for _ in range(nresults):
+            worker_id, error, images = self._done_queue.get()
+            if error is not None:
+                raise RuntimeError('rollout worker {} failed:\n{}'.format(worker_id, error))
+            results[worker_id] = images
+        return results
+
+    def create_sim(self, *create_args):
+        """
+        (re)creates the simulator of every worker, takes the arguments of SimRolloutWorker.create_sim
+        """
+        for q in self._task_queues:
+            q.put(('create', create_args))
+        self._gather(self.nworkers)
+
+    def perform_rollouts(self, curr_qpos, curr_qvel, actions):
+        M = actions.shape[0]
+        assert M <= self._action_shape[0], 'pool was created for at most {} samples'.format(self._action_shape[0])
+        self._actions[:M] = actions
+
+        bounds = np.linspace(0, M, self.nworkers + 1).astype(np.int64)
+        active = [i for i in range(self.nworkers) if bounds[i + 1] > bounds[i]]
+        for i in active:
+            self._task_queues[i].put(('rollout', curr_qpos, curr_qvel, bounds[i], bounds[i + 1]))
+        results = self._gather(len(active))
+
+        scores = self._scores[:M].copy()
+        if results[active[0]] is None:
+            return None, scores
+        return np.concatenate([results[i] for i in active], axis=0), scores
+
+    def close(self):
+        for q in self._task_queues:
+            q.put(None)
+        for p in self._procs:
+            p.join()
 
 
 class CEM_Controller_Sim(CEM_Controller_Base):
@@ -132,13 +238,16 @@ class CEM_Controller_Sim(CEM_Controller_Base):
         super(CEM_Controller_Sim, self).__init__(ag_params, policyparams)
         self.parallel = True
         # self.parallel = False
-        if self.parallel:
+        self._pool = None
+        if self.parallel and not self._hp.rollout_pool:
             ray.init()
 
     def _default_hparams(self):
         default_dict = {
             'len_pred':15,
             'num_workers':10,
+            'rollout_pool':True,        # persistent process pool with shared memory scores, uses ray if False
+            'render_rollouts':True,     # if False rollouts are not rendered and only the distance score is evaluated
         }
 
         parent_params = super()._default_hparams()
@@ -148,6 +257,15 @@ class CEM_Controller_Sim(CEM_Controller_Base):
         return parent_params
 
     def create_sim(self):
+        create_args = (self.agentparams, self.curr_sim_state, self.goal_pos, self._hp.finalweight, self.len_pred,
+                       self.naction_steps, self._hp.discrete_ind, self._hp.action_bound, self.adim, self.repeat,
+                       self._hp.initial_std, self._hp.render_rollouts)
+        if self._hp.rollout_pool:
+            if self._pool is None:
+                self._pool = SimRolloutPool(self._hp.num_workers, self._max_samples(), self.len_pred, self.adim)
+            self._pool.create_sim(*create_args)
+            return
+
         self.workers = []
         if self.parallel:
             self.n_worker = self._hp.num_workers
@@ -158,16 +276,14 @@ class CEM_Controller_Sim(CEM_Controller_Base):
             if self.parallel:
                 self.workers.append(SimWorker.remote())
             else:
-                self.workers.append(SimWorker())
+                self.workers.append(SimRolloutWorker())
 
         id_list = []
         for i, worker in enumerate(self.workers):
             if self.parallel:
-                id_list.append(worker.create_sim.remote(self.agentparams, self.curr_sim_state, self.goal_pos, self._hp.finalweight, self.len_pred,
-                                                        self.naction_steps, self._hp.discrete_ind, self._hp.action_bound, self.adim, self.repeat, self._hp.initial_std))
+                id_list.append(worker.create_sim.remote(*create_args))
             else:
-                return worker.create_sim(self.agentparams, self.curr_sim_state, self.goal_pos, self._hp.finalweight, self.len_pred,
-                                         self.naction_steps, self._hp.discrete_ind, self._hp.action_bound, self.adim, self.repeat, self._hp.initial_std)
+                return worker.create_sim(*create_args)
         if self.parallel:
             # blocking call
             for id in id_list:
@@ -175,10 +291,14 @@ class CEM_Controller_Sim(CEM_Controller_Base):
 
 
     def get_rollouts(self, actions, cem_itr, itr_times):
+        span = self.timer.start('predict', itr=cem_itr)
         images, all_scores = self.sim_rollout_parallel(actions)
+        self.timer.stop(span)
 
-        if self.verbose:
+        if self.verbose and images is not None:
+            span = self.timer.start('visualize', itr=cem_itr)
             self.save_gif(images, all_scores, cem_itr)
+            self.timer.stop(span)
         return all_scores
 
     def save_gif(self, images, all_scores, cem_itr):
@@ -195,6 +315,10 @@ class CEM_Controller_Sim(CEM_Controller_Base):
 
 
     def sim_rollout_parallel(self, actions):
+        if self._hp.rollout_pool:
+            images, scores_mjc = self._pool.perform_rollouts(self.qpos_full, self.qvel_full, actions)
+            return images, self.get_scores(images, scores_mjc)
+
         per_worker = int(self.M / np.float32(self.n_worker))
         id_list = []
         for i, worker in enumerate(self.workers):
@@ -212,7 +336,10 @@ class CEM_Controller_Sim(CEM_Controller_Base):
                 image_list.append(images)
                 scores_list.append(scores_mjc)
             scores_mjc = np.concatenate(scores_list, axis=0)
-            images = np.concatenate(image_list, axis=0)
+            if image_list[0] is not None:
+                images = np.concatenate(image_list, axis=0)
+            else:
+                images = None
 
         scores = self.get_scores(images, scores_mjc)
         return images, scores
@@ -21,6 +21,7 @@ class CEM_Controller_Sim_GoalImage(CEM_Controller_Sim):
     """
     def __init__(self, ag_params, policyparams, gpu_id, ngpu):
         super().__init__(ag_params, policyparams, gpu_id, ngpu)
+        assert self._hp.render_rollouts, 'the image based cost needs rendered rollouts'
 
     def _default_hparams(self):
         default_dict = {
@@ -17,7 +17,12 @@ else:
     from queue import Queue
 import time
 from .utils.cem_controller_utils import save_track_pkl
+from .utils.pixel_cost import DistanceGridCache, expected_distance_costs
+from .utils.planning_costs import action_costs, extra_costs
 from .cem_controller_base import CEM_Controller_Base
+from python_visual_mpc.video_prediction.predictor_server import setup_predictor_client
+from python_visual_mpc.video_prediction.predictor_pool import PredictorPool, replica_confs
+from python_visual_mpc.video_prediction.utils_vpred.output_fetches import call_predictor
 
 
 verbose_queue = Queue()
@@ -33,6 +38,36 @@ def verbose_worker():
             print("TKINTER ERROR, SKIPPING")
         req += 1
 
+class ScoringThread(Thread):
+    """
+    runs a scoring function in the background, exceptions are re-raised in the thread calling join
+    """
+    def __init__(self, target, *args):
+        super(ScoringThread, self).__init__()
+        self._target_fn, self._args = target, args
+        self._exception = None
+
+    def run(self):
+        try:
+            self._target_fn(*self._args)
+        except Exception as e:
+            self._exception = e
+
+    def join(self, timeout=None):
+        super(ScoringThread, self).join(timeout)
+        if self._exception is not None:
+            raise self._exception
+
+
+def preallocate_outputs(chunk, M):
+    """
+    allocates the array the predictor outputs of all runs are written to
+    """
+    if chunk is None:
+        return None
+    return np.empty((M,) + chunk.shape[1:], dtype=chunk.dtype)
+
+
 class VisualzationData():
     def __init__(self):
         """
@@ -60,9 +95,15 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
 
         params = imp.load_source('params', ag_params['current_dir'] + '/conf.py')
         self.netconf = params.configuration
-        self.predictor = self.netconf['setup_predictor'](ag_params, self.netconf, gpu_id, ngpu, self.logger)
-
         self.bsize = self.netconf['batch_size']
+        self._replicas = None
+        if self._hp.predictor_replicas or self._hp.replica_checkpoints:
+            self.predictor = None
+        elif self._hp.predictor_server:
+            self.netconf['predictor_server'] = self._hp.predictor_server
+            self.predictor = setup_predictor_client(ag_params, self.netconf, gpu_id, ngpu, self.logger)
+        else:
+            self.predictor = self.netconf['setup_predictor'](ag_params, self.netconf, gpu_id, ngpu, self.logger)
 
         self.seqlen = self.netconf['sequence_length']
 
@@ -75,6 +116,9 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
 
         self.ncontxt = self.netconf['context_frames']
 
+        if self.predictor is None:
+            self._replicas = self._setup_replicas(ag_params, gpu_id)
+
         if 'ndesig' in self.netconf:        # total number of
             self.ndesig = self.netconf['ndesig']
         else: self.ndesig = None
@@ -94,12 +138,17 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
 
         if self._hp.predictor_propagation:
             self.rec_input_distrib = []  # record the input distributions
+        self._best_gen_distrib = None
 
         self.parallel_vis = True
-        if self.parallel_vis:
+        if self.parallel_vis and (self.verbose or self._hp.verbose_every_itr):
+            # the worker blocks on verbose_queue forever, only start it if anything will be visualized
             self._thread = Thread(target=verbose_worker)
             self._thread.start()
         self.goal_image = None
+        self._action_costs = None
+        self._ensemble_std = None
+        self._encoded_context = None   # (i_tr, t) of the context the predictor has cached
 
         self.best_cost_perstep = np.zeros([self.ncam, self.ndesig, self.seqlen])
 
@@ -108,6 +157,7 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
         self.visualizer = CEM_Visual_Preparation()
 
         self.reg_tradeoff = np.ones([self.ncam, self.ndesig])/self.ncam/self.ndesig
+        self._distance_grids = DistanceGridCache(self._hp.distance_grid_cache_size, self.logger)
 
     def _setup_visualizer(self, default=CEM_Visual_Preparation):
         run_freq = 1
@@ -115,6 +165,9 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
             run_freq = 3
         self.visualizer = self.policyparams.get('visualizer', default)(run_freq)
 
+    def _sample_batch(self):
+        return self.bsize
+
     def _default_hparams(self):
         default_dict = {
             'predictor_propagation':False,
@@ -122,7 +175,15 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
             'only_take_first_view':False,
             'extra_score_functions': [None],
             'pixel_score_weight': 1.,
-            'extra_score_weight': 1.
+            'extra_score_weight': 1.,
+            'action_cost_factor': 0.,   # weight of the summed squared action norms added to the score
+            'distance_grid_cache_size': 64,   # number of distance grids kept in the LRU cache
+            'pipeline_rollouts': False,   # score the outputs of run k on a worker thread while run k+1 is predicted
+            'predictor_server': '',   # unix socket of a running predictor_server, if empty the model is built in-process
+            'predictor_replicas': 0,   # number of predictor processes the samples are split over, 0 predicts in-process
+            'replica_checkpoints': [],   # one replica per checkpoint, every replica scores all samples (ensemble)
+            'replica_threads': 0,   # TensorFlow threads per replica, 0 keeps the TensorFlow default
+            'ensemble_std_weight': 0.,   # adds weight * std of the replicas' scores, penalizes uncertain predictions
         }
         parent_params = super(CEM_Controller_Vidpred, self)._default_hparams()
 
@@ -132,31 +193,42 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
 
     def reset(self):
         super(CEM_Controller_Vidpred, self).reset()
+        self._encoded_context = None
         if self._hp.predictor_propagation:
             self.rec_input_distrib = []  # record the input distributions
 
     def calc_action_cost(self, actions):
-        actions_costs = np.zeros(self.M)
-        for smp in range(self.M):
-            force_magnitudes = np.array([np.linalg.norm(actions[smp, t]) for
-                                         t in range(self.naction_steps * self.repeat)])
-            actions_costs[smp]=np.sum(np.square(force_magnitudes)) * self._hp.action_cost_factor
-        return actions_costs
+        return action_costs(actions, self._hp.action_cost_factor)
 
     def switch_on_pix(self, desig):
         one_hot_images = np.zeros((1, self.netconf['context_frames'], self.ncam, self.img_height, self.img_width, self.ndesig), dtype=np.float32)
         desig = np.clip(desig, np.zeros(2).reshape((1, 2)), np.array([self.img_height, self.img_width]).reshape((1, 2)) - 1).astype(np.int)
-        # switch on pixels
-        for icam in range(self.ncam):
-            for p in range(self.ndesig):
-                one_hot_images[:, :, icam, desig[icam, p, 0], desig[icam, p, 1], p] = 1.
-                self.logger.log('using desig pix',desig[icam, p, 0], desig[icam, p, 1])
+        # switch on the pixels of all cameras and designated pixels at once
+        icam, p = np.meshgrid(np.arange(self.ncam), np.arange(self.ndesig), indexing='ij')
+        one_hot_images[:, :, icam, desig[..., 0], desig[..., 1], p] = 1.
+        self.logger.log('using desig pix', desig.tolist())
 
         return one_hot_images
 
+    def _setup_replicas(self, ag_params, gpu_id):
+        assert self._hp.extra_score_functions[0] is None and not self._hp.predictor_propagation, \
+            "predictor replicas only return the pixel-distance costs"
+        conf = copy.deepcopy(self.netconf)
+        if self._hp.replica_threads:
+            conf['num_threads'] = self._hp.replica_threads
+        confs = replica_confs(conf, self._hp.predictor_replicas, self._hp.replica_checkpoints)
+        return PredictorPool(confs, ag_params, self._max_samples(), ensemble=bool(self._hp.replica_checkpoints),
+                             gpu_id=gpu_id, logger=self.logger)
+
     def get_rollouts(self, actions, cem_itr, itr_times):
+        self._action_costs = self.calc_action_cost(actions) if self._hp.action_cost_factor > 0 else None
+        if self._replicas is not None:
+            return self.replica_rollouts(actions, cem_itr, itr_times)
+        span = self.timer.start('prepare', itr=cem_itr)
         actions, last_frames, last_states, t_0 = self.prep_vidpred_inp(actions, cem_itr)
         input_distrib = self.make_input_distrib(cem_itr)
+        self.timer.stop(span)
+        context_kwargs = self.reuse_context(last_frames, last_states, input_distrib)
 
         t_startpred = time.time()
         if self.M > self.bsize:
@@ -165,34 +237,60 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
         else:
             nruns = 1
             assert self.M == self.bsize
-        gen_images_l, gen_distrib_l, gen_states_l = [], [], []
         itr_times['pre_run'] = time.time() - t_0
+
+        # scoring chunk k on a worker thread while chunk k+1 is predicted only works for the pixel-distance cost
+        pipelined = self._hp.pipeline_rollouts and nruns > 1 and \
+                    type(self).eval_planningcost == CEM_Controller_Vidpred.eval_planningcost
+        if pipelined:
+            scores_per_task = np.empty((self.M, self.ncam * self.ndesig))
+        scorer = None
+        fetches = self.rollout_fetches(cem_itr)
+        gen_images, gen_distrib, gen_states = None, None, None
         for run in range(nruns):
             self.logger.log('run{}'.format(run))
             t_run_loop = time.time()
-            actions_ = actions[run*self.bsize:(run+1)*self.bsize]
-
-            gen_images, gen_distrib, gen_states, _ = self.predictor(input_images=last_frames,
-                                                                    input_state=last_states,
-                                                                    input_actions=actions_,
-                                                                    input_one_hot_images=input_distrib)
-            gen_images_l.append(gen_images)
-            gen_distrib_l.append(gen_distrib)
-            gen_states_l.append(gen_states)
+            rows = slice(run*self.bsize, (run+1)*self.bsize)
+
+            span = self.timer.start('predict', itr=cem_itr, run=run)
+            gen_images_, gen_distrib_, gen_states_, _ = call_predictor(self.predictor, fetches,
+                                                                       input_images=last_frames,
+                                                                       input_state=last_states,
+                                                                       input_actions=actions[rows],
+                                                                       input_one_hot_images=input_distrib,
+                                                                       **context_kwargs)
+            self.timer.stop(span)
+            span = self.timer.start('concatenate', itr=cem_itr, run=run)
+            if nruns == 1:
+                gen_images, gen_distrib, gen_states = gen_images_, gen_distrib_, gen_states_
+            else:
+                if run == 0:
+                    gen_images, gen_distrib, gen_states = [preallocate_outputs(o, self.M) for o in
+                                                           (gen_images_, gen_distrib_, gen_states_)]
+                for out, out_ in zip((gen_images, gen_distrib, gen_states), (gen_images_, gen_distrib_, gen_states_)):
+                    if out is not None:
+                        out[rows] = out_
+            self.timer.stop(span)
+
+            if pipelined:
+                if scorer is not None:
+                    scorer.join()
+                scorer = ScoringThread(self._score_chunk, scores_per_task, gen_distrib, rows)
+                scorer.start()
             itr_times['run{}'.format(run)] = time.time() - t_run_loop
-        t_run_post = time.time()
-        gen_images = np.concatenate(gen_images_l, 0)
-        gen_distrib = np.concatenate(gen_distrib_l, 0)
-        if gen_states_l[0] is not None:
-            gen_states = np.concatenate(gen_states_l, 0)
-        itr_times['t_concat'] = time.time() - t_run_post
         self.logger.log('time for videoprediction {}'.format(time.time() - t_startpred))
         t_run_post = time.time()
+        span = self.timer.start('score', itr=cem_itr)
 
-        scores = self.eval_planningcost(cem_itr, gen_distrib, gen_images)
+        if pipelined:
+            scorer.join()
+            itr_times['wait_for_scorer'] = time.time() - t_run_post
+            scores = self.combine_planningcost(cem_itr, scores_per_task, gen_distrib, gen_images)
+        else:
+            scores = self.eval_planningcost(cem_itr, gen_distrib, gen_images)
 
-        itr_times['run_post'] = time.time() - t_run_post
-        tstart_verbose = time.time()
+        itr_times['run_post'] = self.timer.stop(span)
+        span = self.timer.start('visualize', itr=cem_itr)
 
         self.vd.t = self.t
         self.vd.scores = scores
@@ -209,13 +307,8 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
         self.vd.ncam = self.ncam
         self.vd.image_height = self.img_height
 
-        if self.verbose and cem_itr == self._hp.iterations-1 and self.i_tr % self.verbose_freq ==0 or \
-                (self._hp.verbose_every_itr and self.i_tr % self.verbose_freq ==0):
-            if self.parallel_vis:
-                print('t{} cemitr {}'.format(self.t, cem_itr))
-                verbose_queue.put((self.visualizer, copy.deepcopy(self.vd)))
-            else:
-                self.visualizer.visualize(self.vd)
+        if self._hp.verbose_every_itr and self.i_tr % self.verbose_freq == 0:
+            self._visualize(cem_itr)
 
         if 'save_desig_pos' in self.agentparams:
             save_track_pkl(self, self.t, cem_itr)
@@ -223,28 +316,124 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
         if 'sawyer' in self.agentparams:
             bestind = self.publish_sawyer(gen_distrib, gen_images, scores)
 
-        itr_times['verbose_time'] = time.time() - tstart_verbose
-        self.logger.log('verbose time', time.time() - tstart_verbose)
+        itr_times['verbose_time'] = self.timer.stop(span)
+        self.logger.log('verbose time', itr_times['verbose_time'])
+
+        return scores
+
+    def reuse_context(self, last_frames, last_states, input_distrib):
+        """
+        with predictors that cache the context encoding (netconf 'cache_context') the context is encoded once per
+        control step, all iterations and runs of perform_CEM predict from it
+        :return: keyword arguments for the predictor calls
+        """
+        if not hasattr(self.predictor, 'encode_context'):
+            return {}
+        if self._encoded_context != (self.i_tr, self.t):
+            span = self.timer.start('encode_context')
+            self.predictor.encode_context(input_images=last_frames, input_one_hot_images=input_distrib,
+                                          input_state=last_states)
+            self.timer.stop(span)
+            self._encoded_context = (self.i_tr, self.t)
+        return {'reuse_context': True}
+
+    def _visualize(self, cem_itr):
+        if self.parallel_vis:
+            print('t{} cemitr {}'.format(self.t, cem_itr))
+            verbose_queue.put((self.visualizer, copy.deepcopy(self.vd)))
+        else:
+            self.visualizer.visualize(self.vd)
+
+    def visualize_itr(self, cem_itr):
+        """
+        :return: True if iteration cem_itr may be visualized, i.e. every iteration with verbose_every_itr and otherwise
+        every iteration the plan may end with
+        """
+        return self.verbose and self._may_stop_after(cem_itr) and self.i_tr % self.verbose_freq ==0 or \
+                (self._hp.verbose_every_itr and self.i_tr % self.verbose_freq ==0)
 
+    def finish_plan(self, last_itr):
+        """
+        visualizes the last iteration and records the propagated distribution of the plan's best action, the CEM loop
+        may stop before iteration iterations - 1
+        """
+        if self.verbose and not self._hp.verbose_every_itr and self.i_tr % self.verbose_freq == 0:
+            self._visualize(last_itr)
+        if self._hp.predictor_propagation:
+            self.rec_input_distrib.append(self._best_gen_distrib)
+
+    def rollout_fetches(self, cem_itr):
+        """
+        :return: names of the predictor outputs scoring and visualizing iteration cem_itr reads, the predicted images
+        are only fetched if they are visualized, published or scored
+        """
+        fetches = ['gen_distrib']
+        if self.visualize_itr(cem_itr) or 'sawyer' in self.agentparams or \
+                self._hp.extra_score_functions[0] is not None or \
+                type(self).eval_planningcost != CEM_Controller_Vidpred.eval_planningcost:
+            fetches.append('gen_images')
+        return fetches
+
+    def replica_rollouts(self, actions, cem_itr, itr_times):
+        """
+        predicts and scores the samples on the predictor replicas, only the per-step pixel-distance costs come back so
+        nothing is visualized
+        """
+        actions, last_frames, last_states, t_0 = self.prep_vidpred_inp(actions, cem_itr)
+        input_distrib = self.make_input_distrib(cem_itr)
+        distance_grids = self._distance_grids.get_stacked(self.goal_pix, self.img_height, self.img_width)
+        itr_times['pre_run'] = time.time() - t_0
+
+        span = self.timer.start('predict', itr=cem_itr, replicas=self._replicas.nreplicas)
+        costs, latencies = self._replicas.predict_costs(actions, distance_grids, True, last_frames, last_states,
+                                                        input_distrib)
+        t_pred = self.timer.stop(span)
+        for i in sorted(latencies):
+            itr_times['replica{}'.format(i)] = latencies[i]
+        self.plan_stat['replica_latency_itr{}'.format(cem_itr)] = [latencies[i] for i in sorted(latencies)]
+        self.logger.log('time for videoprediction on {} replicas {}'.format(len(latencies), t_pred))
+
+        span = self.timer.start('score', itr=cem_itr)
+        M = actions.shape[0]
+        self.cost_perstep[:M] = np.transpose(np.mean(costs, axis=0), [0, 2, 3, 1])
+        scores_per_replica = self.weight_steps(costs)   # shape nreplicas, M, ncam, ndesig
+        if self._hp.trade_off_reg:
+            scores_per_replica *= self.reg_tradeoff[None, None]
+        scores_per_replica = scores_per_replica.reshape(costs.shape[0], M, self.ncam * self.ndesig)
+
+        self._ensemble_std = None
+        if costs.shape[0] > 1 and self._hp.ensemble_std_weight > 0:
+            self._ensemble_std = np.std(np.mean(scores_per_replica, axis=2), axis=0)
+        scores = self.combine_planningcost(cem_itr, np.mean(scores_per_replica, axis=0), None, None)
+        itr_times['run_post'] = self.timer.stop(span)
         return scores
 
     def eval_planningcost(self, cem_itr, gen_distrib, gen_images):
+        scores_per_task = self.pixel_scores_per_task(gen_distrib)
+        return self.combine_planningcost(cem_itr, scores_per_task, gen_distrib, gen_images)
 
+    def pixel_scores_per_task(self, gen_distrib, rows=slice(None)):
+        """
+        :param gen_distrib: shape [batch, t, ncam, r, c, ndesig], rows of the current samples given by rows
+        :return: scores of shape [batch, ncam * ndesig]
+        """
+        distance_grids = self._distance_grids.get_stacked(self.goal_pix, self.img_height, self.img_width)
+        scores_per_task = self.calc_scores(gen_distrib, distance_grids, normalize=True, rows=rows)
+        if self._hp.trade_off_reg:
+            scores_per_task *= self.reg_tradeoff[None]
+        return scores_per_task.reshape(scores_per_task.shape[0], self.ncam * self.ndesig)
+
+    def _score_chunk(self, scores_per_task, gen_distrib, rows):
+        span = self.timer.start('score_chunk', first_row=rows.start)
+        scores_per_task[rows] = self.pixel_scores_per_task(gen_distrib[rows], rows)
+        self.timer.stop(span)
+
+    def combine_planningcost(self, cem_itr, scores_per_task, gen_distrib, gen_images):
         t_startcalcscores = time.time()
-        scores_per_task = []
-
         for icam in range(self.ncam):
             for p in range(self.ndesig):
-                distance_grid = self.get_distancegrid(self.goal_pix[icam, p])
-                score = self.calc_scores(icam, p, gen_distrib[:, :, icam, :, :, p], distance_grid,
-                                         normalize=True)
-                if self._hp.trade_off_reg:
-                    score *= self.reg_tradeoff[icam, p]
-                scores_per_task.append(score)
                 self.logger.log(
-                    'best flow score of task {} cam{}  :{}'.format(p, icam, np.min(scores_per_task[-1])))
-
-        scores_per_task = np.stack(scores_per_task, axis=1)
+                    'best flow score of task {} cam{}  :{}'.format(p, icam, np.min(scores_per_task[:, p + icam * self.ndesig])))
 
         if self._hp.only_take_first_view:
             scores_per_task = scores_per_task[:, 0][:, None]
@@ -252,27 +441,18 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
         scores = np.mean(scores_per_task, axis=1)
 
         if self._hp.extra_score_functions[0] is not None:
-            batches, T, ncams, height, width, channels = gen_images.shape
-            extra_costs = np.zeros((batches))
             score_std, score_mean = np.std(scores), np.mean(scores)
-
-            for cost in self._hp.extra_score_functions:
-                c_score = np.zeros((batches, T))
-                for t in range(T):
-                    if self.goal_image is None:
-                        c_score[:, t] = cost.score(images=gen_images[:, t])
-                    else:
-                        c_score[:, t] = cost.score(images=gen_images[:, t], goal_images=self.goal_image)
-
-                c_score[:, -1] *= self._hp.finalweight
-                c_score = np.sum(c_score, 1)
-                if score_std > 0 and score_mean > 0 and self._hp.pixel_score_weight > 0:
-                    old_std, old_mean = np.std(c_score), np.mean(c_score)
-                    c_score = score_std * ((c_score - old_mean) / old_std) + score_mean
-                extra_costs += c_score
-
-            print('best extra costs: {}'.format(np.amin(extra_costs)))
-            scores = self._hp.pixel_score_weight * scores + self._hp.extra_score_weight * extra_costs
+            if self._hp.pixel_score_weight <= 0:
+                score_std = 0.   # nothing to match the extra costs to
+            extra = extra_costs(self._hp.extra_score_functions, gen_images, self.goal_image, self._hp.finalweight,
+                                score_std, score_mean)
+            print('best extra costs: {}'.format(np.amin(extra)))
+            scores = self._hp.pixel_score_weight * scores + self._hp.extra_score_weight * extra
+
+        if self._action_costs is not None:
+            scores = scores + self._action_costs
+        if self._ensemble_std is not None:
+            scores = scores + self._hp.ensemble_std_weight * self._ensemble_std
 
         bestind = scores.argsort()[0]
         for icam in range(self.ncam):
@@ -280,15 +460,13 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
                 self.logger.log('flow score of best traj for task{} cam{} :{}'.format(p, icam, scores_per_task[
                     bestind, p + icam * self.ndesig]))
 
-        self.best_cost_perstep = self.cost_perstep[bestind]
+        self.best_cost_perstep = self.cost_perstep[:self.M][bestind]
 
         if self._hp.predictor_propagation:
-            if cem_itr == (self._hp.iterations - 1):
-                # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
-                bestind = scores.argsort()[0]
-                best_gen_distrib = gen_distrib[bestind, self.ncontxt].reshape(1, self.ncam, self.img_height,
-                                                                              self.img_width, self.ndesig)
-                self.rec_input_distrib.append(best_gen_distrib)
+            # finish_plan records the prop distrib of the action actually chosen after the last iteration (i.e.
+            # self.indices[0]), which iteration is the last one is only known once the CEM loop has ended
+            self._best_gen_distrib = gen_distrib[bestind, self.ncontxt].reshape(1, self.ncam, self.img_height,
+                                                                                self.img_width, self.ndesig).copy()
         self.logger.log('time to calc scores {}'.format(time.time() - t_startcalcscores))
         return scores
 
@@ -330,38 +508,30 @@ class CEM_Controller_Vidpred(CEM_Controller_Base):
         return bestind
 
 
-    def calc_scores(self, icam, idesig, gen_distrib, distance_grid, normalize=True):
+    def calc_scores(self, gen_distrib, distance_grids, normalize=True, rows=slice(None)):
         """
-        :param gen_distrib: shape [batch, t, r, c]
-        :param distance_grid: shape [r, c]
-        :return:
+        :param gen_distrib: shape [batch, t, ncam, r, c, ndesig]
+        :param distance_grids: shape [ncam, ndesig, r, c]
+        :param rows: rows of the current self.M samples corresponding to the samples in gen_distrib
+        :return: scores of shape [batch, ncam, ndesig]
+        """
+        assert len(gen_distrib.shape) == 6
+        costs = expected_distance_costs(gen_distrib, distance_grids, normalize)   # shape b, t, ncam, ndesig
+        # cost_perstep is allocated for the first iteration, later iterations may evaluate fewer samples
+        self.cost_perstep[:self.M][rows] = np.transpose(costs, [0, 2, 3, 1])
+        return self.weight_steps(costs)
+
+    def weight_steps(self, costs):
+        """
+        :param costs: shape [..., t, ncam, ndesig]
+        :return: average over time with the last step weighted by finalweight, shape [..., ncam, ndesig]
         """
-        assert len(gen_distrib.shape) == 4
         t_mult = np.ones([self.seqlen - self.netconf['context_frames']])
         t_mult[-1] = self._hp.finalweight
-
-        gen_distrib = gen_distrib.copy()
-        #normalize prob distributions
-        if normalize:
-            gen_distrib /= np.sum(np.sum(gen_distrib, axis=2), 2)[:,:, None, None]
-        gen_distrib *= distance_grid[None, None]
-        scores = np.sum(np.sum(gen_distrib, axis=2),2)
-        self.cost_perstep[:,icam, idesig] = scores
-        scores *= t_mult[None]
-        scores = np.sum(scores, axis=1)/np.sum(t_mult)
-        return scores
+        return np.sum(costs * t_mult[:, None, None], axis=-3)/np.sum(t_mult)
 
     def get_distancegrid(self, goal_pix):
-        distance_grid = np.empty((self.img_height, self.img_width))
-        for i in range(self.img_height):
-            for j in range(self.img_width):
-                pos = np.array([i, j])
-                distance_grid[i, j] = np.linalg.norm(goal_pix - pos)
-
-        self.logger.log('making distance grid with goal_pix', goal_pix)
-        # plt.imshow(distance_grid, zorder=0, cmap=plt.get_cmap('jet'), interpolation='none')
-        # plt.show()
-        return distance_grid
+        return self._distance_grids.get(goal_pix, self.img_height, self.img_width)
 
     def make_input_distrib(self, itr):
         if self._hp.predictor_propagation:  # using the predictor's DNA to propagate, no correction
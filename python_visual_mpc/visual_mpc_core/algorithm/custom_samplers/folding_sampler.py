@@ -1,5 +1,6 @@
 import copy
 import numpy as np
+from python_visual_mpc.visual_mpc_core.algorithm.utils import action_processing
 
 
 class FoldingSampler:
@@ -18,64 +19,43 @@ class FoldingSampler:
     def sample(self, M, current_state):
         assert M % 3 == 0, "splits samples into setting with 3 means"
         ret_actions = np.zeros((M, self._steps, self._adim))
-        per_split, current_state = M / 3, current_state[-1, :2]
+        per_split, current_state = M // 3, current_state[-1, :2]
 
         lower_sigma = copy.deepcopy(self._base_sigma)
         lower_sigma[:2, :2] /= 10
         lower_sigma[3, 3] /= 2
 
-        for i in range(per_split):
-            first_pnt, second_pnt = np.random.uniform(size=2), np.random.uniform(size=2)
-
-            delta_first, delta_second = (first_pnt - current_state) / self._repeat, \
-                                        (second_pnt - first_pnt) / self._repeat
-
-            mean = np.array([delta_first[0], delta_first[1], 1, 0.])
-            ret_actions[i, 0] = np.random.multivariate_normal(mean, self._base_sigma, 1).reshape(-1)
-
-            mean = np.array([0, 0., -1, 0])
-            ret_actions[i, 1] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
-
-            mean = np.array([0, 0., 1, 0])
-            ret_actions[i, 2] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
-
-            mean = np.array([delta_second[0], delta_second[1], 1, 0])
-            ret_actions[i, 3] = np.random.multivariate_normal(mean, self._base_sigma, 1).reshape(-1)
-
-            mean = np.array([0, 0., -1, 0])
-            ret_actions[i, 4] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
-
-            if self._steps > 5:
-                ret_actions[i, self._steps:] = np.random.multivariate_normal(np.zeros(4), self._base_sigma,
-                                                                             self._steps - 5)
-
-        for i in range(per_split, 2 * per_split):
-            second_pnt = np.random.uniform(size=2)
-
-            delta_second = (second_pnt - current_state) / self._repeat
-
-            mean = np.array([0, 0, 1, 0.])
-            ret_actions[i, 0] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
-
-            mean = np.array([delta_second[0], delta_second[1], 1, 0])
-            ret_actions[i, 1] = np.random.multivariate_normal(mean, self._base_sigma, 1).reshape(-1)
-
-            mean = np.array([0, 0., -1, 0])
-            ret_actions[i, 2] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
-
-            mean = np.array([0, 0., 0, 0])
-            ret_actions[i, 3:] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
-
-            if self._steps > 5:
-                ret_actions[i, self._steps:] = np.random.multivariate_normal(np.zeros(4), self._base_sigma,
-                                                                             self._steps - 5)
-        default_actions = np.random.multivariate_normal(self._base_mean, self._full_sigma, per_split)
+        # first split: move to a random point, lower, lift, move to a second random point and lower again
+        first_pnt, second_pnt = np.random.uniform(size=(2, per_split, 2))
+        delta_first, delta_second = (first_pnt - current_state) / self._repeat, (second_pnt - first_pnt) / self._repeat
+        split = ret_actions[:per_split]
+        base_means = np.zeros((per_split, 2, self._adim))
+        base_means[:, 0, :2], base_means[:, 1, :2] = delta_first, delta_second
+        base_means[:, :, 2] = 1
+        split[:, [0, 3]] = action_processing.gaussian_steps(base_means, self._base_sigma)
+        lower_means = np.zeros((per_split, 3, self._adim))
+        lower_means[:, :, 2] = [-1, 1, -1]
+        split[:, [1, 2, 4]] = action_processing.gaussian_steps(lower_means, lower_sigma)
+
+        # second split: lift, move to a random point, lower and hold
+        second_pnt = np.random.uniform(size=(per_split, 2))
+        delta_second = (second_pnt - current_state) / self._repeat
+        split = ret_actions[per_split:2 * per_split]
+        base_means = np.zeros((per_split, self._adim))
+        base_means[:, :2], base_means[:, 2] = delta_second, 1
+        split[:, 1] = action_processing.gaussian_steps(base_means, self._base_sigma)
+        lower_means = np.zeros((per_split, 3, self._adim))
+        lower_means[:, :, 2] = [1, -1, 0]
+        lower = action_processing.gaussian_steps(lower_means, lower_sigma)
+        split[:, 0], split[:, 2], split[:, 3:] = lower[:, 0], lower[:, 1], lower[:, 2, None]
+
+        default_actions = action_processing.gaussian_steps(np.tile(self._base_mean, (per_split, 1)), self._full_sigma)
         ret_actions[2 * per_split:] = default_actions.reshape((per_split, self._steps, self._adim))
 
         ret_actions[:, :, :3] = np.clip(ret_actions[:, :, :3], -np.array(self._hp.max_shift),
                                         np.array(self._hp.max_shift))
 
-        return np.repeat(ret_actions, self._repeat, axis=1)
+        return action_processing.repeat_actions(ret_actions, self._repeat)
 
     @staticmethod
     def get_default_hparams():
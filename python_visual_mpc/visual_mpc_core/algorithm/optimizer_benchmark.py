@@ -0,0 +1,126 @@
+""" rollouts needed by CEM, iCEM and MPPI to push the object within a fixed distance of the goal on cartgripper, or to plan
+with CEM_Controller_Vidpred and a given predictor """
+import argparse
+import copy
+import imp
+import numpy as np
+from python_visual_mpc.visual_mpc_core.envs.mujoco_env.cartgripper_env.cartgripper_xyz import CartgripperXYZEnv
+from python_visual_mpc.visual_mpc_core.algorithm.cem_controller_sim import CEM_Controller_Sim
+from python_visual_mpc.visual_mpc_core.algorithm.cem_controller_vidpred import CEM_Controller_Vidpred
+
+
+ENV_PARAMS = {'num_objects': 1, 'object_mass': 0.1, 'friction': 1.0}
+
+OPTIMIZERS = {'cem': {'reuse_mean': True, 'reuse_cov': True},
+              'icem': {'optimizer': 'icem'},
+              'mppi': {'optimizer': 'mppi'}}
+
+
+def make_task(seed, goal_dist):
+    """
+    :return: reset state and a goal pose goal_dist away from the initial object position in a random direction
+    """
+    np.random.seed(seed)
+    env = CartgripperXYZEnv(copy.deepcopy(ENV_PARAMS))
+    obs, reset_state = env.reset()
+    angle = np.random.uniform(0, 2 * np.pi)
+    goal_pos = obs['object_qpos'].copy()
+    goal_pos[:, :2] += goal_dist * np.array([np.cos(angle), np.sin(angle)])
+    return reset_state, goal_pos
+
+
+def rollouts_to_target(policyparams, reset_state, goal_pos, target_dist, T):
+    """
+    runs the controller in closed loop
+    :return: simulator rollouts summed over all planning steps until the object is within target_dist of the goal,
+    None if it is not reached within T steps
+    """
+    env = CartgripperXYZEnv(copy.deepcopy(ENV_PARAMS), reset_state)
+    env.set_goal_obj_pose(goal_pos)
+    obs, _ = env.reset()
+    agentparams = {'env': (CartgripperXYZEnv, ENV_PARAMS), 'adim': env.adim, 'sdim': env.sdim, 'T': T}
+    policy = CEM_Controller_Sim(agentparams, policyparams, 0, 1)
+    policy.reset()
+
+    obs_hist = dict((k, [obs[k]]) for k in ('qpos_full', 'qvel_full', 'state', 'object_qpos'))
+    nrollouts = 0
+    try:
+        for t in range(T):
+            hist = dict((k, np.stack(v)) for k, v in obs_hist.items())
+            pi_t = policy.act(t, 0, goal_pos=goal_pos, reset_state=reset_state, **hist)
+            nrollouts += pi_t['plan_stat'].get('num_rollouts', 0)
+            obs = env.step(copy.deepcopy(pi_t['actions']))
+            for k in obs_hist:
+                obs_hist[k].append(obs[k])
+            if env.get_distance_score() <= target_dist:
+                return nrollouts
+        return None
+    finally:
+        if policy._pool is not None:
+            policy._pool.close()
+
+
+def vidpred_plan(policyparams, vidpred_dir, seed, T):
+    """
+    plans T steps with CEM_Controller_Vidpred on random context images, the predictor is set up from the conf.py in
+    vidpred_dir, e.g. a stand-in without a checkpoint
+    :return: predictor rollouts summed over all planning steps and the mean best score of the executed plans
+    """
+    conf = imp.load_source('params', vidpred_dir + '/conf.py').configuration
+    ncam, height, width = conf['ncam'], conf['orig_size'][0], conf['orig_size'][1]
+    ndesig = conf.get('ndesig', 1)
+    rng = np.random.RandomState(seed)
+    images = rng.randint(0, 255, (T + 1, ncam, height, width, 3)).astype(np.uint8)
+    desig_pix = rng.randint(0, [height, width], (ncam, ndesig, 2))
+    goal_pix = rng.randint(0, [height, width], (ncam, ndesig, 2))
+
+    np.random.seed(seed)
+    agentparams = {'current_dir': vidpred_dir, 'adim': conf['adim'], 'sdim': conf['sdim'], 'T': T + 1}
+    policy = CEM_Controller_Vidpred(agentparams, policyparams, 0, 1)
+    policy.reset()
+    nrollouts, bestscores = 0, []
+    for t in range(T):
+        pi_t = policy.act(t, 0, desig_pix=desig_pix, goal_pix=goal_pix, images=images,
+                          state=np.zeros((T + 1, conf['sdim'])))
+        nrollouts += pi_t['plan_stat'].get('num_rollouts', 0)
+        if t > 0:   # the first step executes a zero action without planning
+            bestscores.append(policy._prev_bestscore)
+    return nrollouts, np.mean(bestscores)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='optimizer benchmark')
+    parser.add_argument('--ntasks', type=int, default=10)
+    parser.add_argument('--goal_dist', type=float, default=0.2, help='initial distance between object and goal')
+    parser.add_argument('--target_dist', type=float, default=0.05, help='distance counted as reaching the goal')
+    parser.add_argument('--T', type=int, default=35)
+    parser.add_argument('--num_samples', type=int, default=None, help='controller default if not given')
+    parser.add_argument('--num_workers', type=int, default=None, help='controller default if not given')
+    parser.add_argument('--optimizers', type=str, nargs='+', default=sorted(OPTIMIZERS.keys()))
+    parser.add_argument('--vidpred_dir', type=str, default=None,
+                        help='plan with CEM_Controller_Vidpred and the predictor conf.py in this directory instead')
+    args = parser.parse_args()
+
+    if args.vidpred_dir is not None:
+        for name in args.optimizers:
+            policyparams = dict(OPTIMIZERS[name])
+            if args.num_samples is not None:
+                policyparams['num_samples'] = [args.num_samples]
+            results = np.array([vidpred_plan(policyparams, args.vidpred_dir, seed, args.T)
+                                for seed in range(args.ntasks)])
+            print('{}: {:.0f} predictor rollouts per task, mean best score {:.4f}'.format(
+                name, np.mean(results[:, 0]), np.mean(results[:, 1])))
+    else:
+        tasks = [make_task(seed, args.goal_dist) for seed in range(args.ntasks)]
+        for name in args.optimizers:
+            policyparams = dict(OPTIMIZERS[name], render_rollouts=False)
+            if args.num_samples is not None:    # the controller rejects overrides equal to the default
+                policyparams['num_samples'] = [args.num_samples]
+            if args.num_workers is not None:
+                policyparams['num_workers'] = args.num_workers
+            results = [rollouts_to_target(policyparams, reset_state, goal_pos, args.target_dist, args.T)
+                       for reset_state, goal_pos in tasks]
+            reached = [r for r in results if r is not None]
+            median = np.median(reached) if reached else float('nan')
+            print('{}: reached {}/{} goals, median {:.0f} rollouts to reach {} m'.format(
+                name, len(reached), len(results), median, args.target_dist))
@@ -5,7 +5,7 @@ import numpy as np
 from python_visual_mpc.visual_mpc_core.algorithm.policy import Policy
 
 from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_controller_utils import construct_initial_sigma
-from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_controller_utils import truncate_movement
+from python_visual_mpc.visual_mpc_core.algorithm.utils import action_processing
 
 class Randompolicy(Policy):
     """
@@ -48,22 +48,14 @@ class Randompolicy(Policy):
         return {'actions': self.actions[t, :self.adim]}
 
     def process_actions(self):
-        if len(self.actions.shape) == 2:
-            self.actions = self._process(self.actions)
-        elif len(self.actions.shape) == 3:   # when processing batch of actions
-            newactions = []
-            for b in range(self.actions.shape[0]):
-                newactions.append(self._process(self.actions[b]))
-            self.actions = np.stack(newactions, axis=0)
-
-    def _process(self, actions):
+        """
+        processes a single action sequence of shape [nactions, adim] or a batch of shape [M, nactions, adim]
+        """
         if self._hp.discrete_gripper:
-            actions = discretize_gripper(actions, self._hp)
+            action_processing.binarize_gripper(self.actions, out=self.actions)
         if self._hp.action_bound:
-            actions = truncate_movement(actions, self._hp)
-            
-        actions = np.repeat(actions, self._hp.repeat, axis=0)
-        return actions
+            action_processing.clip_movement(self.actions, self._hp, out=self.actions)
+        self.actions = action_processing.repeat_actions(self.actions, self._hp.repeat)
 
     def finish(self):
         pass
@@ -180,16 +172,8 @@ class RandomPickPolicy(Randompolicy):
 
 def discretize_gripper(actions, gripper_ind):
     assert len(actions.shape) == 2
-    for a in range(actions.shape[0]):
-        if actions[a, gripper_ind] >= 0:
-            actions[a, gripper_ind] = 1
-        else:
-            actions[a, gripper_ind] = -1
-    return actions
+    return action_processing.binarize_gripper(actions, gripper_ind, out=actions)
 
 
 def discretize(actions, discrete_ind):
-    for a in range(actions.shape[0]):
-        for ind in discrete_ind:
-            actions[a, ind] = np.clip(np.floor(actions[a, ind]), 0, 4)
-    return actions
+    return action_processing.discretize(actions, discrete_ind, out=actions)
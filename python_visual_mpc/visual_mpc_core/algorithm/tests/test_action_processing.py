@@ -0,0 +1,258 @@
+""" action_processing and its callers against frozen copies of the per-sample loops they replaced """
+import copy
+import numpy as np
+import pytest
+
+from python_visual_mpc.visual_mpc_core.algorithm.utils import action_processing
+from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_controller_utils import apply_ag_epsilon, discretize, \
+    truncate_movement
+from python_visual_mpc.visual_mpc_core.algorithm.random_policy import Randompolicy
+from python_visual_mpc.visual_mpc_core.algorithm.custom_samplers.folding_sampler import FoldingSampler
+
+
+class Hparams(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def old_apply_ag_epsilon(actions, state, hp, close_override=False, no_close_first_repeat = False):
+    z_thresh, epsilon, norm = hp.autograsp_epsilon
+    assert 0 <= epsilon <= 1, "epsilon should be a valid probability"
+
+    z_dim, gripper_dim = 2, -1
+    if hp.action_order[0] is not None:
+        assert 'z' in hp.action_order and 'grasp' in hp.action_order, "Ap epsilon requires z and grasp action"
+        for i, a in enumerate(hp.action_order):
+            if a == 'grasp':
+                gripper_dim = i
+            elif a == 'z':
+                z_dim = i
+
+    cumulative_zs = np.cumsum(actions[:, :, z_dim] / norm, 1) + state[-1, z_dim]
+    z_thresh_check = (cumulative_zs <= z_thresh).astype(np.float32) * 2 - 1
+    first_close_pos = np.argmax(z_thresh_check, axis = 1)
+    if close_override:
+        actions[:, :, gripper_dim] = 1
+    else:
+        for i, p in enumerate(first_close_pos):
+            pivot = p - p % hp.repeat    # ensure that pivots only occur on repeat boundry
+            if no_close_first_repeat:
+                pivot = max(pivot, hp.repeat)
+            actions[i, :pivot, gripper_dim] = -1
+            actions[i, pivot:, gripper_dim] = 1
+    epsilon_vec = np.random.choice([-1, 1], size=actions.shape[:-1], p=[epsilon, 1 - epsilon])
+    actions[:, :, gripper_dim] *= epsilon_vec
+
+    return actions
+
+
+def old_discretize(actions, M, naction_steps, discrete_ind):
+    for b in range(M):
+        for a in range(naction_steps):
+            for ind in discrete_ind:
+                actions[b, a, ind] = np.clip(np.floor(actions[b, a, ind]), 0, 4)
+    return actions
+
+
+def old_truncate_movement(actions, hp):
+    maxshift = hp.initial_std * 2
+
+    if len(actions.shape) == 3:
+        if hp.action_order[0] is not None:
+            for i, a in enumerate(hp.action_order):
+                if a == 'x' or a == 'y':
+                    maxshift = hp.initial_std * 2
+                elif a == 'theta':
+                    maxshift = np.pi / 4
+                else:
+                    continue
+                actions[:, :, i] = np.clip(actions[:, :, i], -maxshift, maxshift)
+            return actions
+
+        actions[:,:,:2] = np.clip(actions[:,:,:2], -maxshift, maxshift)  # clip in units of meters
+        if actions.shape[-1] >= 4: # if rotation is enabled
+            maxrot = np.pi / 4
+            actions[:, :, 3] = np.clip(actions[:, :, 3], -maxrot, maxrot)
+
+    elif len(actions.shape) == 2:
+        if hp.action_order[0] is not None:
+            for i, a in enumerate(hp.action_order):
+                if a == 'x' or a == 'y':
+                    maxshift = hp.initial_std * 2
+                elif a == 'theta':
+                    maxshift = np.pi / 4
+                else:
+                    continue
+                actions[:, i] = np.clip(actions[:, i], -maxshift, maxshift)
+            return actions
+
+        actions[:,:2] = np.clip(actions[:,:2], -maxshift, maxshift)  # clip in units of meters
+        if actions.shape[-1] >= 4: # if rotation is enabled
+            maxrot = np.pi / 4
+            actions[:, 3] = np.clip(actions[:, 3], -maxrot, maxrot)
+    else:
+        raise NotImplementedError
+    return actions
+
+
+def old_discretize_gripper(actions, gripper_ind):
+    assert len(actions.shape) == 2
+    for a in range(actions.shape[0]):
+        if actions[a, gripper_ind] >= 0:
+            actions[a, gripper_ind] = 1
+        else:
+            actions[a, gripper_ind] = -1
+    return actions
+
+
+def old_process_actions(actions, hp):
+    """ Randompolicy.process_actions and _process, returning the actions instead of setting self.actions """
+    def _process(actions):
+        if hp.action_bound:
+            actions = old_truncate_movement(actions, hp)
+        actions = np.repeat(actions, hp.repeat, axis=0)
+        return actions
+
+    if len(actions.shape) == 2:
+        return _process(actions)
+    newactions = []
+    for b in range(actions.shape[0]):
+        newactions.append(_process(actions[b]))
+    return np.stack(newactions, axis=0)
+
+
+def old_folding_sample(sampler, M, current_state):
+    """ FoldingSampler.sample with one draw per sample and step """
+    self = sampler
+    assert M % 3 == 0, "splits samples into setting with 3 means"
+    ret_actions = np.zeros((M, self._steps, self._adim))
+    per_split, current_state = M // 3, current_state[-1, :2]
+
+    lower_sigma = copy.deepcopy(self._base_sigma)
+    lower_sigma[:2, :2] /= 10
+    lower_sigma[3, 3] /= 2
+
+    for i in range(per_split):
+        first_pnt, second_pnt = np.random.uniform(size=2), np.random.uniform(size=2)
+
+        delta_first, delta_second = (first_pnt - current_state) / self._repeat, \
+                                    (second_pnt - first_pnt) / self._repeat
+
+        mean = np.array([delta_first[0], delta_first[1], 1, 0.])
+        ret_actions[i, 0] = np.random.multivariate_normal(mean, self._base_sigma, 1).reshape(-1)
+
+        mean = np.array([0, 0., -1, 0])
+        ret_actions[i, 1] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
+
+        mean = np.array([0, 0., 1, 0])
+        ret_actions[i, 2] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
+
+        mean = np.array([delta_second[0], delta_second[1], 1, 0])
+        ret_actions[i, 3] = np.random.multivariate_normal(mean, self._base_sigma, 1).reshape(-1)
+
+        mean = np.array([0, 0., -1, 0])
+        ret_actions[i, 4] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
+
+    for i in range(per_split, 2 * per_split):
+        second_pnt = np.random.uniform(size=2)
+
+        delta_second = (second_pnt - current_state) / self._repeat
+
+        mean = np.array([0, 0, 1, 0.])
+        ret_actions[i, 0] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
+
+        mean = np.array([delta_second[0], delta_second[1], 1, 0])
+        ret_actions[i, 1] = np.random.multivariate_normal(mean, self._base_sigma, 1).reshape(-1)
+
+        mean = np.array([0, 0., -1, 0])
+        ret_actions[i, 2] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
+
+        mean = np.array([0, 0., 0, 0])
+        ret_actions[i, 3:] = np.random.multivariate_normal(mean, lower_sigma, 1).reshape(-1)
+
+    default_actions = np.random.multivariate_normal(self._base_mean, self._full_sigma, per_split)
+    ret_actions[2 * per_split:] = default_actions.reshape((per_split, self._steps, self._adim))
+
+    ret_actions[:, :, :3] = np.clip(ret_actions[:, :, :3], -np.array(self._hp.max_shift),
+                                    np.array(self._hp.max_shift))
+
+    return np.repeat(ret_actions, self._repeat, axis=1)
+
+
+def random_actions(shape, seed=0, scale=0.2):
+    return np.random.RandomState(seed).normal(scale=scale, size=shape)
+
+
+ACTION_ORDERS = [[None], ['x', 'y', 'theta', 'z', 'grasp']]
+
+
+@pytest.mark.parametrize('action_order', ACTION_ORDERS)
+@pytest.mark.parametrize('close_override', [False, True])
+@pytest.mark.parametrize('no_close_first_repeat', [False, True])
+def test_apply_ag_epsilon(action_order, close_override, no_close_first_repeat):
+    hp = Hparams(autograsp_epsilon=[-0.1, 0.2, 1], action_order=action_order, repeat=3)
+    actions, state = random_actions((300, 15, 5)), random_actions((4, 5), seed=1)
+    np.random.seed(0)
+    expected = old_apply_ag_epsilon(actions.copy(), state, hp, close_override, no_close_first_repeat)
+    np.random.seed(0)
+    result = actions.copy()
+    returned = apply_ag_epsilon(result, state, hp, close_override, no_close_first_repeat)
+    assert returned is result
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_discretize():
+    actions = random_actions((300, 5, 5), scale=3.)
+    expected = old_discretize(actions.copy(), 200, 4, [2, 4])
+    result = actions.copy()
+    assert discretize(result, 200, 4, [2, 4]) is result
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('action_order', ACTION_ORDERS)
+@pytest.mark.parametrize('shape', [(15, 5), (300, 15, 5), (300, 15, 3)])
+def test_truncate_movement(action_order, shape):
+    if action_order[0] is not None and shape[-1] < len(action_order):
+        return
+    hp = Hparams(initial_std=0.05, action_order=action_order)
+    actions = random_actions(shape, scale=1.)
+    expected = old_truncate_movement(actions.copy(), hp)
+    result = actions.copy()
+    assert truncate_movement(result, hp) is result
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_binarize_gripper():
+    actions = random_actions((15, 5))
+    expected = old_discretize_gripper(actions.copy(), -1)
+    np.testing.assert_array_equal(action_processing.binarize_gripper(actions, -1), expected)
+
+
+@pytest.mark.parametrize('shape', [(5, 4), (20, 5, 4)])
+@pytest.mark.parametrize('policyparams', [{}, {'action_bound': False}, {'action_order': ['x', 'y', 'z', 'theta']}])
+def test_randompolicy_process_actions(shape, policyparams):
+    policy = Randompolicy({'adim': 4, 'T': 15}, policyparams, 0, 1)
+    actions = random_actions(shape, scale=1.)
+    expected = old_process_actions(actions.copy(), policy._hp)
+    policy.actions = actions.copy()
+    policy.process_actions()
+    np.testing.assert_array_equal(policy.actions, expected)
+
+
+def test_folding_sampler():
+    """ the vectorized sampler draws in a different order, so only the distribution of the samples is compared """
+    nactions, repeat, M = 5, 3, 6000
+    sigma = np.diag(np.tile([0.05 ** 2, 0.05 ** 2, 0.15 ** 2, (np.pi / 18) ** 2], nactions))
+    hp = Hparams(nactions=nactions, **FoldingSampler.get_default_hparams())
+    sampler = FoldingSampler(sigma, np.zeros(4 * nactions), hp, repeat, 4)
+    state = np.full((2, 4), 0.5)
+    np.random.seed(0)
+    expected = old_folding_sample(sampler, M, state)
+    np.random.seed(1)
+    result = sampler.sample(M, state)
+
+    assert result.shape == expected.shape
+    for split in range(3):
+        rows = slice(split * M // 3, (split + 1) * M // 3)
+        np.testing.assert_allclose(np.mean(result[rows], 0), np.mean(expected[rows], 0), atol=0.02)
+        np.testing.assert_allclose(np.std(result[rows], 0), np.std(expected[rows], 0), rtol=0.1, atol=1e-3)
@@ -0,0 +1,76 @@
+""" CEM_Controller_Vidpred with a numpy stand-in predictor, for iterations that evaluate fewer samples than the first """
+import os
+os.environ.setdefault('NO_ROS', '1')
+import numpy as np
+import pytest
+
+from python_visual_mpc.visual_mpc_core.algorithm.cem_controller_vidpred import CEM_Controller_Vidpred
+
+
+STUB_CONF = '''
+import numpy as np
+
+def setup_stub_predictor(hyperparams, conf, gpu_id, ngpu, logger):
+    """ the designated pixel drifts to the right with the magnitude of the first action dimension """
+    def predictor(input_images=None, input_one_hot_images=None, input_state=None, input_actions=None, **kwargs):
+        b, T = input_actions.shape[0], conf['sequence_length'] - conf['context_frames']
+        drift = np.abs(input_actions[:, conf['context_frames']:, :1, None, None, None])
+        gen_distrib = np.ones((b, T, 1, 12, 16, 1), np.float32) + drift * np.arange(16)[None, None, None, None, :, None]
+        gen_images = np.zeros((b, T, 1, 12, 16, 3), np.float32)
+        return gen_images, gen_distrib / np.sum(gen_distrib, axis=(3, 4), keepdims=True), None, None
+    return predictor
+
+configuration = {'setup_predictor': setup_stub_predictor, 'batch_size': 50, 'sequence_length': 15,
+                 'context_frames': 2, 'adim': 4, 'sdim': 4, 'ndesig': 1, 'ncam': 1, 'orig_size': [12, 16]}
+'''
+
+
+def plan(tmpdir, policyparams, nsteps=2):
+    tmpdir.join('conf.py').write(STUB_CONF)
+    np.random.seed(0)
+    controller = CEM_Controller_Vidpred({'current_dir': str(tmpdir), 'T': 20, 'adim': 4, 'sdim': 4}, policyparams,
+                                        0, 1)
+    controller.reset()
+    images = np.random.RandomState(1).randint(0, 255, (20, 1, 12, 16, 3)).astype(np.uint8)
+    for t in range(nsteps):
+        controller.act(t=t, i_tr=0, desig_pix=[[3, 4]], goal_pix=[[6, 10]], images=images, state=np.zeros((20, 4)))
+    return controller
+
+
+@pytest.mark.parametrize('pipelined', [{}, {'pipeline_rollouts': True}])
+def test_adaptive_schedule_shrinks_M(tmpdir, pipelined):
+    controller = plan(tmpdir, dict({'num_samples': [150], 'iterations': 6, 'adaptive_schedule': True,
+                                    'schedule_spread_tol': 0., 'schedule_trace_tol': 0.}, **pipelined))
+    evaluated_M = [v['M'] for k, v in controller.plan_stat.items() if k.startswith('schedule_itr')]
+    assert min(evaluated_M) < 150
+    assert controller.best_cost_perstep.shape == (1, 1, 13)
+
+
+def test_elite_archive_skips_samples(tmpdir):
+    controller = plan(tmpdir, {'num_samples': [150], 'iterations': 4, 'selection_frac': 0.5, 'elite_archive': True})
+    assert controller.plan_stat['archived_elites_itr1'] > 0
+    assert controller.plan_stat['num_rollouts'] < 4 * 150
+
+
+@pytest.mark.parametrize('optimizer', ['icem', 'mppi'])
+def test_sampling_optimizers(tmpdir, optimizer):
+    controller = plan(tmpdir, {'num_samples': [150], 'selection_frac': 0.1, 'optimizer': optimizer})
+    if optimizer == 'icem':
+        assert controller.plan_stat['num_samples_itr2'] < controller.plan_stat['num_samples_itr0']
+    assert controller.M == 150
+
+
+@pytest.mark.parametrize('early_stop', [{}, {'adaptive_schedule': True, 'schedule_spread_tol': 10.}])
+def test_predictor_propagation_after_early_stop(tmpdir, early_stop):
+    controller = plan(tmpdir, dict({'predictor_propagation': True}, **early_stop), nsteps=4)
+    if early_stop:
+        assert controller.plan_stat['cem_iterations'] < controller._hp.iterations
+    # the designated pixel of the first plan and the propagated distribution of every plan
+    assert len(controller.rec_input_distrib) == 4
+
+
+def test_predictor_propagation_after_warm_start(tmpdir):
+    controller = plan(tmpdir, {'predictor_propagation': True, 'reuse_mean': True, 'reuse_cov': True,
+                               'warmstart_iterations': 1, 'warmstart_tol': 10.}, nsteps=4)
+    assert controller.plan_stat['cem_iterations'] == 1
+    assert len(controller.rec_input_distrib) == 4
@@ -0,0 +1,127 @@
+"""
+Vectorized post-processing of sampled action sequences.
+
+All functions take arrays of shape [..., T, adim] (typically [M, T, adim]) and an optional preallocated out array of
+the output shape, out may be the input itself for in-place processing.
+"""
+import numpy as np
+from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_covariance import sampling_factor
+
+
+def _output(actions, out):
+    if out is None:
+        return actions.copy()
+    if out is not actions:
+        np.copyto(out, actions)
+    return out
+
+
+def clip_movement(actions, hp, out=None):
+    """
+    clips xy to 2 * hp.initial_std and the rotation to pi / 4, the dimensions are given by hp.action_order or
+    default to x, y, z, theta
+    """
+    out = _output(actions, out)
+    maxshift = hp.initial_std * 2
+    maxrot = np.pi / 4
+    if hp.action_order[0] is not None:
+        for i, a in enumerate(hp.action_order):
+            if a == 'x' or a == 'y':
+                np.clip(out[..., i], -maxshift, maxshift, out=out[..., i])
+            elif a == 'theta':
+                np.clip(out[..., i], -maxrot, maxrot, out=out[..., i])
+        return out
+
+    np.clip(out[..., :2], -maxshift, maxshift, out=out[..., :2])
+    if out.shape[-1] >= 4:
+        np.clip(out[..., 3], -maxrot, maxrot, out=out[..., 3])
+    return out
+
+
+def discretize(actions, discrete_ind, out=None):
+    """
+    floors the dimensions in discrete_ind and clips them between 0 and 4
+    """
+    out = _output(actions, out)
+    discrete_ind = list(discrete_ind)
+    out[..., discrete_ind] = np.clip(np.floor(out[..., discrete_ind]), 0, 4)
+    return out
+
+
+def binarize_gripper(actions, gripper_ind=-1, out=None):
+    """
+    sets the gripper dimension to 1 where it is >= 0 and to -1 otherwise
+    """
+    out = _output(actions, out)
+    out[..., gripper_ind] = np.where(out[..., gripper_ind] >= 0, 1., -1.)
+    return out
+
+
+def repeat_actions(actions, repeat, out=None):
+    """
+    same as np.repeat(actions, repeat, axis=-2), written into out of shape [..., T * repeat, adim]
+    """
+    shape = actions.shape[:-2] + (actions.shape[-2] * repeat, actions.shape[-1])
+    if out is None:
+        out = np.empty(shape, dtype=actions.dtype)
+    assert out.shape == shape
+    out.reshape(actions.shape[:-1] + (repeat, actions.shape[-1]))[:] = actions[..., None, :]
+    return out
+
+
+def gripper_dims(hp):
+    """
+    :return: index of the z and the gripper dimension
+    """
+    z_dim, gripper_dim = 2, -1
+    if hp.action_order[0] is not None:
+        assert 'z' in hp.action_order and 'grasp' in hp.action_order, "Ap epsilon requires z and grasp action"
+        z_dim, gripper_dim = hp.action_order.index('z'), hp.action_order.index('grasp')
+    return z_dim, gripper_dim
+
+
+def autograsp_pivots(actions, state, hp, no_close_first_repeat=False):
+    """
+    :param actions: repeated actions of shape [M, T, adim]
+    :return: for every sample the first step at which the gripper closes, on a repeat boundary
+    """
+    z_thresh, _, norm = hp.autograsp_epsilon
+    z_dim, _ = gripper_dims(hp)
+    cumulative_zs = np.cumsum(actions[:, :, z_dim] / norm, 1) + state[-1, z_dim]
+    first_close_pos = np.argmax(cumulative_zs <= z_thresh, axis=1)
+    pivots = first_close_pos - first_close_pos % hp.repeat   # ensure that pivots only occur on repeat boundry
+    if no_close_first_repeat:
+        pivots = np.maximum(pivots, hp.repeat)
+    return pivots
+
+
+def apply_autograsp(actions, state, hp, close_override=False, no_close_first_repeat=False, out=None):
+    """
+    opens the gripper before and closes it from the pivot on, then flips every gripper action with probability
+    epsilon, see autograsp_pivots
+    """
+    _, epsilon, _ = hp.autograsp_epsilon
+    assert 0 <= epsilon <= 1, "epsilon should be a valid probability"
+    _, gripper_dim = gripper_dims(hp)
+    out = _output(actions, out)
+
+    if close_override:
+        out[:, :, gripper_dim] = 1
+    else:
+        pivots = autograsp_pivots(out, state, hp, no_close_first_repeat)
+        out[:, :, gripper_dim] = np.where(np.arange(out.shape[1])[None] < pivots[:, None], -1., 1.)
+    epsilon_vec = np.random.choice([-1, 1], size=out.shape[:-1], p=[epsilon, 1 - epsilon])
+    out[:, :, gripper_dim] *= epsilon_vec
+    return out
+
+
+def gaussian_steps(means, sigma, out=None):
+    """
+    draws every row of means from N(mean, sigma) with a single factorization of sigma
+    :param means: shape [..., d]
+    """
+    noise = np.random.standard_normal(means.shape).dot(sampling_factor(sigma).T)
+    if out is None:
+        return means + noise
+    np.add(means, noise, out=out)
+    return out
@@ -5,6 +5,8 @@ import matplotlib; matplotlib.use('Agg'); import matplotlib.pyplot as plt
 import copy
 import pdb
 import time
+from python_visual_mpc.visual_mpc_core.algorithm.utils.cem_covariance import DenseCovariance
+from python_visual_mpc.visual_mpc_core.algorithm.utils import action_processing
 
 
 def save_track_pkl(ctrl, t, cem_itr):
@@ -139,108 +141,108 @@ def construct_initial_sigma(hp, adim, t=None):
     return sigma
 
 
-def reuse_cov(sigma, adim, hp):
-    assert hp.replan_interval == 3
+def batch_rejection_sample(mean, sigma, nsamples, bound, oversample=1.2, max_block=None):
+    """
+    draws nsamples from N(mean, sigma) restricted to -bound <= x <= bound (elementwise)
+    samples are drawn in blocks from a single factorization of sigma, out-of-bound rows are masked out and only the
+    shortfall is redrawn, the resulting distribution is the same as drawing and rejecting one sample at a time.
+    :param mean: shape [d]
+    :param sigma: covariance of shape [d, d] or one of the classes in cem_covariance
+    :param nsamples: number of samples to return
+    :param bound: shape [d], use np.inf for unbounded dimensions
+    :param oversample: factor by which the expected number of required draws is increased
+    :param max_block: maximum number of rows drawn at once
+    :return: samples of shape [nsamples, d], acceptance rate
+    """
+    if max_block is None:
+        max_block = 100 * nsamples
+    if isinstance(sigma, np.ndarray):
+        sigma = DenseCovariance(sigma)
+    d = mean.shape[0]
+    samples = np.empty((nsamples, d))
+    n_accepted, n_ok, n_drawn = 0, 0, 0
+    while n_accepted < nsamples:
+        shortfall = nsamples - n_accepted
+        if n_ok == 0:
+            block = shortfall * oversample * max(n_drawn, 1)
+        else:
+            block = shortfall * oversample * n_drawn / float(n_ok)
+        block = int(min(max(np.ceil(block), 1), max_block))
+
+        draws = mean[None] + sigma.sample_noise(block)
+        ok = np.all(np.abs(draws) <= bound[None], axis=1)
+        n_drawn += block
+        n_ok += np.count_nonzero(ok)
+
+        accepted = draws[ok][:shortfall]
+        samples[n_accepted:n_accepted + accepted.shape[0]] = accepted
+        n_accepted += accepted.shape[0]
+    return samples, n_ok / float(n_drawn)
+
+
+def warmstart_shift(elapsed_steps, residual_steps, repeat):
+    """
+    :param elapsed_steps: number of environment steps since the previous plan was made
+    :param residual_steps: steps carried over from earlier calls that did not add up to a full action block
+    :return: number of action blocks to shift the previous plan by, new residual steps
+    """
+    steps = elapsed_steps + residual_steps
+    return steps // repeat, steps % repeat
+
+
+def reuse_cov(sigma, adim, hp, shift=1):
+    """
+    shifts the covariance of the previous plan by shift action blocks, the blocks that become free at the end are
+    filled with the initial covariance and a fraction hp.reuse_cov of the initial covariance is added to the rest
+    """
     print('reusing cov form last MPC step...')
-    sigma_old = copy.deepcopy(sigma)
-    sigma = np.zeros_like(sigma)
-    #reuse covariance and add a fraction of the initial covariance to it
-    sigma[0:-adim,0:-adim] = sigma_old[adim:,adim: ] + \
-                             construct_initial_sigma(hp)[:-adim, :-adim] * hp.reuse_cov
-    sigma[-adim:, -adim:] = construct_initial_sigma(hp)[:adim, :adim]
-    return sigma
+    prior = construct_initial_sigma(hp, adim, t=0)
+    keep = max(hp.nactions - shift, 0) * adim
+    new_sigma = prior.copy()
+    new_sigma[:keep, :keep] = sigma[shift * adim:, shift * adim:] + prior[:keep, :keep] * hp.reuse_cov
+    return new_sigma
 
 
-def reuse_action(prev_action, hp):
-    assert hp.replan_interval == 3
+def reuse_action(prev_action, hp, shift=1):
+    """
+    shifts the previous plan of shape [nactions, adim] by shift action blocks, the blocks that become free at the end
+    are zero or repeat the last action of the previous plan depending on hp.warmstart_prior
+    """
     print('reusing mean form last MPC step...')
     action = np.zeros_like(prev_action)
-    action[:-1] = prev_action[1:]
+    keep = max(prev_action.shape[0] - shift, 0)
+    action[:keep] = prev_action[shift:]
+    if hp.warmstart_prior == 'repeat_last':
+        action[keep:] = prev_action[-1]
+    elif hp.warmstart_prior != 'zero':
+        raise ValueError('unknown warmstart_prior {}'.format(hp.warmstart_prior))
     return action.flatten()
 
 
 def apply_ag_epsilon(actions, state, hp, close_override=False, no_close_first_repeat = False):
-    z_thresh, epsilon, norm = hp.autograsp_epsilon
-    assert 0 <= epsilon <= 1, "epsilon should be a valid probability"
-
-    z_dim, gripper_dim = 2, -1
-    if hp.action_order[0] is not None:
-        assert 'z' in hp.action_order and 'grasp' in hp.action_order, "Ap epsilon requires z and grasp action"
-        for i, a in enumerate(hp.action_order):
-            if a == 'grasp':
-                gripper_dim = i
-            elif a == 'z':
-                z_dim = i
-
-    cumulative_zs = np.cumsum(actions[:, :, z_dim] / norm, 1) + state[-1, z_dim]
-    z_thresh_check = (cumulative_zs <= z_thresh).astype(np.float32) * 2 - 1
-    first_close_pos = np.argmax(z_thresh_check, axis = 1)
-    if close_override:
-        actions[:, :, gripper_dim] = 1
-    else:
-        for i, p in enumerate(first_close_pos):
-            pivot = p - p % hp.repeat    # ensure that pivots only occur on repeat boundry
-            if no_close_first_repeat:
-                pivot = max(pivot, hp.repeat)
-            actions[i, :pivot, gripper_dim] = -1
-            actions[i, pivot:, gripper_dim] = 1
-    epsilon_vec = np.random.choice([-1, 1], size=actions.shape[:-1], p=[epsilon, 1 - epsilon])
-    actions[:, :, gripper_dim] *= epsilon_vec
-
-    return actions
+    """
+    in place, see action_processing.apply_autograsp
+    """
+    return action_processing.apply_autograsp(actions, state, hp, close_override, no_close_first_repeat, out=actions)
 
 
 def discretize(actions, M, naction_steps, discrete_ind):
     """
-    discretize and clip between 0 and 4
+    discretize and clip between 0 and 4, in place on the first M samples and naction_steps steps
     :param actions:
     :return:
     """
-    for b in range(M):
-        for a in range(naction_steps):
-            for ind in discrete_ind:
-                actions[b, a, ind] = np.clip(np.floor(actions[b, a, ind]), 0, 4)
+    sub = actions[:M, :naction_steps]
+    action_processing.discretize(sub, discrete_ind, out=sub)
     return actions
 
 def truncate_movement(actions, hp):
-    maxshift = hp.initial_std * 2
-
-    if len(actions.shape) == 3:
-        if hp.action_order[0] is not None:
-            for i, a in enumerate(hp.action_order):
-                if a == 'x' or a == 'y':
-                    maxshift = hp.initial_std * 2
-                elif a == 'theta':
-                    maxshift = np.pi / 4
-                else:
-                    continue
-                actions[:, :, i] = np.clip(actions[:, :, i], -maxshift, maxshift)
-            return actions
-
-        actions[:,:,:2] = np.clip(actions[:,:,:2], -maxshift, maxshift)  # clip in units of meters
-        if actions.shape[-1] >= 4: # if rotation is enabled
-            maxrot = np.pi / 4
-            actions[:, :, 3] = np.clip(actions[:, :, 3], -maxrot, maxrot)
-
-    elif len(actions.shape) == 2:
-        if hp.action_order[0] is not None:
-            for i, a in enumerate(hp.action_order):
-                if a == 'x' or a == 'y':
-                    maxshift = hp.initial_std * 2
-                elif a == 'theta':
-                    maxshift = np.pi / 4
-                else:
-                    continue
-                actions[:, i] = np.clip(actions[:, i], -maxshift, maxshift)
-            return actions
-
-        actions[:,:2] = np.clip(actions[:,:2], -maxshift, maxshift)  # clip in units of meters
-        if actions.shape[-1] >= 4: # if rotation is enabled
-            maxrot = np.pi / 4
-            actions[:, 3] = np.clip(actions[:, 3], -maxrot, maxrot)
-    else:
+    """
+    in place, see action_processing.clip_movement
+    """
+    if len(actions.shape) not in (2, 3):
         raise NotImplementedError
-    return actions
+    return action_processing.clip_movement(actions, hp, out=actions)
 
 
 def get_mask_trafo_scores(policyparams, gen_distrib, goal_mask):
@@ -0,0 +1,231 @@
+"""
+Covariance representations for fitting and sampling the CEM action distribution.
+
+All classes share the interface
+    cls.fit(elites, nactions, adim, **kwargs), cls.from_dense(sigma, nactions, adim, **kwargs),
+    sample_noise(n), dense(), trace(), blend(other, w)
+and cache whatever they need for sampling, so repeated draws from one fit only pay for the matrix products.
+"""
+import numpy as np
+
+
+def sampling_factor(sigma):
+    """
+    computes a matrix L with L*L^T = sigma, used to draw many samples from one factorization
+    :param sigma: covariance matrix, may be singular (e.g. when fitted on fewer elites than dimensions)
+    :return: L
+    """
+    try:
+        return np.linalg.cholesky(sigma)
+    except np.linalg.LinAlgError:
+        # fall back to the eigendecomposition for positive semi-definite covariances
+        eigval, eigvec = np.linalg.eigh(sigma)
+        return eigvec * np.sqrt(np.clip(eigval, 0, None))[None]
+
+
+def _psd_sqrt(mat):
+    eigval, eigvec = np.linalg.eigh(0.5 * (mat + mat.T))
+    return eigvec * np.sqrt(np.clip(eigval, 0, None))[None]
+
+
+class DenseCovariance(object):
+    """
+    full d x d covariance, O(d^3) factorization once per fit and O(d^2) per sample
+    """
+    def __init__(self, sigma):
+        self._sigma = sigma
+        self._L = None
+
+    @classmethod
+    def fit(cls, elites, nactions=None, adim=None):
+        return cls(np.cov(elites, rowvar=False, bias=False))
+
+    @classmethod
+    def from_dense(cls, sigma, nactions=None, adim=None):
+        return cls(sigma)
+
+    def sample_noise(self, n):
+        if self._L is None:
+            self._L = sampling_factor(self._sigma)
+        return np.random.standard_normal((n, self._sigma.shape[0])).dot(self._L.T)
+
+    def dense(self):
+        return self._sigma
+
+    def trace(self):
+        return np.trace(self._sigma)
+
+    def blend(self, other, w):
+        """
+        :return: w * self + (1 - w) * other
+        """
+        return DenseCovariance(w * self._sigma + (1 - w) * other.dense())
+
+
+class DiagonalCovariance(object):
+    """
+    independent action dimensions, O(d) storage and sampling
+    """
+    def __init__(self, var):
+        self._var = var
+        self._dense = None
+
+    @classmethod
+    def fit(cls, elites, nactions=None, adim=None):
+        return cls(np.var(elites, axis=0, ddof=1))
+
+    @classmethod
+    def from_dense(cls, sigma, nactions=None, adim=None):
+        return cls(np.diag(sigma).copy())
+
+    def sample_noise(self, n):
+        return np.random.standard_normal((n, self._var.shape[0])) * np.sqrt(self._var)[None]
+
+    def dense(self):
+        if self._dense is None:
+            self._dense = np.diag(self._var)
+        return self._dense
+
+    def trace(self):
+        return np.sum(self._var)
+
+    def blend(self, other, w):
+        return DiagonalCovariance(w * self._var + (1 - w) * np.diag(other.dense()))
+
+
+class BlockBandedCovariance(object):
+    """
+    Couples every time step only to the previous one: the action block of step t is the regression on block t - 1
+    plus independent noise, x_t = B_t x_{t-1} + e_t with e_t ~ N(0, S_t). The diagonal and first off-diagonal blocks
+    equal those of the fitted covariance and the precision matrix is block-tridiagonal. Unlike masking the dense
+    covariance this is always positive semi-definite. Fitting costs O(nactions * adim^3), sampling O(d * adim).
+    """
+    def __init__(self, B, S_sqrt):
+        """
+        :param B: regression matrices, shape [nactions, adim, adim], B[0] is unused
+        :param S_sqrt: square roots of the noise covariances, shape [nactions, adim, adim]
+        """
+        self._B, self._S_sqrt = B, S_sqrt
+        self._dense = None
+
+    @classmethod
+    def from_blocks(cls, diag_blocks, off_blocks):
+        """
+        :param diag_blocks: Cov(x_t, x_t), shape [nactions, adim, adim]
+        :param off_blocks: Cov(x_t, x_{t-1}), shape [nactions - 1, adim, adim]
+        """
+        nactions, adim = diag_blocks.shape[:2]
+        B = np.zeros_like(diag_blocks)
+        S_sqrt = np.empty_like(diag_blocks)
+        S_sqrt[0] = _psd_sqrt(diag_blocks[0])
+        for t in range(1, nactions):
+            B[t] = off_blocks[t - 1].dot(np.linalg.pinv(diag_blocks[t - 1]))
+            S_sqrt[t] = _psd_sqrt(diag_blocks[t] - B[t].dot(off_blocks[t - 1].T))
+        return cls(B, S_sqrt)
+
+    @classmethod
+    def fit(cls, elites, nactions, adim):
+        centered = (elites - np.mean(elites, axis=0)).reshape(elites.shape[0], nactions, adim)
+        norm = max(elites.shape[0] - 1, 1)
+        diag_blocks = np.einsum('nti,ntj->tij', centered, centered) / norm
+        off_blocks = np.einsum('nti,ntj->tij', centered[:, 1:], centered[:, :-1]) / norm
+        return cls.from_blocks(diag_blocks, off_blocks)
+
+    @classmethod
+    def from_dense(cls, sigma, nactions, adim):
+        blocks = sigma.reshape(nactions, adim, nactions, adim)
+        diag_blocks = np.stack([blocks[t, :, t] for t in range(nactions)])
+        off_blocks = np.array([blocks[t, :, t - 1] for t in range(1, nactions)]).reshape(-1, adim, adim)
+        return cls.from_blocks(diag_blocks, off_blocks)
+
+    def sample_noise(self, n):
+        nactions, adim = self._B.shape[:2]
+        z = np.random.standard_normal((n, nactions, adim))
+        x = np.empty_like(z)
+        x[:, 0] = z[:, 0].dot(self._S_sqrt[0].T)
+        for t in range(1, nactions):
+            x[:, t] = x[:, t - 1].dot(self._B[t].T) + z[:, t].dot(self._S_sqrt[t].T)
+        return x.reshape(n, nactions * adim)
+
+    def dense(self):
+        if self._dense is None:
+            nactions, adim = self._B.shape[:2]
+            sigma = np.zeros((nactions, adim, nactions, adim))
+            for t in range(nactions):
+                S = self._S_sqrt[t].dot(self._S_sqrt[t].T)
+                if t == 0:
+                    sigma[0, :, 0] = S
+                    continue
+                for s in range(t):    # Cov(x_t, x_s) = B_t Cov(x_{t-1}, x_s)
+                    sigma[t, :, s] = self._B[t].dot(sigma[t - 1, :, s])
+                    sigma[s, :, t] = sigma[t, :, s].T
+                sigma[t, :, t] = self._B[t].dot(sigma[t - 1, :, t - 1]).dot(self._B[t].T) + S
+            self._dense = sigma.reshape(nactions * adim, nactions * adim)
+        return self._dense
+
+    def trace(self):
+        return np.trace(self.dense())
+
+    def blend(self, other, w):
+        nactions, adim = self._B.shape[:2]
+        return BlockBandedCovariance.from_dense(w * self.dense() + (1 - w) * other.dense(), nactions, adim)
+
+
+class LowRankCovariance(object):
+    """
+    sigma = U U^T + diag(D) with U of shape [d, rank], O(d * rank) storage and sampling. Fitted from the top singular
+    vectors of the centered elites, D keeps the marginal variances of the elites.
+    """
+    def __init__(self, U, D):
+        self._U, self._D = U, D
+        self._dense = None
+
+    @classmethod
+    def _truncate(cls, U, D, rank):
+        """
+        keeps the rank strongest directions of U, the variance of the dropped directions goes to the diagonal
+        """
+        if U.shape[1] <= rank:
+            return cls(U, D)
+        left, s, _ = np.linalg.svd(U, full_matrices=False)
+        kept = left[:, :rank] * s[None, :rank]
+        dropped = left[:, rank:] * s[None, rank:]
+        return cls(kept, D + np.sum(np.square(dropped), axis=1))
+
+    @classmethod
+    def fit(cls, elites, nactions=None, adim=None, rank=4):
+        centered = (elites - np.mean(elites, axis=0)) / np.sqrt(max(elites.shape[0] - 1, 1))
+        return cls._truncate(centered.T, np.zeros(elites.shape[1]), rank)
+
+    @classmethod
+    def from_dense(cls, sigma, nactions=None, adim=None, rank=4):
+        eigval, eigvec = np.linalg.eigh(sigma)
+        order = np.argsort(eigval)[::-1][:rank]
+        U = eigvec[:, order] * np.sqrt(np.clip(eigval[order], 0, None))[None]
+        return cls(U, np.clip(np.diag(sigma) - np.sum(np.square(U), axis=1), 0, None))
+
+    def sample_noise(self, n):
+        d, rank = self._U.shape
+        return np.random.standard_normal((n, rank)).dot(self._U.T) + \
+               np.random.standard_normal((n, d)) * np.sqrt(self._D)[None]
+
+    def dense(self):
+        if self._dense is None:
+            self._dense = self._U.dot(self._U.T) + np.diag(self._D)
+        return self._dense
+
+    def trace(self):
+        return np.sum(np.square(self._U)) + np.sum(self._D)
+
+    def blend(self, other, w):
+        rank = self._U.shape[1]
+        if isinstance(other, LowRankCovariance):
+            U = np.concatenate([np.sqrt(w) * self._U, np.sqrt(1 - w) * other._U], axis=1)
+            return LowRankCovariance._truncate(U, w * self._D + (1 - w) * other._D, max(rank, other._U.shape[1]))
+        return LowRankCovariance.from_dense(w * self.dense() + (1 - w) * other.dense(), rank=max(rank, 1))
+
+
+COVARIANCE_TYPES = {'dense': DenseCovariance,
+                    'diag': DiagonalCovariance,
+                    'banded': BlockBandedCovariance,
+                    'lowrank': LowRankCovariance}
@@ -0,0 +1,56 @@
+""" Adaptive number of iterations and samples for the CEM loop. """
+import numpy as np
+
+
+def round_up(n, multiple):
+    return int(np.ceil(n / float(multiple))) * multiple
+
+
+class CEMScheduler(object):
+    """
+    Watches the spread of the elite scores and the trace of the fitted covariance after every CEM iteration. Stops
+    the loop once either has collapsed and otherwise shrinks the number of samples with the standard deviation of the
+    sampling distribution, always in multiples of the sample batch.
+    """
+    def __init__(self, hp, sample_batch=1):
+        """
+        :param hp: controller hparams with the schedule_* entries
+        :param sample_batch: M is always a multiple of this, e.g. the predictor batch size
+        """
+        self._hp = hp
+        self.sample_batch = sample_batch
+        self._trace0 = None
+        self._M0 = None
+
+    def start(self, M, K, sigma):
+        """
+        called before the first iteration with the initial number of samples, elites and the initial covariance
+        """
+        self._M0 = M
+        self._min_M = round_up(max(self._hp.schedule_min_frac * M, K), self.sample_batch)
+        self._trace0 = sigma.trace()
+
+    def update(self, itr, M, elite_scores, sigma):
+        """
+        :param itr: index of the iteration that just finished
+        :param M: number of samples of that iteration
+        :param elite_scores: scores of the K best samples
+        :param sigma: covariance fitted on the elites, a dense matrix or one of the classes in cem_covariance
+        :return: stop, number of samples of the next iteration, dict describing the decision for plan_stat
+        """
+        spread = np.std(elite_scores) / (np.abs(np.mean(elite_scores)) + 1e-8)
+        trace_ratio = sigma.trace() / self._trace0
+        stat = {'elite_spread': spread, 'trace_ratio': trace_ratio, 'M': M}
+
+        if itr + 1 >= self._hp.schedule_min_iterations:
+            if spread < self._hp.schedule_spread_tol:
+                stat['stop'] = 'elite_spread'
+                return True, M, stat
+            if trace_ratio < self._hp.schedule_trace_tol:
+                stat['stop'] = 'cov_trace'
+                return True, M, stat
+
+        next_M = round_up(self._M0 * np.sqrt(max(trace_ratio, 0.)), self.sample_batch)
+        next_M = int(min(M, max(next_M, self._min_M)))
+        stat['next_M'] = next_M
+        return False, next_M, stat
@@ -0,0 +1,60 @@
+""" Best action sequences carried between CEM iterations and MPC steps. """
+import numpy as np
+
+
+class EliteArchive(object):
+    """
+    Keeps the size best (actions, score) pairs seen so far. Within one CEM call the scores stay valid, so the elites
+    are merged into the next fit without being predicted again. After the robot has moved the archive can be shifted
+    in time, the shifted sequences have no score anymore and need to be evaluated again.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.actions, self.scores = None, None
+
+    def __len__(self):
+        if self.actions is None:
+            return 0
+        return self.actions.shape[0]
+
+    def clear(self):
+        self.actions, self.scores = None, None
+
+    @property
+    def scored(self):
+        return self.actions is not None and self.scores is not None
+
+    def merge(self, actions, scores):
+        """
+        :return: actions and scores of the new samples followed by the archived elites
+        """
+        if not self.scored:
+            return actions, scores
+        return np.concatenate([actions, self.actions], 0), np.concatenate([scores, self.scores], 0)
+
+    def update(self, actions, scores):
+        """
+        replaces the archive with the size best of the given samples, which should already contain the old archive
+        """
+        best = np.argsort(scores)[:self.size]
+        self.actions, self.scores = actions[best].copy(), scores[best].copy()
+
+    def shift(self, nsteps, prior='zero', tail_noise=None):
+        """
+        shifts the archived sequences of shape [n, T, adim] by nsteps time steps, the freed steps at the end are zero
+        or repeat the last action depending on prior, the scores are dropped
+        :param tail_noise: None or array of shape [n, min(nsteps, T), adim] added to the freed steps, without it the
+        elites would all agree on the end of the sequence and a fit on them would not explore it
+        :return: the shifted sequences
+        """
+        if self.actions is None:
+            return None
+        shifted = np.zeros_like(self.actions)
+        keep = max(self.actions.shape[1] - nsteps, 0)
+        shifted[:, :keep] = self.actions[:, nsteps:]
+        if prior == 'repeat_last':
+            shifted[:, keep:] = self.actions[:, -1:]
+        if tail_noise is not None:
+            shifted[:, keep:] += tail_noise
+        self.actions, self.scores = shifted, None
+        return shifted
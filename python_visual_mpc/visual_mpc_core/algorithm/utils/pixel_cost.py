@@ -0,0 +1,132 @@
+""" Vectorized expected-distance cost on predicted designated-pixel distributions. """
+import numpy as np
+import time
+from collections import OrderedDict
+
+
+def make_distance_grid(goal_pix, height, width):
+    """
+    :param goal_pix: (row, col) of the goal pixel
+    :return: euclidean distance of every pixel to goal_pix, shape [height, width]
+    """
+    rows = np.arange(height)[:, None] - goal_pix[0]
+    cols = np.arange(width)[None, :] - goal_pix[1]
+    return np.sqrt(np.square(rows) + np.square(cols))
+
+
+class DistanceGridCache(object):
+    """
+    Memoizes distance grids by (goal_pix, image size), least recently used grids are evicted first
+    """
+    def __init__(self, maxsize=64, logger=None):
+        self._maxsize = maxsize
+        self._grids = OrderedDict()
+        self._logger = logger
+        self._stacked_key, self._stacked = None, None
+
+    def get(self, goal_pix, height, width):
+        key = (float(goal_pix[0]), float(goal_pix[1]), int(height), int(width))
+        if key in self._grids:
+            grid = self._grids.pop(key)
+            self._grids[key] = grid
+            return grid
+
+        if self._logger is not None:
+            self._logger.log('making distance grid with goal_pix', goal_pix)
+        grid = make_distance_grid(goal_pix, height, width)
+        grid.flags.writeable = False   # grids are shared between calls
+        self._grids[key] = grid
+        if len(self._grids) > self._maxsize:
+            self._grids.popitem(last=False)
+        return grid
+
+    def get_stacked(self, goal_pix, height, width):
+        """
+        :param goal_pix: shape [ncam, ndesig, 2]
+        :return: distance grids of shape [ncam, ndesig, height, width]
+        """
+        key = (tuple(np.asarray(goal_pix, dtype=np.float64).flatten()), int(height), int(width))
+        if key == self._stacked_key:
+            return self._stacked
+
+        ncam, ndesig = goal_pix.shape[:2]
+        grids = np.empty((ncam, ndesig, height, width))
+        for icam in range(ncam):
+            for p in range(ndesig):
+                grids[icam, p] = self.get(goal_pix[icam, p], height, width)
+        grids.flags.writeable = False
+        self._stacked_key, self._stacked = key, grids
+        return grids
+
+    def __len__(self):
+        return len(self._grids)
+
+
+def expected_distance_costs(gen_distrib, distance_grids, normalize=True):
+    """
+    evaluates all cameras and designated pixels in one contraction, gen_distrib is neither copied nor modified
+    :param gen_distrib: shape [batch, t, ncam, r, c, ndesig]
+    :param distance_grids: shape [ncam, ndesig, r, c]
+    :param normalize: whether to normalize the distributions to sum to one
+    :return: expected distance per timestep, shape [batch, t, ncam, ndesig]
+    """
+    distance_grids = distance_grids.astype(gen_distrib.dtype, copy=False)
+    costs = np.einsum('btcrwp,cprw->btcp', gen_distrib, distance_grids)
+    if normalize:
+        costs /= np.sum(gen_distrib, axis=(3, 4))
+    return costs
+
+
+def _legacy_costs(gen_distrib, goal_pix, t_mult):
+    # per-pixel grid construction and per-task scoring as done before the vectorized path
+    bsize, T, ncam, height, width, ndesig = gen_distrib.shape
+    scores_per_task = []
+    for icam in range(ncam):
+        for p in range(ndesig):
+            distance_grid = np.empty((height, width))
+            for i in range(height):
+                for j in range(width):
+                    distance_grid[i, j] = np.linalg.norm(goal_pix[icam, p] - np.array([i, j]))
+            distrib = gen_distrib[:, :, icam, :, :, p].copy()
+            distrib /= np.sum(np.sum(distrib, axis=2), 2)[:, :, None, None]
+            distrib *= distance_grid[None, None]
+            scores = np.sum(np.sum(distrib, axis=2), 2)
+            scores_per_task.append(np.sum(scores * t_mult[None], axis=1) / np.sum(t_mult))
+    return np.stack(scores_per_task, axis=1)
+
+
+def _vectorized_costs(gen_distrib, goal_pix, t_mult, grid_cache):
+    height, width = gen_distrib.shape[3:5]
+    costs = expected_distance_costs(gen_distrib, grid_cache.get_stacked(goal_pix, height, width))
+    scores = np.sum(costs * t_mult[None, :, None, None], axis=1) / np.sum(t_mult)
+    return scores.reshape(scores.shape[0], -1)
+
+
+def benchmark(sizes=((48, 64), (96, 128)), bsize=200, T=13, ncam=1, ndesig=1, niter=3):
+    """
+    prints the time spent on pixel-distance scoring per CEM iteration for the legacy and the vectorized path
+    """
+    t_mult = np.ones(T)
+    t_mult[-1] = 10.
+    for height, width in sizes:
+        gen_distrib = np.random.uniform(size=(bsize, T, ncam, height, width, ndesig)).astype(np.float32)
+        goal_pix = np.random.randint(0, min(height, width), size=(ncam, ndesig, 2))
+        grid_cache = DistanceGridCache()
+
+        t_start = time.time()
+        for _ in range(niter):
+            legacy = _legacy_costs(gen_distrib, goal_pix, t_mult)
+        t_legacy = (time.time() - t_start) / niter
+
+        t_start = time.time()
+        for _ in range(niter):
+            vectorized = _vectorized_costs(gen_distrib, goal_pix, t_mult, grid_cache)
+        t_vectorized = (time.time() - t_start) / niter
+
+        assert np.allclose(legacy, vectorized, rtol=1e-4)
+        print('{}x{}, batch {}: legacy {:.4f}s, vectorized {:.4f}s per CEM iteration ({:.1f}x)'.format(
+            height, width, bsize, t_legacy, t_vectorized, t_legacy / t_vectorized))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,100 @@
+""" Named timing spans of the planning hot path with histogram summaries and Chrome trace export. """
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# fixed log-spaced bin edges in seconds (10us to 100s, four bins per decade) so histograms of different trajectories
+# can be added up
+HISTOGRAM_EDGES = np.logspace(-5, 2, 29)
+
+
+class PlanTimer(object):
+    """
+    Records spans as (name, start, duration, thread, args) tuples, starting and stopping a span costs two clock reads
+    and one list append.
+
+        span = timer.start('predict', run=0)
+        ...
+        duration = timer.stop(span)
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._events = []
+        self._t0 = _clock()
+
+    def start(self, name, **args):
+        return name, _clock(), args
+
+    def stop(self, span):
+        """
+        :return: duration of the span in seconds
+        """
+        name, start, args = span
+        duration = _clock() - start
+        self._events.append((name, start, duration, threading.current_thread().ident, args))
+        return duration
+
+    @property
+    def events(self):
+        return list(self._events)
+
+    def durations(self):
+        """
+        :return: OrderedDict mapping every span name to the array of its durations, in order of first occurrence
+        """
+        durations = OrderedDict()
+        for name, _, duration, _, _ in self._events:
+            durations.setdefault(name, []).append(duration)
+        return OrderedDict((name, np.array(d)) for name, d in durations.items())
+
+    def summary(self):
+        """
+        :return: per span name the count, total, mean, median, 90th and 99th percentile and maximum in seconds and the
+        counts in the bins of HISTOGRAM_EDGES
+        """
+        summary = OrderedDict()
+        for name, d in self.durations().items():
+            counts, _ = np.histogram(np.clip(d, HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1]), HISTOGRAM_EDGES)
+            summary[name] = OrderedDict([('count', int(d.shape[0])),
+                                         ('total', float(np.sum(d))),
+                                         ('mean', float(np.mean(d))),
+                                         ('p50', float(np.percentile(d, 50))),
+                                         ('p90', float(np.percentile(d, 90))),
+                                         ('p99', float(np.percentile(d, 99))),
+                                         ('max', float(np.max(d))),
+                                         ('histogram', counts.tolist())])
+        return summary
+
+    def chrome_trace(self):
+        """
+        :return: trace in the Chrome trace event format, open with chrome://tracing or Perfetto
+        """
+        pid = os.getpid()
+        events = []
+        for name, start, duration, tid, args in self._events:
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (start - self._t0) * 1e6, 'dur': duration * 1e6,
+                           'args': dict((k, _jsonable(v)) for k, v in args.items())})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, folder, prefix='plan'):
+        """
+        writes <prefix>_timing.json with the summary and <prefix>_trace.json with the Chrome trace to folder
+        """
+        with open(os.path.join(folder, '{}_timing.json'.format(prefix)), 'w') as f:
+            json.dump({'histogram_edges': HISTOGRAM_EDGES.tolist(), 'spans': self.summary()}, f, indent=1)
+        with open(os.path.join(folder, '{}_trace.json'.format(prefix)), 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def _jsonable(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
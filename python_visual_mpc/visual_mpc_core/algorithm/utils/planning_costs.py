@@ -0,0 +1,56 @@
+""" Batched extra costs on predicted rollouts and their combination with the pixel-distance score. """
+import numpy as np
+
+
+def sequence_costs(cost, images, goal_images=None):
+    """
+    evaluates an extra score function on all samples and time steps. Functions with a score_sequence(images,
+    goal_images) method get the full tensor in one call, functions only implementing score(images, goal_images) on single
+    steps of shape [M, ncam, r, c, 3] are called once per step, flattening the steps into the batch only adds memory
+    traffic for costs that are computed image by image
+    :param images: shape [M, T, ncam, r, c, 3]
+    :return: costs of shape [M, T]
+    """
+    kwargs = {}
+    if goal_images is not None:
+        kwargs['goal_images'] = goal_images
+    if hasattr(cost, 'score_sequence'):
+        return np.asarray(cost.score_sequence(images=images, **kwargs), dtype=np.float64).reshape(images.shape[:2])
+
+    c_score = np.empty(images.shape[:2])
+    for t in range(images.shape[1]):
+        c_score[:, t] = cost.score(images=images[:, t], **kwargs)
+    return c_score
+
+
+def action_costs(actions, factor):
+    """
+    sum over time of the squared norm of every action
+    :param actions: shape [M, T, adim]
+    :return: shape [M]
+    """
+    return np.einsum('mtd,mtd->m', actions, actions) * factor
+
+
+def standardize_rows(costs, std, mean):
+    """
+    rescales every row of costs to the given standard deviation and mean, rows with zero spread are set to mean
+    :param costs: shape [ncost, M]
+    """
+    row_std = np.std(costs, axis=1, keepdims=True)
+    centered = costs - np.mean(costs, axis=1, keepdims=True)
+    return std * np.divide(centered, row_std, out=np.zeros_like(centered), where=row_std > 0) + mean
+
+
+def extra_costs(cost_functions, images, goal_images, finalweight, score_std=0., score_mean=0.):
+    """
+    evaluates all extra score functions, weights the last step by finalweight and sums over time. If score_std and
+    score_mean are positive every cost is matched to them before summing so that each cost weighs like the pixel score
+    :return: shape [M]
+    """
+    c_scores = np.stack([sequence_costs(cost, images, goal_images) for cost in cost_functions])   # ncost, M, T
+    c_scores[:, :, -1] *= finalweight
+    c_scores = np.sum(c_scores, axis=2)
+    if score_std > 0 and score_mean > 0:
+        c_scores = standardize_rows(c_scores, score_std, score_mean)
+    return np.sum(c_scores, axis=0)
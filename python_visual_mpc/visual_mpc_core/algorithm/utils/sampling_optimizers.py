@@ -0,0 +1,56 @@
+""" Noise and weighting helpers for the iCEM and MPPI optimizers in CEM_Controller_Base. """
+import numpy as np
+from .cem_scheduler import round_up
+
+
+def colored_noise(beta, nsamples, nsteps, adim):
+    """
+    draws noise with power spectral density proportional to 1/f^beta along the time axis, beta=0 is white noise and
+    larger beta gives smoother action sequences. Every entry has zero mean and unit variance.
+    :return: array of shape [nsamples, nsteps, adim]
+    """
+    if beta == 0 or nsteps <= 1:
+        return np.random.standard_normal((nsamples, nsteps, adim))
+
+    freqs = np.fft.rfftfreq(nsteps)
+    freqs[0] = 1. / nsteps     # the lowest frequency the sequence can resolve, avoids dividing by zero for the mean
+    scale = freqs ** (-beta / 2.)
+
+    real = np.random.standard_normal((nsamples, adim, freqs.shape[0])) * scale
+    imag = np.random.standard_normal((nsamples, adim, freqs.shape[0])) * scale
+    # the mean and, for an even number of steps, the Nyquist frequency have real coefficients and count once in the
+    # variance of the inverse transform, all other frequencies count twice for the real and twice for the imaginary part
+    var_weight = np.full(freqs.shape[0], 4.)
+    imag[..., 0] = 0
+    var_weight[0] = 1.
+    if nsteps % 2 == 0:
+        imag[..., -1] = 0
+        var_weight[-1] = 1.
+    std = np.sqrt(np.sum(var_weight * scale ** 2)) / nsteps
+
+    noise = np.fft.irfft(real + 1j * imag, n=nsteps, axis=-1) / std
+    return np.transpose(noise, [0, 2, 1])
+
+
+def mppi_weights(scores, temperature):
+    """
+    exponential weights of the MPPI update, lower scores get higher weight
+    :param temperature: in units of the standard deviation of the scores, so the same value works for every cost
+    :return: weights summing to one
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    scale = temperature * (np.std(scores) + 1e-8)
+    weights = np.exp(-(scores - np.min(scores)) / scale)
+    return weights / np.sum(weights)
+
+
+def population_sizes(M, niter, decay, min_samples, multiple=1):
+    """
+    number of samples per iteration of iCEM, M / decay^i but at least min_samples, rounded up to a multiple of
+    multiple (e.g. the predictor batch size)
+    """
+    sizes = []
+    for itr in range(niter):
+        n = max(M * decay ** (-itr), min_samples)
+        sizes.append(min(round_up(n, multiple), round_up(M, multiple)))
+    return sizes
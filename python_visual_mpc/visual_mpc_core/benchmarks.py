@@ -86,6 +86,8 @@ def perform_benchmark(conf=None, iex=-1, gpu_id=None):
         sim.agent._hyperparams['record'] = record_dir
 
         agent_data = sim.take_sample(i_traj)
+        if getattr(sim.policy, 'timer', None) is not None:
+            sim.policy.timer.save(record_dir)    # planning latency summary and trace of this trajectory
 
         stats_data = agent_data['stats']
         stat_arrays = OrderedDict()
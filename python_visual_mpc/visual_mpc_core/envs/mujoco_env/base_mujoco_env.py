@@ -33,6 +33,7 @@ class BaseMujocoEnv(BaseEnv):
         parent_params.add_hparam('viewer_image_height', 480)
         parent_params.add_hparam('viewer_image_width', 640)
         parent_params.add_hparam('ncam', 1)
+        parent_params.add_hparam('skip_render', False)    # observations carry empty images, for state-based planning
 
         return parent_params
 
@@ -59,8 +60,10 @@ class BaseMujocoEnv(BaseEnv):
         - left: renders only left camera
         - main: renders only main (front) camera
         :param mode: Mode to render with (dual by default)
-        :return: uint8 numpy array with rendering from sim
+        :return: uint8 numpy array with rendering from sim, of shape (ncam, 0, 0, 3) if skip_render is set
         """
+        if self._hp.skip_render:
+            return np.zeros((self._ncam, 0, 0, 3), dtype=np.uint8)
         images = np.zeros((self._ncam, self._frame_height, self._frame_width, 3), dtype=np.uint8)
         for i, cam in enumerate(self.cameras):
             images[i] = self.sim.render(self._frame_width, self._frame_height, camera_name=cam)
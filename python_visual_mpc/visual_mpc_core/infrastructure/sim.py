@@ -26,6 +26,7 @@ class Sim(object):
         self.policy = config['policy']['type'](self.agent._hyperparams, config['policy'], gpu_id, ngpu)
 
         self._record_queue = config.pop('record_saver', None)
+        self._record_buffer = config.pop('record_buffer', None)
         self._counter = config.pop('counter', None)
 
         self.trajectory_list = []
@@ -60,6 +61,9 @@ class Sim(object):
 
         if self._hyperparams.get('save_raw_images', False):
             self._save_raw_data(itr, agent_data, obs_dict, policy_outputs)
+        elif self._record_queue is not None and self._record_buffer is not None:
+            # the arrays go through shared memory, the queue only carries a descriptor
+            self._record_queue.put(self._record_buffer.pack(agent_data, obs_dict, policy_outputs))
         elif self._record_queue is not None:
             self._record_queue.put((agent_data, obs_dict, policy_outputs))
         else:
@@ -97,3 +101,5 @@ class Sim(object):
             pkl.dump(obs_dict, file)
         with open('{}/policy_out.pkl'.format(traj_folder), 'wb') as file:
             pkl.dump(policy_outputs, file)
+        if getattr(self.policy, 'timer', None) is not None:
+            self.policy.timer.save(traj_folder)    # planning latency summary and trace next to agent_data's scores
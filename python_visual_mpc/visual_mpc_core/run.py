@@ -1,5 +1,5 @@
 from python_visual_mpc.visual_mpc_core.infrastructure.synchronize_tfrecs import sync
-from multiprocessing import Pool, Process, Manager
+from multiprocessing import Pool, Manager
 import sys
 import argparse
 import importlib.machinery
@@ -9,7 +9,8 @@ from python_visual_mpc.visual_mpc_core.benchmarks import perform_benchmark
 import copy
 import random
 import numpy as np
-from python_visual_mpc.visual_mpc_core.agent.utils.traj_saver import record_worker
+from python_visual_mpc.visual_mpc_core.agent.utils.traj_saver import start_record_workers, stop_record_workers
+from python_visual_mpc.visual_mpc_core.agent.utils import shared_traj_buffer
 import re
 import os
 from python_visual_mpc.visual_mpc_core.infrastructure.utility.combine_scores import combine_scores
@@ -136,7 +137,7 @@ def main():
         print('launched sync')
 
     if 'data_save_dir' in hyperparams['agent']:
-        record_queue, record_saver_proc, counter = prepare_saver(hyperparams)
+        record_queue, record_saver_procs, counter, record_buffer = prepare_saver(hyperparams)
 
     if args.iex != -1:
         hyperparams['agent']['iex'] = args.iex
@@ -151,6 +152,7 @@ def main():
         modconf['result_dir'] = result_dir
         if 'data_save_dir' in hyperparams['agent']:
             modconf['record_saver'] = record_queue
+            modconf['record_buffer'] = record_buffer
             modconf['counter'] = counter
         conflist.append(modconf)
     if parallel:
@@ -160,8 +162,9 @@ def main():
         use_worker(conflist[0], args.iex)
 
     if 'data_save_dir' in hyperparams['agent'] and not hyperparams.get('save_raw_images', False):
-        record_queue.put(None)           # send flag to background thread that it can end saving after it's done
-        record_saver_proc.join()         # joins thread and continues execution
+        stop_record_workers(record_queue, record_saver_procs)   # savers finish writing their queued trajectories
+        if record_buffer is not None:
+            record_buffer.close()
 
     if 'master_datadir' in hyperparams['agent']:
         ray.wait([sync_todo_id])
@@ -174,16 +177,29 @@ def main():
 
 def prepare_saver(hyperparams):
     m = Manager()
-    record_queue, synch_counter = m.Queue(), SynchCounter(m)
+    n_record_workers = hyperparams.get('n_record_workers', 1)
+    # bounded, so that data collection blocks instead of piling up trajectories when the savers fall behind
+    record_queue_size = hyperparams.get('record_queue_size', 8 * n_record_workers)
+    record_queue = m.Queue(record_queue_size)
+    synch_counter = SynchCounter(m)
     save_dir, T = hyperparams['agent']['data_save_dir'] + '/records', hyperparams['agent']['T']
+    record_buffer = None
     if hyperparams.get('save_data', True) and not hyperparams.get('save_raw_images', False):
+        if hyperparams.get('shared_memory_handoff', False):
+            if shared_traj_buffer.shared_memory is None:
+                print('shared memory handoff requires python >= 3.8, sending trajectories through the queue')
+            else:
+                # one slot per queued trajectory plus one per record worker
+                nslots = record_queue_size + n_record_workers
+                slot_bytes = int(hyperparams.get('shm_slot_mb', 32) * 2 ** 20)
+                record_buffer = shared_traj_buffer.SharedTrajectoryBuffer(nslots, slot_bytes, m.Queue())
         seperate_good, traj_per_file = hyperparams.get('seperate_good', False), hyperparams.get('traj_per_file', 16)
-        record_saver_proc = Process(target=record_worker, args=(
-        record_queue, save_dir, T, seperate_good, traj_per_file, hyperparams['start_index']))
-        record_saver_proc.start()
+        record_saver_procs = start_record_workers(record_queue, n_record_workers, save_dir, T, seperate_good,
+                                                  traj_per_file, hyperparams['start_index'], shared_buffer=record_buffer,
+                                                  save_format=hyperparams.get('record_format', 'tfrecord'))
     else:
-        record_saver_proc = None
-    return record_queue, record_saver_proc, synch_counter
+        record_saver_procs = []
+    return record_queue, record_saver_procs, synch_counter, record_buffer
 
 
 def sorted_alphanumeric(l):